@@ -1,2 +1,26 @@
 class CompileError(Exception):
-    pass
+    """Raised when building code fails.
+
+    .. attribute:: diagnostics
+
+        The output of the compiler, or *None* if not available.
+    """
+
+    def __init__(self, *args, **kwargs):
+        diagnostics = kwargs.pop("diagnostics", None)
+        if kwargs:
+            raise TypeError("unexpected keyword arguments: %s"
+                    % ", ".join(kwargs))
+
+        Exception.__init__(self, *args)
+        self.diagnostics = diagnostics
+
+    def __reduce__(self):
+        return (type(self), self.args, {"diagnostics": self.diagnostics})
+
+
+class CompileLimitError(CompileError):
+    """Raised when building code fails because the compiler exceeded the
+    limits set by :class:`codepy.toolchain.CompileLimits`, which may not
+    happen again under less load.
+    """
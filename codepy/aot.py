@@ -0,0 +1,359 @@
+"""Ahead-of-time builds of extension modules otherwise compiled just in time.
+
+For targets without a compiler, the extension modules an application builds
+through :func:`codepy.jit.compile_from_string` (and therefore
+:meth:`codepy.bpl.BoostPythonModule.compile` and the kernels in
+:mod:`codepy.elementwise`) can be recorded while running it where a
+compiler is available, either within :func:`recording` or with the
+environment variable :envvar:`CODEPY_AOT_RECORD` set to the name of the
+record file. :func:`export_package`, also available as::
+
+    python -m codepy.aot export RECORD_FILE OUTPUT_DIR PACKAGE_NAME
+
+turns the record into the source of a Python package that builds all
+recorded modules with :mod:`setuptools`, for instance with ``pip wheel``.
+Once such a package is installed, :func:`codepy.jit.compile_from_string`
+finds the modules in it by their source, before trying to compile them.
+"""
+
+from __future__ import division, print_function
+
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# the attributes of toolchains needed to build the modules again
+_TOOLCHAIN_ATTRIBUTES = ["cflags", "ldflags", "include_dirs", "library_dirs",
+        "libraries", "defines", "undefines"]
+
+
+# the attributes of toolchains that change the meaning of the sources
+_KEY_ATTRIBUTES = ["defines", "undefines", "cflags"]
+
+
+def _get_toolchain_attributes(toolchain):
+    return dict(
+            (attr, list(getattr(toolchain, attr, [])))
+            for attr in _TOOLCHAIN_ATTRIBUTES)
+
+
+def get_aot_key(name, source_string, toolchain_attributes):
+    """Return the key identifying the module *name* built from the list of
+    sources *source_string* in packages made by :func:`export_package`.
+    *toolchain_attributes* is a dictionary of the toolchain's attributes, as
+    in the records of :func:`record_module`.
+
+    Unlike cache keys, it depends only on the flags of the toolchain that
+    are exported, not on the compiler, so that it can be computed without
+    one.
+    """
+    import hashlib
+    checksum = hashlib.md5()
+    checksum.update(name.encode("utf-8"))
+    for source in source_string:
+        checksum.update(b"\0")
+        checksum.update(source.encode("utf-8"))
+
+    for attr in _KEY_ATTRIBUTES:
+        values = toolchain_attributes[attr]
+        if attr == "cflags":
+            values = _portable_flags(values)
+
+        checksum.update(b"\0\0")
+        checksum.update(attr.encode("utf-8"))
+        for value in values:
+            checksum.update(b"\0")
+            checksum.update(value.encode("utf-8"))
+
+    return checksum.hexdigest()
+
+
+# {{{ recording
+
+_record_file = None
+
+
+@contextmanager
+def recording(record_file):
+    """A context manager recording the extension modules built within the
+    block (including those found in the cache) by appending them to
+    *record_file*.
+    """
+    global _record_file
+    old_record_file = _record_file
+    _record_file = record_file
+    try:
+        yield
+    finally:
+        _record_file = old_record_file
+
+
+def _get_record_file():
+    import os
+    if _record_file is not None:
+        return _record_file
+    return os.environ.get("CODEPY_AOT_RECORD") or None
+
+
+def record_module(toolchain, name, source_string, source_name):
+    """Append the module *name* to the current record file, if any."""
+    record_file = _get_record_file()
+    if record_file is None:
+        return
+
+    from six.moves.cPickle import dumps
+    data = dumps({
+        "name": name,
+        "source_string": list(source_string),
+        "source_name": list(source_name),
+        "toolchain": _get_toolchain_attributes(toolchain),
+        }, protocol=2)
+
+    with open(record_file, "ab") as outf:
+        try:
+            import fcntl
+        except ImportError:
+            outf.write(data)
+        else:
+            # several processes may record to the same file
+            fcntl.flock(outf.fileno(), fcntl.LOCK_EX)
+            try:
+                outf.write(data)
+                outf.flush()
+            finally:
+                fcntl.flock(outf.fileno(), fcntl.LOCK_UN)
+
+
+def read_record(record_file):
+    """Return the modules in *record_file* as a dictionary mapping their
+    :func:`get_aot_key` to the recorded information.
+    """
+    from six.moves.cPickle import load
+
+    modules = {}
+    with open(record_file, "rb") as inf:
+        while True:
+            try:
+                module = load(inf)
+            except EOFError:
+                break
+
+            modules[get_aot_key(module["name"], module["source_string"],
+                module["toolchain"])] = module
+
+    return modules
+
+# }}}
+
+
+# {{{ export
+
+SETUP_TEMPLATE = """from setuptools import setup, Extension
+
+setup(
+    name=%(package_name)r,
+    version=%(version)r,
+    packages=[%(package_name)r],
+    ext_modules=[
+%(extensions)s
+        ],
+    entry_points={"codepy.aot": [%(entry_point)r]},
+    zip_safe=False,
+    )
+"""
+
+EXTENSION_TEMPLATE = """        Extension(%(name)r,
+            sources=%(sources)r,
+            include_dirs=%(include_dirs)r,
+            library_dirs=%(library_dirs)r,
+            libraries=%(libraries)r,
+            define_macros=%(define_macros)r,
+            undef_macros=%(undef_macros)r,
+            extra_compile_args=%(extra_compile_args)r,
+            extra_link_args=%(extra_link_args)r,
+            language="c++"),"""
+
+
+def _portable_flags(flags):
+    # code built for the exporting machine's CPU may not run elsewhere;
+    # setuptools provides the flags for building extensions itself
+    return [f for f in flags
+            if not f.startswith(("-march=", "-mcpu=", "-mtune="))
+            and f not in ["-shared", "-c"]]
+
+
+def export_package(record_file, output_dir, package_name, version="1.0"):
+    """Write the source of a package named *package_name* that builds the
+    modules recorded in *record_file* to the directory *output_dir*.
+    """
+    import os
+    from os.path import join
+
+    modules = read_record(record_file)
+
+    package_dir = join(output_dir, package_name)
+    if not os.path.isdir(package_dir):
+        os.makedirs(package_dir)
+
+    extensions = []
+    index = {}
+    for key, module in sorted(modules.items()):
+        # the module's name is the last component of that of the
+        # extension, as Python finds its initialization function by it
+        module_dir = "m_%s" % key
+        if not os.path.isdir(join(package_dir, module_dir)):
+            os.mkdir(join(package_dir, module_dir))
+
+        sources = []
+        for source_name, source in zip(
+                module["source_name"], module["source_string"]):
+            path = join(package_name, module_dir, source_name)
+            with open(join(output_dir, path), "w") as outf:
+                outf.write(source)
+            sources.append(path)
+
+        toolchain = module["toolchain"]
+        define_macros = []
+        for define in toolchain["defines"]:
+            macro, _, value = define.partition("=")
+            define_macros.append((macro, value or None))
+
+        extensions.append(EXTENSION_TEMPLATE % dict(
+            name="%s.%s.%s" % (package_name, module_dir, module["name"]),
+            sources=sources,
+            include_dirs=toolchain["include_dirs"],
+            library_dirs=toolchain["library_dirs"],
+            libraries=toolchain["libraries"],
+            define_macros=define_macros,
+            undef_macros=toolchain["undefines"],
+            extra_compile_args=_portable_flags(toolchain["cflags"]),
+            extra_link_args=_portable_flags(toolchain["ldflags"]),
+            ))
+        index[key] = (module_dir, module["name"])
+
+    with open(join(package_dir, "__init__.py"), "w") as outf:
+        outf.write('"""Extension modules built ahead of time by codepy."""\n\n')
+        outf.write("# maps keys computed by codepy.aot.get_aot_key to\n")
+        outf.write("# (subdirectory, module name)\n")
+        outf.write("MODULES = %r\n" % index)
+
+    with open(join(output_dir, "setup.py"), "w") as outf:
+        outf.write(SETUP_TEMPLATE % dict(
+            package_name=package_name,
+            version=version,
+            extensions="\n".join(extensions),
+            entry_point="%s = %s" % (package_name, package_name)))
+
+    return sorted(modules)
+
+# }}}
+
+
+# {{{ lookup
+
+_packages = None
+
+
+def _get_packages():
+    """Return a list of the installed packages built by
+    :func:`export_package`.
+    """
+    global _packages
+    if _packages is None:
+        import os
+        from importlib import import_module
+
+        names = [name
+                for name in os.environ.get("CODEPY_AOT_PACKAGES", "").split(",")
+                if name]
+
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            pass
+        else:
+            eps = entry_points()
+            if hasattr(eps, "select"):
+                eps = eps.select(group="codepy.aot")
+            else:
+                eps = eps.get("codepy.aot", [])
+            names.extend(ep.value for ep in eps)
+
+        _packages = []
+        for name in names:
+            try:
+                _packages.append(import_module(name))
+            except ImportError as e:
+                logger.warning("could not import AOT package %s: %s"
+                        % (name, e))
+
+    return _packages
+
+
+def have_aot_modules():
+    """Return *True* if any packages built by :func:`export_package` are
+    installed.
+    """
+    return bool(_get_packages())
+
+
+def find_aot_module(toolchain, name, source_string):
+    """Return the path of the module *name* built from the list of sources
+    *source_string* with the flags of *toolchain* in an installed package,
+    or *None*.
+    """
+    packages = _get_packages()
+    if not packages:
+        return None
+
+    from os.path import dirname, exists, join
+    from importlib.machinery import EXTENSION_SUFFIXES
+
+    key = get_aot_key(name, source_string,
+            _get_toolchain_attributes(toolchain))
+    for package in packages:
+        try:
+            module_dir, module_name = package.MODULES[key]
+        except (AttributeError, KeyError):
+            continue
+
+        for suffix in EXTENSION_SUFFIXES:
+            path = join(dirname(package.__file__), module_dir,
+                    module_name + suffix)
+            if exists(path):
+                return path
+
+    return None
+
+# }}}
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="Build ahead of time extension modules recorded "
+            "while codepy compiled them just in time.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    export_parser = subparsers.add_parser("export",
+            help="write a package building the recorded modules")
+    export_parser.add_argument("record_file")
+    export_parser.add_argument("output_dir")
+    export_parser.add_argument("package_name")
+    export_parser.add_argument("--version", default="1.0")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        keys = export_package(args.record_file, args.output_dir,
+                args.package_name, args.version)
+        print("exported %d modules to %s" % (len(keys), args.output_dir))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: foldmethod=marker
@@ -0,0 +1,191 @@
+"""Selection of compiler flags by timing compiled variants."""
+
+from __future__ import division
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Variants tried by default, as pairs of an optimization level (see
+# :meth:`codepy.toolchain.Toolchain.with_optimization_level`) and a list of
+# additional compiler flags. ``-ffast-math`` changes the semantics of floating
+# point arithmetic and is therefore not among them, but may be passed
+# explicitly.
+DEFAULT_VARIANTS = [
+        (2, []),
+        (3, []),
+        (3, ["-funroll-loops"]),
+        (3, ["-mprefer-vector-width=256"]),
+        (3, ["-mprefer-vector-width=512"]),
+        ]
+
+
+def get_default_autotune_dir():
+    import appdirs
+    import sys
+    from os.path import join
+    return join(
+            appdirs.user_cache_dir("codepy", "codepy"),
+            "codepy-autotune-v1-py%s" % (
+                ".".join(str(i) for i in sys.version_info),))
+
+
+def _get_machine_id():
+    import platform
+    from codepy.toolchain import get_cpu_features
+
+    model = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as inf:
+            for line in inf:
+                key, _, value = line.partition(":")
+                if key.strip() == "model name":
+                    model = value.strip()
+                    break
+    except IOError:
+        pass
+
+    return [platform.machine(), model, sorted(get_cpu_features())]
+
+
+def apply_variant(toolchain, variant):
+    """Return a copy of *toolchain* set up for *variant*, a pair of an
+    optimization level and a list of extra compiler flags.
+    """
+    level, extra_cflags = variant
+    toolchain = toolchain.with_optimization_level(level)
+    return toolchain.copy(cflags=toolchain.cflags + list(extra_cflags))
+
+
+def autotune(key, variants, build, benchmark, autotune_dir=None,
+        max_workers=None):
+    """Return a tuple *(variant, built)* for the fastest of *variants*.
+
+    *build* is called with each variant and returns an object that is passed
+    to *benchmark*, which returns the time it takes to run. The builds happen
+    in a pool of *max_workers* threads, the benchmarks one after the other.
+    Variants that fail to build are skipped.
+
+    The winner is recorded under *key*, a string, in *autotune_dir*, so
+    that later calls with the same *key* build only the recorded variant. If
+    *autotune_dir* is *None*, a default location is used.
+    """
+    import os
+    from os.path import join
+    from six.moves.cPickle import load, dump
+
+    if autotune_dir is None:
+        autotune_dir = get_default_autotune_dir()
+
+    record_path = join(autotune_dir, key)
+
+    try:
+        with open(record_path, "rb") as inf:
+            variant = load(inf)
+    except (IOError, EOFError):
+        pass
+    else:
+        if variant in variants:
+            return variant, build(variant)
+
+    from concurrent.futures import ThreadPoolExecutor
+    from codepy import CompileError
+
+    def try_build(variant):
+        try:
+            return build(variant)
+        except CompileError:
+            logger.info("autotuning variant %s failed to build" % (variant,))
+            return None
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(variants))
+    try:
+        builds = list(executor.map(try_build, variants))
+    finally:
+        executor.shutdown()
+
+    timings = []
+    for variant, built in zip(variants, builds):
+        if built is not None:
+            timing = benchmark(built)
+            logger.info("autotuning variant %s took %g s" % (variant, timing))
+            timings.append((timing, variants.index(variant), built))
+
+    if not timings:
+        raise CompileError("no autotuning variant could be built")
+
+    timing, best_index, built = min(timings)
+    variant = variants[best_index]
+
+    try:
+        os.makedirs(autotune_dir)
+    except OSError as e:
+        from errno import EEXIST
+        if e.errno != EEXIST:
+            raise
+
+    # write atomically, as other processes may be reading
+    from tempfile import mkstemp
+    fd, temp_path = mkstemp(dir=autotune_dir)
+    with os.fdopen(fd, "wb") as outf:
+        dump(variant, outf)
+    os.rename(temp_path, record_path)
+
+    return variant, built
+
+
+def autotune_elementwise_kernel(arguments, operation, sample_args,
+        name="kernel", toolchain=None, variants=None, repeat=5,
+        autotune_dir=None, max_workers=None, **kwargs):
+    """Return a :class:`codepy.elementwise.ElementwiseKernel` compiled with
+    the fastest of *variants* (by default :data:`DEFAULT_VARIANTS`) when
+    called with *sample_args*, taking the best of *repeat* runs. Remaining
+    keyword arguments are passed to the kernel's constructor.
+
+    The choice is recorded by the kernel's source, the compiler and the
+    machine (see :func:`autotune`), so that later calls compile only the
+    chosen variant.
+    """
+    from timeit import default_timer
+    from hashlib import md5
+    from codepy.elementwise import ElementwiseKernel
+
+    if toolchain is None:
+        from codepy.toolchain import guess_toolchain
+        toolchain = guess_toolchain()
+
+    if variants is None:
+        variants = DEFAULT_VARIANTS
+
+    variants = [(level, list(extra_cflags)) for level, extra_cflags in variants]
+
+    checksum = md5()
+    checksum.update(repr([
+        arguments, operation, name, sorted(kwargs.items()),
+        toolchain.abi_id(), _get_machine_id(),
+        ]).encode("utf-8"))
+
+    def build(variant):
+        # compiled here, so that failing variants are skipped and the
+        # compile is not timed, whatever the compilation mode
+        kernel = ElementwiseKernel(arguments, operation, name,
+                toolchain=apply_variant(toolchain, variant),
+                **dict(kwargs, lazy=False))
+        if kernel.generic_arg_indices:
+            kernel._get_specialization(kernel._get_arg_dtypes(sample_args))
+        return kernel
+
+    def benchmark(kernel):
+        # warm up
+        kernel(*sample_args)
+
+        timings = []
+        for i in range(repeat):
+            start = default_timer()
+            kernel(*sample_args)
+            timings.append(default_timer() - start)
+        return min(timings)
+
+    variant, kernel = autotune(checksum.hexdigest(), variants, build, benchmark,
+            autotune_dir=autotune_dir, max_workers=max_workers)
+    return kernel
@@ -15,6 +15,7 @@ class BoostPythonModule(object):
 
         self.has_codepy_include = False
         self.has_raw_function_include = False
+        self.has_gil_release_guard = False
         self.max_arity = max_arity
         self.use_private_namespace = use_private_namespace
 
@@ -56,6 +57,37 @@ class BoostPythonModule(object):
             ])
         self.has_raw_function_include = True
 
+    def add_gil_release_guard(self):
+        """Add the declaration of ``codepy_scoped_gil_release`` to the
+        preamble. Constructing an instance of this class releases the global
+        interpreter lock, which is reacquired once it goes out of scope.
+        """
+        if self.has_gil_release_guard:
+            return
+
+        from cgen import Line
+
+        self.add_to_preamble([
+            Line(),
+            Line("namespace"),
+            Line("{"),
+            Line("  class codepy_scoped_gil_release"),
+            Line("  {"),
+            Line("    private:"),
+            Line("      PyThreadState *m_thread_state;"),
+            Line(),
+            Line("    public:"),
+            Line("      codepy_scoped_gil_release()"),
+            Line("        : m_thread_state(PyEval_SaveThread())"),
+            Line("      { }"),
+            Line(),
+            Line("      ~codepy_scoped_gil_release()"),
+            Line("      { PyEval_RestoreThread(m_thread_state); }"),
+            Line("  };"),
+            Line("}"),
+            ])
+        self.has_gil_release_guard = True
+
     def expose_vector_type(self, name, py_name=None):
         self.add_codepy_include()
 
@@ -73,11 +105,23 @@ class BoostPythonModule(object):
                     ".def(codepy::no_compare_indexing_suite<cl>())" % py_name),
                 ]))
 
-    def add_function(self, func):
+    def add_function(self, func, release_gil=False):
         """Add a function to be exposed. *func* is expected to be a
         :class:`cgen.FunctionBody`.
+
+        If *release_gil* is *True*, the body of *func* is run without holding
+        the global interpreter lock. Boost.Python converts all arguments
+        before the body is entered, but the body itself must not touch any
+        Python objects.
         """
 
+        if release_gil:
+            from cgen import Block, FunctionBody, Statement
+            self.add_gil_release_guard()
+            func = FunctionBody(func.fdecl, Block([
+                Statement("codepy_scoped_gil_release codepy_gil_release"),
+                func.body]))
+
         self.mod_body.append(func)
         from cgen import Statement
         self.init_body.append(
@@ -153,18 +197,30 @@ class BoostPythonModule(object):
 
         return Module(body)
 
-    def compile(self, toolchain, **kwargs):
+    def compile(self, toolchain, key=None, **kwargs):
         """Return the extension module generated from the code described
         by *self*. If necessary, build the code using *toolchain* with
         :func:`codepy.jit.extension_from_string`. Any keyword arguments
         accept by that latter function may be passed in *kwargs*.
+
+        If *key* is given, it must describe the generated code, such as by
+        the parameters of the generator, and the code is only generated if
+        no cache entry for *key* exists (see
+        :func:`codepy.jit.compile_from_string`).
         """
 
         from codepy.libraries import add_boost_python
         toolchain = toolchain.copy()
         add_boost_python(toolchain)
 
+        def generate_source():
+            return str(self.generate())+"\n"
+
         from codepy.jit import extension_from_string
-        return extension_from_string(toolchain, self.name,
-                str(self.generate())+"\n", **kwargs)
+        if key is None:
+            return extension_from_string(toolchain, self.name,
+                    generate_source(), **kwargs)
+        else:
+            return extension_from_string(toolchain, self.name,
+                    generate_source, key=key, **kwargs)
 
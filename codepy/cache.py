@@ -0,0 +1,607 @@
+"""Administration of the compiler cache of :func:`codepy.jit.compile_from_string`.
+
+The functions here are also available as::
+
+    python -m codepy.cache [--cache-dir DIR] COMMAND ...
+
+with the commands ``stats``, ``list``, ``verify``, ``prune``, ``export`` and
+``import`` (see ``--help``). All of them are safe to use while other
+processes use the cache: published entries are never modified, only
+replaced or removed while holding their locks, and imported entries are
+published like freshly built ones. Hit rates are only available if cache
+accesses are recorded (see :func:`codepy.jit.set_access_recording`).
+"""
+
+from __future__ import division, print_function
+
+from pytools import Record
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry(Record):
+    """An entry of the compiler cache.
+
+    .. attribute:: checksum
+    .. attribute:: path
+
+        The directory holding the entry.
+
+    .. attribute:: size
+
+        The total size of the entry's files, in bytes.
+
+    .. attribute:: created
+
+        The time the entry was built, in seconds since the epoch.
+
+    .. attribute:: build_time
+
+        The time building the entry took, in seconds, or *None* if unknown.
+
+    .. attribute:: compiler
+
+        A description of the compiler that built the entry, or *None* if
+        unknown.
+    """
+
+
+def _get_cache_dir(cache_dir):
+    if cache_dir is None:
+        from codepy.jit import _get_default_cache_dir
+        cache_dir = _get_default_cache_dir()
+    return cache_dir
+
+
+def _is_checksum(name):
+    return len(name) == 32 and all(c in "0123456789abcdef" for c in name)
+
+
+def _read_entry(cache_dir, checksum):
+    import os
+    from os.path import getmtime, getsize, join
+    from codepy.jit import _get_entry_dir, _load_info, _InvalidInfoFile
+
+    path = _get_entry_dir(cache_dir, checksum)
+    try:
+        size = sum(getsize(join(path, fn)) for fn in os.listdir(path))
+        try:
+            info = _load_info(join(path, "info"))
+        except _InvalidInfoFile:
+            info = None
+        created = getattr(info, "created", None) or getmtime(path)
+    except OSError:
+        # removed meanwhile
+        return None
+
+    return CacheEntry(
+            checksum=checksum,
+            path=path,
+            size=size,
+            created=created,
+            build_time=getattr(info, "build_time", None),
+            compiler=getattr(info, "compiler", None))
+
+
+def iter_entries(cache_dir=None):
+    """Yield a :class:`CacheEntry` for each entry of the cache in
+    *cache_dir*, by default the default cache directory.
+    """
+    import os
+    from os.path import join
+
+    cache_dir = _get_cache_dir(cache_dir)
+
+    try:
+        shards = sorted(os.listdir(cache_dir))
+    except OSError:
+        return
+
+    for shard in shards:
+        if len(shard) != 2:
+            continue
+
+        try:
+            names = sorted(os.listdir(join(cache_dir, shard)))
+        except OSError:
+            continue
+
+        for name in names:
+            # skips locks and entries being built
+            if not _is_checksum(name):
+                continue
+
+            entry = _read_entry(cache_dir, name)
+            if entry is not None:
+                yield entry
+
+
+def read_accesses(cache_dir=None):
+    """Return a dictionary mapping the checksums of entries to tuples
+    *(hits, misses, last_access)*, as recorded in *cache_dir*.
+    """
+    from os.path import join
+    from codepy.jit import _flush_accesses
+
+    # including those of this process not yet written
+    _flush_accesses()
+
+    accesses = {}
+    try:
+        inf = open(join(_get_cache_dir(cache_dir), "accesses"))
+    except IOError:
+        return accesses
+
+    with inf:
+        for line in inf:
+            try:
+                when, kind, checksum = line.split()
+                when = float(when)
+            except ValueError:
+                # partially written
+                continue
+
+            hits, misses, last_access = accesses.get(checksum, (0, 0, 0))
+            if kind == "hit":
+                hits += 1
+            else:
+                misses += 1
+            accesses[checksum] = (hits, misses, max(last_access, when))
+
+    return accesses
+
+
+def get_stats(cache_dir=None, slowest=5):
+    """Return a dictionary with the number of *entries*, their total size
+    in *bytes*, the recorded numbers of *hits* and *misses*, and the
+    *slowest* entries to build, as a list of :class:`CacheEntry` instances.
+    """
+    entries = list(iter_entries(cache_dir))
+    accesses = read_accesses(cache_dir)
+
+    return {
+            "entries": len(entries),
+            "bytes": sum(entry.size for entry in entries),
+            "hits": sum(hits for hits, _, _ in accesses.values()),
+            "misses": sum(misses for _, misses, _ in accesses.values()),
+            "slowest": sorted(
+                (entry for entry in entries if entry.build_time is not None),
+                key=lambda entry: entry.build_time, reverse=True)[:slowest],
+            }
+
+
+def verify_entry(entry):
+    """Return a list of the problems found with *entry*, a
+    :class:`CacheEntry`: an unreadable info file, missing or corrupt built
+    files and changed dependencies.
+    """
+    import os
+    from os.path import exists, join
+    from codepy.jit import (_load_info, _InvalidInfoFile, _get_file_md5sum,
+            _decompress, COMPRESSED_SUFFIX)
+
+    problems = []
+    try:
+        info = _load_info(join(entry.path, "info"))
+    except _InvalidInfoFile:
+        return ["invalid info file"]
+
+    built_files = [fn for fn in os.listdir(entry.path) if fn != "info"]
+    if not built_files:
+        problems.append("no built file")
+
+    for fn in built_files:
+        path = join(entry.path, fn)
+        try:
+            with open(path, "rb") as inf:
+                data = inf.read()
+            if fn.endswith(COMPRESSED_SUFFIX):
+                data = _decompress(data)
+        except Exception as e:
+            problems.append("unreadable file %s: %s" % (fn, e))
+        else:
+            if not data:
+                problems.append("empty file %s" % fn)
+
+    for name, date, md5sum in info.dependencies:
+        if not exists(name):
+            problems.append("missing dependency %s" % name)
+        elif _get_file_md5sum(name) != md5sum:
+            problems.append("changed dependency %s" % name)
+
+    return problems
+
+
+def remove_entry(checksum, cache_dir=None):
+    """Remove the entry *checksum* from the cache in *cache_dir*, along with
+    its lock file, waiting for processes using it to release its lock.
+    """
+    import os
+    import shutil
+    from os.path import dirname, join
+    from tempfile import mkdtemp
+    from codepy.jit import CleanupManager, EntryLockManager, _get_entry_dir
+
+    entry_dir = _get_entry_dir(_get_cache_dir(cache_dir), checksum)
+
+    cleanup_m = CleanupManager()
+    try:
+        lock_m = EntryLockManager(cleanup_m, entry_dir)
+
+        # move it out of the way first, so that it disappears atomically
+        temp_dir = mkdtemp(prefix="tmp-", dir=dirname(entry_dir))
+        try:
+            os.rename(entry_dir, join(temp_dir, checksum))
+        except OSError:
+            pass
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+        lock_m.remove_lock_file()
+    finally:
+        cleanup_m.clean_up()
+
+
+def _remove_keys(cache_dir, checksums):
+    """Remove the files of the user keys (see
+    :func:`codepy.jit.compile_from_string`) naming one of *checksums*.
+    """
+    import os
+    from os.path import join
+
+    keys_dir = join(cache_dir, "keys")
+    try:
+        shards = os.listdir(keys_dir)
+    except OSError:
+        return
+
+    for shard in shards:
+        try:
+            names = os.listdir(join(keys_dir, shard))
+        except OSError:
+            continue
+
+        for name in names:
+            path = join(keys_dir, shard, name)
+            try:
+                with open(path) as inf:
+                    if inf.read().strip() in checksums:
+                        os.unlink(path)
+            except (IOError, OSError):
+                pass
+
+
+def _remove_accesses(cache_dir, checksums):
+    """Remove the access records of *checksums*. Records written by other
+    processes meanwhile may be lost, which only affects the statistics.
+    """
+    import os
+    from os.path import join
+    from tempfile import mkstemp
+
+    accesses_file = join(cache_dir, "accesses")
+    try:
+        with open(accesses_file) as inf:
+            lines = inf.readlines()
+    except IOError:
+        return
+
+    fd, temp_path = mkstemp(dir=cache_dir)
+    with os.fdopen(fd, "w") as outf:
+        for line in lines:
+            fields = line.split()
+            if not (len(fields) == 3 and fields[2] in checksums):
+                outf.write(line)
+    os.rename(temp_path, accesses_file)
+
+
+# leftovers of interrupted builds older than this are removed when pruning
+STALE_TEMP_DIR_AGE = 24 * 60 * 60
+
+
+def prune(cache_dir=None, max_age=None, max_size=None, compiler=None,
+        dry_run=False):
+    """Remove the entries of the cache in *cache_dir* not used for more than
+    *max_age* seconds, those built by a compiler whose description contains
+    *compiler*, and then the least recently used ones until the cache
+    takes up at most *max_size* bytes, along with their lock files, user
+    keys and access records. Return the list of the removed entries, as
+    :class:`CacheEntry` instances. If *dry_run*, nothing is removed.
+    """
+    import os
+    import shutil
+    from os.path import getmtime, join
+    from time import time
+
+    cache_dir = _get_cache_dir(cache_dir)
+    now = time()
+    accesses = read_accesses(cache_dir)
+
+    def last_used(entry):
+        return max(entry.created, accesses.get(entry.checksum, (0, 0, 0))[2])
+
+    entries = sorted(iter_entries(cache_dir), key=last_used)
+
+    to_remove = [entry for entry in entries
+            if (max_age is not None and now - last_used(entry) > max_age)
+            or (compiler is not None and entry.compiler is not None
+                and compiler in entry.compiler)]
+
+    if max_size is not None:
+        removed = set(entry.checksum for entry in to_remove)
+        size = sum(entry.size for entry in entries
+                if entry.checksum not in removed)
+        for entry in entries:
+            if size <= max_size:
+                break
+            if entry.checksum not in removed:
+                to_remove.append(entry)
+                size -= entry.size
+
+    if dry_run:
+        return to_remove
+
+    for entry in to_remove:
+        remove_entry(entry.checksum, cache_dir)
+
+    removed = set(entry.checksum for entry in to_remove)
+    if removed:
+        _remove_keys(cache_dir, removed)
+        _remove_accesses(cache_dir, removed)
+
+    for shard in os.listdir(cache_dir):
+        if len(shard) != 2:
+            continue
+        for name in os.listdir(join(cache_dir, shard)):
+            path = join(cache_dir, shard, name)
+            try:
+                if (name.startswith("tmp-")
+                        and now - getmtime(path) > STALE_TEMP_DIR_AGE):
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    return to_remove
+
+
+def export_entries(archive, cache_dir=None, checksums=None):
+    """Write the entries *checksums* (by default all) of the cache in
+    *cache_dir* to the :mod:`tarfile` *archive*, compressed according to its
+    extension. Return the number of exported entries.
+    """
+    import tarfile
+
+    mode = "w"
+    for ext, compression in [(".gz", "gz"), (".tgz", "gz"), (".bz2", "bz2"),
+            (".xz", "xz")]:
+        if archive.endswith(ext):
+            mode = "w:" + compression
+
+    count = 0
+    with tarfile.open(archive, mode) as tar:
+        for entry in iter_entries(cache_dir):
+            if checksums is not None and entry.checksum not in checksums:
+                continue
+
+            # published entries are not modified, but may be removed
+            try:
+                tar.add(entry.path, arcname=entry.checksum)
+            except (IOError, OSError) as e:
+                logger.warning("could not export %s: %s" % (entry.checksum, e))
+            else:
+                count += 1
+
+    return count
+
+
+def import_entries(archive, cache_dir=None):
+    """Add the entries in *archive*, written by :func:`export_entries`, to
+    the cache in *cache_dir*, keeping valid entries already there. Return
+    the number of imported entries.
+    """
+    import tarfile
+    from os.path import dirname, join
+    from tempfile import mkdtemp
+    from codepy.jit import (CleanupManager, EntryLockManager, _get_entry_dir,
+            _load_info, _InvalidInfoFile, _publish_entry, _erase_dir)
+
+    cache_dir = _get_cache_dir(cache_dir)
+
+    entries = {}
+    with tarfile.open(archive, "r:*") as tar:
+        for member in tar.getmembers():
+            parts = member.name.split("/")
+            if not _is_checksum(parts[0]) or len(parts) > 2:
+                raise ValueError("unexpected member in archive: %s"
+                        % member.name)
+            if len(parts) == 2:
+                if not member.isfile() or parts[1] in ["", ".", ".."]:
+                    raise ValueError("unexpected member in archive: %s"
+                            % member.name)
+                entries.setdefault(parts[0], []).append(member)
+
+        count = 0
+        for checksum, members in sorted(entries.items()):
+            entry_dir = _get_entry_dir(cache_dir, checksum)
+
+            cleanup_m = CleanupManager()
+            try:
+                # Variable 'lock_m' is used for no other purpose than
+                # to keep lock manager alive.
+                lock_m = EntryLockManager(cleanup_m, entry_dir)  # noqa
+
+                try:
+                    _load_info(join(entry_dir, "info"))
+                    continue
+                except _InvalidInfoFile:
+                    pass
+
+                temp_dir = mkdtemp(prefix="tmp-", dir=dirname(entry_dir))
+                try:
+                    # the info file marks the entry as complete
+                    for member in sorted(members,
+                            key=lambda member: member.name.endswith("/info")):
+                        with open(join(temp_dir, member.name.split("/")[1]),
+                                "wb") as outf:
+                            outf.write(tar.extractfile(member).read())
+
+                    _load_info(join(temp_dir, "info"))
+                except _InvalidInfoFile:
+                    _erase_dir(temp_dir)
+                    logger.warning("not importing invalid entry %s"
+                            % checksum)
+                    continue
+                except Exception:
+                    _erase_dir(temp_dir)
+                    raise
+
+                _publish_entry(temp_dir, entry_dir)
+                count += 1
+            finally:
+                cleanup_m.clean_up()
+
+    return count
+
+
+# {{{ command line interface
+
+def _format_size(size):
+    if size < 1024:
+        return "%d B" % size
+
+    for unit in ["KiB", "MiB", "GiB"]:
+        size /= 1024
+        if size < 1024 or unit == "GiB":
+            return "%.1f %s" % (size, unit)
+
+
+def _format_age(seconds):
+    for unit, length in [("d", 86400), ("h", 3600), ("min", 60)]:
+        if seconds >= length:
+            return "%.1f %s" % (seconds / length, unit)
+    return "%.0f s" % seconds
+
+
+def main():
+    import argparse
+    import sys
+    from time import time
+    from codepy.toolchain import _parse_size
+
+    parser = argparse.ArgumentParser(
+            description="Inspect and maintain the codepy compiler cache.")
+    parser.add_argument("--cache-dir", default=None,
+            help="the cache directory, by default that of codepy.jit")
+    subparsers = parser.add_subparsers(dest="command")
+
+    stats_parser = subparsers.add_parser("stats", help="show statistics")
+    stats_parser.add_argument("--slowest", type=int, default=5,
+            help="number of slowest builds to show")
+
+    list_parser = subparsers.add_parser("list", help="list entries")
+    list_parser.add_argument("--sort", choices=["age", "size", "build-time"],
+            default="age")
+
+    verify_parser = subparsers.add_parser("verify", help="verify entries")
+    verify_parser.add_argument("--remove", action="store_true",
+            help="remove entries with problems")
+
+    prune_parser = subparsers.add_parser("prune", help="remove entries")
+    prune_parser.add_argument("--max-age", type=float, default=None,
+            help="remove entries unused for more days than this")
+    prune_parser.add_argument("--max-size", default=None,
+            help="remove least recently used entries beyond this size, "
+            "e.g. 2G")
+    prune_parser.add_argument("--compiler", default=None,
+            help="remove entries built by compilers whose description "
+            "contains this")
+    prune_parser.add_argument("--dry-run", action="store_true")
+
+    export_parser = subparsers.add_parser("export",
+            help="write entries to an archive")
+    export_parser.add_argument("archive")
+    export_parser.add_argument("checksums", nargs="*")
+
+    import_parser = subparsers.add_parser("import",
+            help="add entries from an archive")
+    import_parser.add_argument("archive")
+
+    args = parser.parse_args()
+    cache_dir = _get_cache_dir(args.cache_dir)
+    now = time()
+
+    if args.command == "stats":
+        stats = get_stats(cache_dir, args.slowest)
+        print("cache directory: %s" % cache_dir)
+        print("entries: %d" % stats["entries"])
+        print("size: %s" % _format_size(stats["bytes"]))
+        accesses = stats["hits"] + stats["misses"]
+        if accesses:
+            print("hit rate: %.1f%% of %d accesses"
+                    % (100 * stats["hits"] / accesses, accesses))
+        else:
+            print("hit rate: not recorded")
+        if stats["slowest"]:
+            print("slowest builds:")
+            for entry in stats["slowest"]:
+                print("  %s  %.2f s  %s" % (
+                    entry.checksum, entry.build_time, entry.compiler))
+
+    elif args.command == "list":
+        key = {
+                "age": lambda entry: -entry.created,
+                "size": lambda entry: entry.size,
+                "build-time": lambda entry: entry.build_time or 0,
+                }[args.sort]
+        for entry in sorted(iter_entries(cache_dir), key=key):
+            build_time = ("%.2f s" % entry.build_time
+                    if entry.build_time is not None else "-")
+            print("%s  %10s  %10s  %8s  %s" % (
+                entry.checksum, _format_age(now - entry.created),
+                _format_size(entry.size), build_time, entry.compiler or ""))
+
+    elif args.command == "verify":
+        status = 0
+        for entry in iter_entries(cache_dir):
+            problems = verify_entry(entry)
+            if problems:
+                status = 1
+                print("%s: %s" % (entry.checksum, "; ".join(problems)))
+                if args.remove:
+                    remove_entry(entry.checksum, cache_dir)
+        sys.exit(status)
+
+    elif args.command == "prune":
+        removed = prune(cache_dir,
+                max_age=(args.max_age * 86400
+                    if args.max_age is not None else None),
+                max_size=(_parse_size(args.max_size)
+                    if args.max_size is not None else None),
+                compiler=args.compiler,
+                dry_run=args.dry_run)
+        for entry in removed:
+            print("%s %s" % ("would remove" if args.dry_run else "removed",
+                entry.checksum))
+        print("%s %d entries, %s" % (
+            "would remove" if args.dry_run else "removed", len(removed),
+            _format_size(sum(entry.size for entry in removed))))
+
+    elif args.command == "export":
+        count = export_entries(args.archive, cache_dir,
+                args.checksums or None)
+        print("exported %d entries to %s" % (count, args.archive))
+
+    elif args.command == "import":
+        count = import_entries(args.archive, cache_dir)
+        print("imported %d entries into %s" % (count, cache_dir))
+
+    else:
+        parser.print_help()
+
+# }}}
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: foldmethod=marker
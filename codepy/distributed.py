@@ -0,0 +1,560 @@
+"""Compilation distributed across build workers.
+
+A :class:`BuildWorker` daemon, started with ``python -m codepy.distributed``
+on each machine contributing to builds, compiles preprocessed sources into
+object files. A :class:`RemoteExecutor`, attached to a toolchain with
+:meth:`codepy.toolchain.Toolchain.with_executor`, preprocesses sources
+locally, has them compiled by the least busy worker and links the results
+locally. Jobs that cannot be built remotely, or whose worker fails, are
+built locally instead.
+
+Workers only run the compilers they are configured with, and only with
+flags of the shapes in :data:`ALLOWED_FLAG_PATTERNS`, but they should still
+only be reachable from trusted machines. Requests also need to carry a
+shared secret, by default taken from the environment variable
+:envvar:`CODEPY_BUILD_TOKEN` on both sides.
+"""
+
+from __future__ import division, print_function
+
+import hmac
+import threading
+
+# Messages consist of a JSON header, which states the size of a binary
+# payload following it, as for the compile server.
+from codepy.server import _send_message, _recv_message
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Compiler flags whose effect depends on the file system or the CPU of the
+# compiling machine, in addition to -march=native and the like, which are
+# replaced by what they stand for on the local machine.
+LOCAL_ONLY_FLAG_PREFIXES = ["-fprofile-", "-ftime-trace"]
+
+# Compiler flags only used for linking, which are dropped when compiling
+# object files remotely.
+LINK_ONLY_FLAG_PREFIXES = ["-L", "-l", "-Wl,"]
+
+# The shapes of the compiler flags workers accept. Sources arrive
+# preprocessed, so neither include directories nor any other flag naming a
+# file is needed. Values must not contain "/", so that they cannot be paths.
+ALLOWED_FLAG_PATTERNS = [
+        r"-O[0-3sgz]?", r"-Ofast",
+        r"-f[a-zA-Z0-9][a-zA-Z0-9+_-]*(=[a-zA-Z0-9+_.,:-]*)?",
+        r"-m[a-zA-Z0-9][a-zA-Z0-9+_.-]*(=[a-zA-Z0-9+_.,:-]*)?",
+        r"-[DU][a-zA-Z_][a-zA-Z0-9_]*(=[^/]*)?",
+        r"-std=[a-z0-9+]+",
+        r"-W[a-zA-Z0-9][a-zA-Z0-9+_-]*(=[a-zA-Z0-9+_.-]*)?",
+        r"--param=[a-zA-Z0-9_-]+=[0-9]+",
+        r"-g[0-3]?", r"-ggdb[0-3]?", r"-w", r"-pedantic", r"-pthread",
+        ]
+
+# Features refused even though they match the patterns above, as they
+# read or write files other than the ones of the request, or load code into
+# the compiler.
+FORBIDDEN_FLAG_PREFIXES = ["-fdump-", "-fopt-info", "-fprofile-",
+        "-fauto-profile", "-fplugin", "-ftime-trace", "-fsave-optimization",
+        "-fcallgraph-info", "-fsanitize-blacklist", "-fsanitize-ignorelist",
+        "-fsanitize-coverage-", "-fcoverage", "-fmodule-mapper", "-mllvm"]
+
+
+def is_flag_allowed(flag):
+    """Return whether build workers accept the compiler flag *flag*."""
+    import re
+    return (any(re.match(pattern + "$", flag)
+                for pattern in ALLOWED_FLAG_PATTERNS)
+            and not flag.startswith(tuple(FORBIDDEN_FLAG_PREFIXES)))
+
+
+def _get_default_token():
+    import os
+    return os.environ.get("CODEPY_BUILD_TOKEN") or None
+
+
+# {{{ worker
+
+class BuildWorker(object):
+    """Compile preprocessed sources sent by :class:`RemoteExecutor` instances,
+    listening on *host* and *port* (an arbitrary free port if 0; see
+    :attr:`address`). Up to *max_jobs* compilers run at a time, by default
+    as many as there are CPUs, and only those named in *compilers*, as found
+    on the worker's :envvar:`PATH`.
+
+    Requests need to carry *token* (by default, :envvar:`CODEPY_BUILD_TOKEN`).
+    Without one, :exc:`ValueError` is raised, unless *insecure* is *True*.
+    """
+
+    def __init__(self, host="localhost", port=0, max_jobs=None,
+            compilers=("gcc", "g++", "cc", "c++", "clang", "clang++"),
+            token=None, insecure=False):
+        import socket
+
+        if token is None:
+            token = _get_default_token()
+        if token is None and not insecure:
+            raise ValueError("build workers need a token, unless insecure "
+                    "is set")
+
+        if max_jobs is None:
+            from multiprocessing import cpu_count
+            max_jobs = cpu_count()
+
+        self.compilers = frozenset(compilers)
+        self.token = token
+        self.job_semaphore = threading.Semaphore(max_jobs)
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(64)
+
+        self.shutdown_requested = threading.Event()
+
+    @property
+    def address(self):
+        """The *(host, port)* the worker listens on."""
+        return self.listener.getsockname()[:2]
+
+    def _find_compiler(self, header):
+        """Return the path of the compiler requested in *header*, or raise
+        :exc:`ValueError`.
+        """
+        import os
+        from codepy.toolchain import _which
+
+        cc = header["cc"]
+        if (not isinstance(cc, str) or os.sep in cc
+                or (os.altsep and os.altsep in cc)
+                or cc not in self.compilers):
+            raise ValueError("compiler not allowed: %s" % cc)
+
+        path = _which(cc)
+        if path is None:
+            raise ValueError("compiler not found: %s" % cc)
+        return path
+
+    def _check_args(self, header):
+        args = header["args"]
+        if not isinstance(args, list) \
+                or not all(isinstance(arg, str) for arg in args):
+            raise ValueError("invalid compiler arguments")
+
+        for arg in args:
+            if not is_flag_allowed(arg):
+                raise ValueError("compiler flag not allowed: %s" % arg)
+
+        if header["suffix"] not in [".i", ".ii"]:
+            raise ValueError("invalid source suffix: %s" % header["suffix"])
+
+    def _compile(self, header, source):
+        import os
+        from os.path import join
+        from tempfile import mkdtemp
+        from pytools.prefork import call_capture_output
+        from codepy.jit import _erase_dir
+
+        try:
+            cc = self._find_compiler(header)
+            self._check_args(header)
+        except ValueError as e:
+            return {"error": str(e)}, b""
+
+        build_dir = mkdtemp()
+        try:
+            source_file = join(build_dir, "source" + header["suffix"])
+            obj_file = join(build_dir, "source.o")
+            with open(source_file, "wb") as outf:
+                outf.write(source)
+
+            # in the build directory, where relative file names stay
+            with self.job_semaphore:
+                result, stdout, stderr = call_capture_output(
+                        [cc] + header["args"]
+                        + ["-c", source_file, "-o", obj_file],
+                        cwd=build_dir, error_on_nonzero=False)
+
+            obj = b""
+            if result == 0:
+                with open(obj_file, "rb") as inf:
+                    obj = inf.read()
+
+            return {
+                    "returncode": result,
+                    "stderr": (stdout + stderr).decode("utf-8", "replace"),
+                    }, obj
+        finally:
+            if os.path.exists(build_dir):
+                _erase_dir(build_dir)
+
+    def _handle_connection(self, conn):
+        try:
+            header, payload = _recv_message(conn)
+
+            if self.token is not None and not hmac.compare_digest(
+                    str(header.get("token")), self.token):
+                _send_message(conn, {"error": "invalid token"})
+            elif header["type"] == "version":
+                from pytools.prefork import call_capture_output
+                try:
+                    cc = self._find_compiler(header)
+                except ValueError as e:
+                    _send_message(conn, {"error": str(e)})
+                else:
+                    result, stdout, stderr = call_capture_output(
+                            [cc, "--version"], error_on_nonzero=False)
+                    _send_message(conn, {
+                        "version": stdout.decode("utf-8", "replace")})
+            elif header["type"] == "compile":
+                _send_message(conn, *self._compile(header, payload))
+            elif header["type"] == "shutdown":
+                self.shutdown_requested.set()
+                _send_message(conn, {})
+            else:
+                _send_message(conn, {"error": "unknown request type"})
+        except Exception:
+            logger.exception("error handling build request")
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        import socket
+
+        self.listener.settimeout(1)
+        try:
+            while not self.shutdown_requested.is_set():
+                try:
+                    conn, _ = self.listener.accept()
+                except socket.timeout:
+                    continue
+
+                conn.settimeout(None)
+                thread = threading.Thread(
+                        target=self._handle_connection, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.listener.close()
+
+
+def spawn_local_workers(count, max_jobs=None, token=None):
+    """Start *count* :class:`BuildWorker` daemons on this machine, as a
+    stand-in for a pool of build machines, and return a tuple
+    *(addresses, processes)*. They require *token* (by default,
+    :envvar:`CODEPY_BUILD_TOKEN`).
+    """
+    import os
+    import sys
+    import subprocess
+    from os.path import dirname, abspath
+
+    # make sure this copy of codepy is found
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+            [dirname(dirname(abspath(__file__)))]
+            + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+
+    cmdline = [sys.executable, "-m", "codepy.distributed", "--port", "0"]
+    if max_jobs is not None:
+        cmdline.extend(["--max-jobs", str(max_jobs)])
+    # passed in the environment, where other users cannot see it
+    if token is not None:
+        env["CODEPY_BUILD_TOKEN"] = token
+
+    addresses = []
+    processes = []
+    for i in range(count):
+        proc = subprocess.Popen(cmdline, env=env, stdout=subprocess.PIPE)
+        host, port = proc.stdout.readline().decode("ascii").split()
+        addresses.append((host, int(port)))
+        processes.append(proc)
+
+    return addresses, processes
+
+# }}}
+
+
+# {{{ executor
+
+class RemoteExecutor(object):
+    """Build object files on the :class:`BuildWorker` daemons at *addresses*,
+    a list of *(host, port)* tuples, for use with
+    :meth:`codepy.toolchain.Toolchain.with_executor`.
+
+    Each job goes to the worker with the fewest jobs in flight. A worker
+    that fails is not used for *retry_after* seconds, and its jobs are
+    built locally. Requests carry *token*, by default
+    :envvar:`CODEPY_BUILD_TOKEN`.
+    """
+
+    def __init__(self, addresses, token=None, timeout=None, retry_after=30):
+        if token is None:
+            token = _get_default_token()
+
+        self.addresses = [tuple(address) for address in addresses]
+        self.token = token
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+        self.lock = threading.Lock()
+        self.in_flight = dict((address, 0) for address in self.addresses)
+        self.failed_at = {}
+        self.versions = {}
+        self.native_flags = {}
+
+        #: The numbers of object files built remotely and locally.
+        self.stats = {"remote": 0, "local": 0}
+
+    def __repr__(self):
+        return "RemoteExecutor(%r)" % (self.addresses,)
+
+    def shutdown_workers(self):
+        """Ask all workers to exit."""
+        for address in self.addresses:
+            try:
+                self._request(address, {"type": "shutdown"})
+            except Exception as e:
+                logger.info("could not shut down build worker %s:%d: %s"
+                        % (address + (e,)))
+
+    # {{{ workers
+
+    def _request(self, address, header, payload=b""):
+        import socket
+
+        header = dict(header)
+        if self.token is not None:
+            header["token"] = self.token
+
+        sock = socket.create_connection(address, timeout=self.timeout)
+        try:
+            _send_message(sock, header, payload)
+            header, payload = _recv_message(sock)
+        finally:
+            sock.close()
+
+        if "error" in header:
+            raise RuntimeError("build worker %s:%d: %s"
+                    % (address + (header["error"],)))
+        return header, payload
+
+    def _acquire_worker(self):
+        from time import time
+
+        with self.lock:
+            now = time()
+            candidates = [address for address in self.addresses
+                    if now - self.failed_at.get(address, -self.retry_after)
+                    >= self.retry_after]
+            if not candidates:
+                return None
+
+            address = min(candidates, key=lambda a: self.in_flight[a])
+            self.in_flight[address] += 1
+            return address
+
+    def _release_worker(self, address, failed=False):
+        from time import time
+
+        with self.lock:
+            self.in_flight[address] -= 1
+            if failed:
+                self.failed_at[address] = time()
+
+    def _get_version(self, address, cc):
+        key = (address, cc)
+        if key not in self.versions:
+            header, _ = self._request(address, {"type": "version", "cc": cc})
+            self.versions[key] = header["version"]
+        return self.versions[key]
+
+    # }}}
+
+    def _get_remote_flags(self, toolchain):
+        """Return the compiler flags of *toolchain* to be used on other
+        machines, or *None* if it needs to be run locally.
+        """
+        from codepy.toolchain import call_capture_output
+
+        flags = [f for f in toolchain.cflags
+                if not f.startswith(tuple(LINK_ONLY_FLAG_PREFIXES))]
+        if any(f.startswith(prefix)
+                for f in flags for prefix in LOCAL_ONLY_FLAG_PREFIXES):
+            return None
+
+        native = [f for f in flags if f.endswith("=native")]
+        if not native:
+            return self._check_remote_flags(flags)
+
+        key = (toolchain.cc, tuple(native))
+        if key not in self.native_flags:
+            import os
+            import shlex
+
+            # gcc shows the flags that -march=native and the like stand for
+            # in the compiler invocations reported by -###.
+            expanded = None
+            result, stdout, stderr = call_capture_output(
+                    [toolchain.cc, "-###", "-E", "-x", "c", os.devnull] + native,
+                    None, False)
+            for line in stderr.split("\n"):
+                args = shlex.split(line)
+                if args and args[0].endswith("cc1"):
+                    expanded = []
+                    for i, arg in enumerate(args):
+                        if arg.startswith("-m") and not arg.endswith("=native"):
+                            expanded.append(arg)
+                        elif arg == "--param" and i + 1 < len(args):
+                            expanded.append("--param=%s" % args[i+1])
+
+            self.native_flags[key] = expanded
+
+        expanded = self.native_flags[key]
+        if expanded is None:
+            return None
+
+        return self._check_remote_flags(
+                [f for f in flags if f not in native] + expanded)
+
+    def _check_remote_flags(self, flags):
+        """Return *flags*, or *None* if workers would refuse them."""
+        refused = [f for f in flags if not is_flag_allowed(f)]
+        if refused:
+            logger.info("building locally, as build workers refuse the "
+                    "flags %s" % " ".join(refused))
+            return None
+        return flags
+
+    def _build_object_remotely(self, toolchain, obj_file, source_file, flags):
+        """Return *True* if *obj_file* was built remotely."""
+        from os.path import splitext
+        from codepy.toolchain import call_capture_output
+
+        address = self._acquire_worker()
+        if address is None:
+            return False
+
+        try:
+            if self._get_version(address, toolchain.cc) != \
+                    toolchain.get_version():
+                logger.info("build worker %s:%d has a different compiler"
+                        % address)
+                self._release_worker(address, failed=True)
+                return False
+
+            cmdline = toolchain._cmdline([source_file], True)
+            cmdline[cmdline.index("-c")] = "-E"
+            result, stdout, stderr = call_capture_output(cmdline, None, False)
+            if result != 0:
+                # reported by the local build
+                self._release_worker(address)
+                return False
+
+            if splitext(source_file)[1] == ".c":
+                suffix = ".i"
+            else:
+                suffix = ".ii"
+
+            header, obj = self._request(address, {
+                    "type": "compile",
+                    "cc": toolchain.cc,
+                    "args": flags,
+                    "suffix": suffix,
+                    }, stdout.encode("utf-8"))
+        except Exception as e:
+            logger.info("build worker %s:%d failed: %s" % (address + (e,)))
+            self._release_worker(address, failed=True)
+            return False
+
+        self._release_worker(address)
+
+        if header["returncode"] != 0:
+            # the local build reports the errors
+            return False
+
+        with open(obj_file, "wb") as outf:
+            outf.write(obj)
+
+        return True
+
+    def build_object(self, toolchain, obj_file, source_files, debug=False):
+        """Build *obj_file* from *source_files* as
+        :meth:`codepy.toolchain.Toolchain.build_object` would.
+        """
+        from codepy.toolchain import GCCToolchain
+
+        flags = None
+        if isinstance(toolchain, GCCToolchain) and len(source_files) == 1:
+            flags = self._get_remote_flags(toolchain)
+
+        if flags is not None and self._build_object_remotely(
+                toolchain, obj_file, source_files[0], flags):
+            kind = "remote"
+        else:
+            toolchain.copy(executor=None).build_object(
+                    obj_file, source_files, debug=debug)
+            kind = "local"
+
+        with self.lock:
+            self.stats[kind] += 1
+
+    def build_extension(self, toolchain, ext_file, source_files, debug=False):
+        """Build *ext_file* from *source_files* as
+        :meth:`codepy.toolchain.Toolchain.build_extension` would, compiling
+        the sources in parallel and linking them locally.
+        """
+        from os.path import basename, join, splitext
+        from tempfile import mkdtemp
+        from concurrent.futures import ThreadPoolExecutor
+        from codepy.jit import _erase_dir
+
+        obj_dir = mkdtemp()
+        try:
+            obj_files = [
+                    join(obj_dir, "%d-%s%s" % (
+                        i, splitext(basename(source))[0], toolchain.o_ext))
+                    for i, source in enumerate(source_files)]
+
+            executor = ThreadPoolExecutor(max_workers=len(source_files))
+            try:
+                futures = [
+                        executor.submit(self.build_object, toolchain,
+                            obj_file, [source], debug)
+                        for obj_file, source in zip(obj_files, source_files)]
+                for future in futures:
+                    future.result()
+            finally:
+                executor.shutdown()
+
+            toolchain.copy(executor=None).link_extension(
+                    ext_file, obj_files, debug=debug)
+        finally:
+            _erase_dir(obj_dir)
+
+# }}}
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a codepy build worker.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--max-jobs", type=int, default=None)
+    parser.add_argument("--insecure", action="store_true",
+            help="accept requests without a token, if CODEPY_BUILD_TOKEN "
+            "is not set")
+    args = parser.parse_args()
+
+    worker = BuildWorker(args.host, args.port, args.max_jobs,
+            insecure=args.insecure)
+    print("%s %d" % worker.address)
+    import sys
+    sys.stdout.flush()
+    worker.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: foldmethod=marker
@@ -15,8 +15,14 @@ from cgen import POD, Value, dtype_to_ctype
 
 
 class Argument:
+    """An argument named *name* of type *dtype*. If *dtype* is *None*,
+    :class:`ElementwiseKernel` determines it from the value passed.
+    """
+
     def __init__(self, dtype, name):
-        self.dtype = numpy.dtype(dtype)
+        if dtype is not None:
+            dtype = numpy.dtype(dtype)
+        self.dtype = dtype
         self.name = name
 
     def __repr__(self):
@@ -49,7 +55,69 @@ class ScalarArg(Argument):
 
 
 
-def get_elwise_module_descriptor(arguments, operation, name="kernel"):
+def _get_arg_initializers(arguments):
+    from cgen import Initializer
+
+    return ([
+        Initializer(
+            Value("numpy_array<%s >::iterator"
+                % dtype_to_ctype(varg.dtype),
+                varg.name),
+            "args.%s_ary.begin()" % varg.name)
+        for varg in arguments if isinstance(varg, VectorArg)]
+        + [Initializer(
+            sarg.declarator(), "args." + sarg.name)
+        for sarg in arguments if isinstance(sarg, ScalarArg)])
+
+
+def _with_openmp(toolchain):
+    return toolchain.copy(
+            cflags=toolchain.cflags + ["-fopenmp"],
+            ldflags=toolchain.ldflags + ["-fopenmp"])
+
+
+def _get_kernel_toolchain(toolchain, parallel):
+    """Return a copy of *toolchain* (by default, the guessed one) set up for
+    building the PyUblas-based kernels of this module.
+    """
+    if toolchain is None:
+        from codepy.toolchain import guess_toolchain
+        toolchain = guess_toolchain()
+
+    from codepy.libraries import add_pyublas
+    toolchain = toolchain.copy()
+    add_pyublas(toolchain)
+
+    if parallel:
+        toolchain = _with_openmp(toolchain)
+
+    return toolchain
+
+
+
+
+def get_elwise_module_descriptor(arguments, operation, name="kernel",
+        release_gil=False, parallel=False, batched=False):
+    """Return a :class:`codepy.bpl.BoostPythonModule` exposing functions
+    applying *operation* to each index ``i`` of the vector *arguments*:
+
+    * *name* runs over ``codepy_length`` elements.
+    * *name* ``_range`` runs over the elements from ``codepy_start`` up to
+      ``codepy_stop``, so that ``i`` is the index into the whole vector
+      arguments.
+    * If *batched* is *True*, *name* ``_batched`` takes a list of argument
+      structs and an array of lengths, and performs one launch for each of
+      them.
+    * If *batched* is *True*, *name* ``_ragged`` takes an array of offsets
+      into the vector arguments, and performs one launch for the elements
+      between each pair of consecutive offsets.
+
+    The index of the launch is available to *operation* as
+    ``codepy_launch``, which is always zero for *name*. If *parallel* is
+    *True*, the elements of single launches and the launches of batches are
+    spread over OpenMP threads.
+    """
+
     from codepy.bpl import BoostPythonModule
 
     from cgen import FunctionBody, FunctionDeclaration, \
@@ -59,9 +127,9 @@ def get_elwise_module_descriptor(arguments, operation, name="kernel"):
     S = Statement
 
     mod = BoostPythonModule()
-    mod.add_to_preamble([
-        Include("pyublas/numpy.hpp"),
-        ])
+    mod.add_to_preamble([Include("pyublas/numpy.hpp")])
+    if batched:
+        mod.add_to_preamble([Include("vector")])
 
     mod.add_to_module([
         S("namespace ublas = boost::numeric::ublas"),
@@ -69,22 +137,17 @@ def get_elwise_module_descriptor(arguments, operation, name="kernel"):
         Line(),
         ])
 
-    body = Block([
-        Initializer(
-            Value("numpy_array<%s >::iterator"
-                % dtype_to_ctype(varg.dtype),
-                varg.name),
-            "args.%s_ary.begin()" % varg.name)
-        for varg in arguments if isinstance(varg, VectorArg)]
-        +[Initializer(
-            sarg.declarator(), "args." + sarg.name)
-        for sarg in arguments if isinstance(sarg, ScalarArg)]
-        )
+    omp_pragma = ([Line("#pragma omp parallel for schedule(static)")]
+            if parallel else [])
+
+    body = Block(_get_arg_initializers(arguments))
 
     body.extend([
+        Initializer(Value("long const", "codepy_launch"), 0),
         Line(),
-        For("unsigned i = 0",
-            "i < codepy_length",
+        ] + omp_pragma + [
+        For("npy_uintp i = codepy_start",
+            "i < codepy_stop",
             "++i",
             Block([S(operation)])
             )
@@ -93,7 +156,18 @@ def get_elwise_module_descriptor(arguments, operation, name="kernel"):
     arg_struct = Struct("arg_struct", 
             [arg.declarator() for arg in arguments])
     mod.add_struct(arg_struct, "ArgStruct")
-    mod.add_to_module([Line()])
+    mod.add_to_module([
+        Line(),
+        # shared by the entry points, so that *operation* is compiled once
+        FunctionBody(
+            FunctionDeclaration(
+                Value("void", "codepy_run_range"),
+                [POD(numpy.uintp, "codepy_start"),
+                    POD(numpy.uintp, "codepy_stop"),
+                    Value("arg_struct &", "args")]),
+            body),
+        Line(),
+        ])
 
     mod.add_function(
             FunctionBody(
@@ -101,42 +175,195 @@ def get_elwise_module_descriptor(arguments, operation, name="kernel"):
                     Value("void", name),
                     [POD(numpy.uintp, "codepy_length"),
                         Value("arg_struct", "args")]),
-                body))
+                Block([S("codepy_run_range(0, codepy_length, args)")])),
+            release_gil=release_gil)
+    mod.add_function(
+            FunctionBody(
+                FunctionDeclaration(
+                    Value("void", name + "_range"),
+                    [POD(numpy.uintp, "codepy_start"),
+                        POD(numpy.uintp, "codepy_stop"),
+                        Value("arg_struct", "args")]),
+                Block([S("codepy_run_range(codepy_start, codepy_stop, args)")])),
+            release_gil=release_gil)
+
+    # {{{ batched launches
+
+    if batched:
+        if release_gil:
+            mod.add_gil_release_guard()
+            gil_release = [S("codepy_scoped_gil_release codepy_gil_release")]
+        else:
+            gil_release = []
+
+        launch_loop = For("long codepy_launch = 0",
+                "codepy_launch < (long) codepy_launch_count",
+                "++codepy_launch",
+                Block([
+                    Initializer(Value("arg_struct &", "args"),
+                        "codepy_args[codepy_launch]"),
+                    Initializer(POD(numpy.uintp, "codepy_length"),
+                        "codepy_lengths[codepy_launch]"),
+                    ]
+                    + _get_arg_initializers(arguments)
+                    + [Line(),
+                        For("npy_uintp i = 0",
+                            "i < codepy_length",
+                            "++i",
+                            Block([S(operation)]))]))
+
+        mod.add_function(
+                FunctionBody(
+                    FunctionDeclaration(
+                        Value("void", name + "_batched"),
+                        [Value("boost::python::object", "arg_structs"),
+                            Value("numpy_array<%s >" % dtype_to_ctype(numpy.uintp),
+                                "lengths_ary")]),
+                    Block([
+                        Initializer(POD(numpy.uintp, "codepy_launch_count"),
+                            "lengths_ary.size()"),
+                        Initializer(
+                            Value("numpy_array<%s >::iterator"
+                                % dtype_to_ctype(numpy.uintp), "codepy_lengths"),
+                            "lengths_ary.begin()"),
+                        Line(),
+                        # copy the argument structs while holding the GIL
+                        Value("std::vector<arg_struct>", "codepy_args"),
+                        S("codepy_args.reserve(codepy_launch_count)"),
+                        For("npy_uintp codepy_launch = 0",
+                            "codepy_launch < codepy_launch_count",
+                            "++codepy_launch",
+                            S("codepy_args.push_back("
+                                "boost::python::extract<arg_struct const &>("
+                                "arg_structs[codepy_launch]))")),
+                        Line(),
+                        Block(gil_release + omp_pragma + [launch_loop]),
+                        ])))
+
+        ragged_body = Block(_get_arg_initializers(arguments))
+        ragged_body.extend([
+            Initializer(
+                Value("numpy_array<%s >::iterator"
+                    % dtype_to_ctype(numpy.uintp), "codepy_offsets"),
+                "offsets_ary.begin()"),
+            Initializer(POD(numpy.uintp, "codepy_launch_count"),
+                "offsets_ary.size() - 1"),
+            Line(),
+            ] + omp_pragma + [
+                For("long codepy_launch = 0",
+                    "codepy_launch < (long) codepy_launch_count",
+                    "++codepy_launch",
+                    For("npy_uintp i = codepy_offsets[codepy_launch]",
+                        "i < codepy_offsets[codepy_launch+1]",
+                        "++i",
+                        Block([S(operation)]))),
+                ])
+
+        mod.add_function(
+                FunctionBody(
+                    FunctionDeclaration(
+                        Value("void", name + "_ragged"),
+                        [Value("numpy_array<%s >" % dtype_to_ctype(numpy.uintp),
+                            "offsets_ary"),
+                            Value("arg_struct", "args")]),
+                    ragged_body),
+                release_gil=release_gil)
+
+    # }}}
 
     return mod
 
 
 
-def get_elwise_module_binary(arguments, operation, name="kernel", toolchain=None):
-    if toolchain is None:
-        from codepy.toolchain import guess_toolchain
-        toolchain = guess_toolchain()
+def get_elwise_module_binary(arguments, operation, name="kernel", toolchain=None,
+        release_gil=False, parallel=False, batched=False):
+    toolchain = _get_kernel_toolchain(toolchain, parallel)
 
-    toolchain = toolchain.copy()
+    return get_elwise_module_descriptor(arguments, operation, name,
+            release_gil=release_gil, parallel=parallel,
+            batched=batched).compile(toolchain)
 
-    from codepy.libraries import add_pyublas
-    toolchain = toolchain.copy()
-    add_pyublas(toolchain)
 
-    return get_elwise_module_descriptor(arguments, operation, name) \
-            .compile(toolchain)
 
 
+def get_elwise_kernel(arguments, operation, name="kernel", toolchain=None,
+        release_gil=False, parallel=False, batched=False):
+    return getattr(get_elwise_module_binary(
+        arguments, operation, name, toolchain, release_gil, parallel,
+        batched), name)
 
 
-def get_elwise_kernel(arguments, operation, name="kernel", toolchain=None):
-    return getattr(get_elwise_module_binary(
-        arguments, operation, name, toolchain), name)
+
+
+_lazy_compilation = False
+_background_executor = None
+
+
+def set_compilation_mode(lazy=False, background=False, max_workers=None):
+    """Set how :class:`ElementwiseKernel` instances constructed from now on
+    with *lazy* left at *None* are compiled.
+
+    If *lazy* is *True*, kernels are compiled when they are first used. If
+    *background* is *True*, which implies *lazy*, compilation of each kernel
+    also starts in a pool of *max_workers* threads as soon as the kernel is
+    constructed, so that most kernels are ready before their first use.
+    Errors are reported when the kernel is first used.
+
+    Compiles already started in the background by a previous call are
+    waited for, so that the kernels that submitted them remain usable.
+    """
+    global _lazy_compilation, _background_executor
+
+    if _background_executor is not None:
+        _background_executor.shutdown(wait=True)
+        _background_executor = None
+
+    if background:
+        from concurrent.futures import ThreadPoolExecutor
+        if max_workers is None:
+            import multiprocessing
+            max_workers = multiprocessing.cpu_count()
+        _background_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    _lazy_compilation = lazy or background
 
 
 
 
 class ElementwiseKernel:
-    def __init__(self, arguments, operation, name="kernel", toolchain=None):
+    """A kernel applying *operation* to each index ``i`` of its vector
+    arguments.
+
+    If *release_gil* is *True*, the global interpreter lock is released
+    while the loop runs, so that kernels invoked from different Python
+    threads can execute concurrently. *operation* must then not touch any
+    Python objects.
+
+    If *parallel* is *True*, elements and batched launches are spread over
+    OpenMP threads, see :func:`get_elwise_module_descriptor`.
+
+    :meth:`call_batched` and :meth:`call_ragged` are only available if
+    *batched* is *True*.
+
+    If *lazy* is *True*, compilation is deferred until the kernel is first
+    used. If it is *None*, the setting made by :func:`set_compilation_mode`
+    applies, which may also start compilation in the background.
+
+    Arguments whose dtype is *None* make the kernel generic. Such a kernel
+    is compiled separately for each combination of argument dtypes it is
+    called with, on the first call with that combination, and kept in
+    :attr:`specializations`, keyed by the tuple of argument dtypes.
+    """
+
+    def __init__(self, arguments, operation, name="kernel", toolchain=None,
+            release_gil=False, parallel=False, lazy=None, batched=False):
         self.arguments = arguments
-        self.module = get_elwise_module_binary(
-                arguments, operation, name, toolchain)
-        self.func = getattr(self.module, name)
+        self.operation = operation
+        self.name = name
+        self.toolchain = toolchain
+        self.release_gil = release_gil
+        self.parallel = parallel
+        self.batched = batched
 
         self.vec_arg_indices = [i for i, arg in enumerate(arguments)
                 if isinstance(arg, VectorArg)]
@@ -145,8 +372,125 @@ class ElementwiseKernel:
                 "ElementwiseKernel can only be used with functions that have at least one " \
                 "vector argument"
 
-    def __call__(self, *args):
-        vectors = []
+        self.generic_arg_indices = [i for i, arg in enumerate(arguments)
+                if arg.dtype is None]
+
+        # maps tuples of argument dtypes to _ElementwiseSpecialization
+        self.specializations = {}
+        # maps tuples of argument dtypes to futures of background compiles
+        self._pending = {}
+        self._spec = None
+
+        if lazy is None:
+            lazy = _lazy_compilation
+
+        if not self.generic_arg_indices:
+            dtypes = tuple(arg.dtype for arg in arguments)
+            if not lazy:
+                self._spec = self._get_specialization(dtypes)
+            elif _background_executor is not None:
+                self._pending[dtypes] = _background_executor.submit(
+                        self._compile_specialization, dtypes, prefetch=True)
+
+    def _get_default_specialization(self):
+        if self._spec is None:
+            if self.generic_arg_indices:
+                raise AttributeError("generic kernels have no "
+                        "default specialization")
+            self._spec = self._get_specialization(
+                    tuple(arg.dtype for arg in self.arguments))
+        return self._spec
+
+    @property
+    def module(self):
+        return self._get_default_specialization().module
+
+    @property
+    def func(self):
+        return self._get_default_specialization().func
+
+    @property
+    def range_func(self):
+        return self._get_default_specialization().range_func
+
+    @property
+    def batched_func(self):
+        return self._get_default_specialization().batched_func
+
+    @property
+    def ragged_func(self):
+        return self._get_default_specialization().ragged_func
+
+    def _get_specialization(self, dtypes):
+        try:
+            return self.specializations[dtypes]
+        except KeyError:
+            pass
+
+        future = self._pending.get(dtypes)
+        if future is not None:
+            return future.result()
+
+        return self._compile_specialization(dtypes)
+
+    def _compile_specialization(self, dtypes, prefetch=False):
+        from codepy.server import (compile_priority,
+                PRIORITY_INTERACTIVE, PRIORITY_PREFETCH)
+
+        arguments = [type(arg)(dtype, arg.name)
+                for arg, dtype in zip(self.arguments, dtypes)]
+        with compile_priority(
+                PRIORITY_PREFETCH if prefetch else PRIORITY_INTERACTIVE):
+            module = get_elwise_module_binary(
+                    arguments, self.operation, self.name, self.toolchain,
+                    self.release_gil, self.parallel, self.batched)
+        spec = _ElementwiseSpecialization(arguments, module, self.name)
+        self.specializations[dtypes] = spec
+        return spec
+
+    def _get_arg_dtypes(self, args):
+        """Return the tuple of argument dtypes to use for *args*. Arguments
+        whose dtype is not given take the dtype of the corresponding value.
+        Python scalars and the zero placeholders for vectors take part in
+        type promotion with the given vectors.
+        """
+        dtypes = [arg.dtype for arg in self.arguments]
+        promoted = []
+        for i in self.generic_arg_indices:
+            dtype = getattr(args[i], "dtype", None)
+            if dtype is None:
+                promoted.append(i)
+            else:
+                dtypes[i] = dtype
+
+        if promoted:
+            vector_dtypes = [
+                    dtypes[i] for i in self.vec_arg_indices
+                    if dtypes[i] is not None and i not in promoted]
+
+            placeholders = [self.arguments[i].name
+                    for i in promoted if i in self.vec_arg_indices]
+            if placeholders and not vector_dtypes:
+                raise ValueError("cannot determine the dtype of the vector "
+                        "arguments %s, as no vector argument has a dtype"
+                        % ", ".join(placeholders))
+
+            for i in promoted:
+                if i in self.vec_arg_indices:
+                    dtypes[i] = numpy.result_type(*vector_dtypes)
+                else:
+                    dtypes[i] = numpy.result_type(*(vector_dtypes + [args[i]]))
+
+        return tuple(dtypes)
+
+    def _make_arg_struct(self, args):
+        spec = self._spec
+        if spec is None:
+            if self.generic_arg_indices:
+                spec = self._get_specialization(self._get_arg_dtypes(args))
+            else:
+                spec = self._get_default_specialization()
+
         args = list(args)
 
         from pytools import single_valued
@@ -154,16 +498,835 @@ class ElementwiseKernel:
                 if not (isinstance(args[i], (int, float)) and args[i] == 0))
         for i in self.vec_arg_indices:
             if isinstance(args[i], (int, float)) and args[i] == 0:
-                args[i] = numpy.zeros(size, dtype=self.arguments[i].dtype)
+                args[i] = numpy.zeros(size, dtype=spec.arguments[i].dtype)
 
         # no need to do type checking--pyublas does that for us
+        arg_struct = spec.module.ArgStruct()
+        for arg_descr, arg in zip(spec.arguments, args):
+            setattr(arg_struct, arg_descr.arg_name(), arg)
+
+        assert not arg_struct.__dict__
+
+        return spec, size, arg_struct
+
+    def __call__(self, *args):
+        spec, size, arg_struct = self._make_arg_struct(args)
+        spec.func(size, arg_struct)
+
+    def _check_batched(self):
+        if not self.batched:
+            raise ValueError("batched launches need a kernel constructed "
+                    "with batched=True")
+
+    def call_batched(self, arg_tuples):
+        """Launch the kernel once for each tuple of arguments in the sequence
+        *arg_tuples*, all within a single native call. All launches must
+        use the same argument dtypes.
+        """
+        self._check_batched()
+
+        specs = []
+        sizes = []
+        arg_structs = []
+        for args in arg_tuples:
+            spec, size, arg_struct = self._make_arg_struct(args)
+            specs.append(spec)
+            sizes.append(size)
+            arg_structs.append(arg_struct)
+
+        if not specs:
+            return
+
+        from pytools import single_valued
+        single_valued(specs).batched_func(
+                arg_structs, numpy.array(sizes, dtype=numpy.uintp))
+
+    def call_ragged(self, offsets, *args):
+        """Launch the kernel once for each range of elements between two
+        consecutive entries of *offsets*, all within a single native call.
+        The vector arguments hold the concatenated data of all launches, and
+        *operation* may refer to the index of the launch as
+        ``codepy_launch``.
+        """
+        self._check_batched()
+
+        offsets = numpy.asarray(offsets, dtype=numpy.uintp)
+        spec, size, arg_struct = self._make_arg_struct(args)
+
+        if len(offsets) == 0:
+            return
+        if offsets[-1] > size or (offsets[1:] < offsets[:-1]).any():
+            raise ValueError("offsets must be non-decreasing and within "
+                    "the vector arguments")
+
+        spec.ragged_func(offsets, arg_struct)
+
+    def call_chunked(self, *args, **kwargs):
+        """Like :meth:`__call__`, but walk the vector arguments in chunks of
+        about *chunk_bytes* (keyword argument, default 4 MiB) summed over all
+        vector arguments, so that the memory touched at any one time is
+        bounded regardless of the size of the arguments. This is intended
+        for :class:`numpy.memmap` arguments larger than main memory. The
+        index ``i`` seen by *operation* is still the index into the whole
+        vector arguments.
+
+        Memory-mapped arguments are advised to be read sequentially, and
+        pages of chunks that are done are released, unless the mapping is
+        copy-on-write. If the keyword argument *prefetch* is *True*, the
+        operating system is asked to start reading the next chunk while the
+        current one is being processed.
+        """
+        chunk_bytes = kwargs.pop("chunk_bytes", 1 << 22)
+        prefetch = kwargs.pop("prefetch", False)
+        if kwargs:
+            raise TypeError("unexpected keyword arguments: %s"
+                    % ", ".join(kwargs))
+
+        args = list(args)
+
+        def is_placeholder(arg):
+            return isinstance(arg, (int, float)) and arg == 0
+
+        vec_indices = [i for i in self.vec_arg_indices
+                if not is_placeholder(args[i])]
+
+        for i in vec_indices:
+            if not args[i].flags.c_contiguous:
+                raise ValueError("argument '%s' is not contiguous"
+                        % self.arguments[i].name)
+            args[i] = args[i].reshape(-1)
+
+        from pytools import single_valued
+        size = single_valued(args[i].size for i in vec_indices)
+
+        # keep chunk boundaries on page boundaries (for page-aligned arrays)
+        chunk_size = chunk_bytes // sum(args[i].itemsize for i in vec_indices)
+        chunk_size = max(4096, chunk_size - chunk_size % 4096)
+
+        mappings = [(args[i], _MappedRegion.from_array(args[i]))
+                for i in vec_indices]
+        mappings = [(ary, region) for ary, region in mappings
+                if region is not None]
+
+        # the whole arguments are passed, so that the index is not
+        # relative to the chunk
+        spec, _, arg_struct = self._make_arg_struct(args)
+
+        import mmap
+        for ary, region in mappings:
+            region.advise(ary, 0, size, mmap.MADV_SEQUENTIAL)
+
+        for start in range(0, size, chunk_size):
+            stop = min(start + chunk_size, size)
+
+            if prefetch and stop < size:
+                for ary, region in mappings:
+                    region.advise(ary, stop, min(stop + chunk_size, size),
+                            mmap.MADV_WILLNEED)
+
+            spec.range_func(start, stop, arg_struct)
+
+            for ary, region in mappings:
+                if region.may_discard:
+                    region.advise(ary, start, stop, mmap.MADV_DONTNEED)
+
+
+
+
+class _ElementwiseSpecialization(object):
+    def __init__(self, arguments, module, name):
+        self.arguments = arguments
+        self.module = module
+        self.func = getattr(module, name)
+        self.range_func = getattr(module, name + "_range")
+        self.batched_func = getattr(module, name + "_batched", None)
+        self.ragged_func = getattr(module, name + "_ragged", None)
+
+
+
+
+class _MappedRegion(object):
+    """The memory map underlying a :class:`numpy.ndarray`, for the purpose of
+    giving advice on its paging behavior.
+    """
+
+    def __init__(self, mapping, may_discard):
+        self.mapping = mapping
+        self.address = numpy.frombuffer(mapping, dtype=numpy.uint8).ctypes.data
+        self.may_discard = may_discard
+
+    @classmethod
+    def from_array(cls, ary):
+        import mmap
+        if not hasattr(mmap.mmap, "madvise"):
+            return None
+
+        # copy-on-write mappings would lose their modifications
+        may_discard = getattr(ary, "mode", None) in ("r", "r+", "w+")
+
+        base = ary
+        while base is not None and not isinstance(base, mmap.mmap):
+            base = getattr(base, "base", None)
+
+        if base is None or base.closed:
+            return None
+
+        return cls(base, may_discard)
+
+    def advise(self, ary, start, stop, advice):
+        """Give *advice* on elements *start* through *stop* of *ary*."""
+        if stop <= start:
+            return
+
+        import mmap
+        begin = ary.ctypes.data + start*ary.itemsize - self.address
+        end = ary.ctypes.data + stop*ary.itemsize - self.address
+
+        # madvise needs page-aligned starting addresses, and applies to
+        # whole pages
+        begin -= begin % mmap.PAGESIZE
+        end = min(end + -end % mmap.PAGESIZE, len(self.mapping))
+        self.mapping.madvise(advice, begin, end - begin)
+
+
+
+
+def get_elwise_ufunc_module_descriptor(arguments, operation, name="kernel",
+        nout=1, dtype_signatures=None):
+    """Return a :class:`cgen.Module` for a Python extension module that
+    defines a :class:`numpy.ufunc` named *name*, applying *operation* to each
+    element.
+
+    All *arguments* become operands of the ufunc, the last *nout* of which
+    are its outputs and must be :class:`VectorArg` instances. A
+    :class:`ScalarArg` is an input operand that is broadcast against the
+    others and referred to by its name, as in :class:`ElementwiseKernel`.
+
+    One inner loop is generated for each entry of *dtype_signatures*, a
+    sequence of tuples holding one dtype per argument. If it is not given,
+    the dtypes of *arguments* form the only signature.
+
+    Since the inner loops may also be called on strided data, *operation*
+    may use the index ``i`` only to subscript vector arguments.
+    """
+
+    from cgen import FunctionBody, FunctionDeclaration, \
+            Value, POD, Pointer, Const, For, If, Initializer, Include, \
+            Statement, Line, Block, Define, Module
+
+    S = Statement
+
+    if dtype_signatures is None:
+        dtype_signatures = [tuple(arg.dtype for arg in arguments)]
+
+    dtype_signatures = [
+            tuple(numpy.dtype(dtype) for dtype in signature)
+            for signature in dtype_signatures]
+
+    for signature in dtype_signatures:
+        if len(signature) != len(arguments):
+            raise ValueError("dtype signature %s does not match the "
+                    "number of arguments" % (signature,))
+
+    if not 0 < nout < len(arguments):
+        raise ValueError("invalid number of outputs: %d" % nout)
+
+    for arg in arguments[-nout:]:
+        if not isinstance(arg, VectorArg):
+            raise ValueError("ufunc output '%s' must be a VectorArg" % arg.name)
+
+    def make_loop(loop_name, signature):
+        vec_indices = [k for k, arg in enumerate(arguments)
+                if isinstance(arg, VectorArg)]
+        scalar_indices = [k for k, arg in enumerate(arguments)
+                if isinstance(arg, ScalarArg)]
+
+        is_contiguous = " && ".join(
+                ["steps[%d] == %d" % (k, signature[k].itemsize)
+                    for k in vec_indices]
+                + ["steps[%d] == 0" % k for k in scalar_indices])
+
+        def scalar_initializer(k, offset):
+            ctype = dtype_to_ctype(signature[k])
+            return Initializer(
+                    POD(signature[k], arguments[k].name),
+                    "*(%s const *) (args[%d]%s)" % (ctype, k, offset))
+
+        # All vector arguments advance with unit stride, so let 'i' run
+        # over the whole inner loop for the benefit of the vectorizer.
+        contiguous_loop = Block(
+                [Initializer(
+                    Pointer(POD(signature[k], arguments[k].name)),
+                    "(%s *) args[%d]" % (dtype_to_ctype(signature[k]), k))
+                    for k in vec_indices]
+                + [scalar_initializer(k, "") for k in scalar_indices]
+                + [For("npy_intp i = 0", "i < n", "++i",
+                    Block([S(operation)]))])
+
+        # Otherwise, point each vector argument at its current element.
+        strided_loop = Block([
+            For("npy_intp codepy_j = 0", "codepy_j < n", "++codepy_j",
+                Block(
+                    [Initializer(
+                        Pointer(POD(signature[k], arguments[k].name)),
+                        "(%s *) (args[%d] + codepy_j*steps[%d])" % (
+                            dtype_to_ctype(signature[k]), k, k))
+                        for k in vec_indices]
+                    + [scalar_initializer(k, " + codepy_j*steps[%d]" % k)
+                        for k in scalar_indices]
+                    + [Initializer(Const(POD(numpy.intp, "i")), "0"),
+                        S("(void) i"),
+                        S(operation)]))])
+
+        return FunctionBody(
+                FunctionDeclaration(
+                    Value("static void", loop_name),
+                    [Pointer(Pointer(Value("char", "args"))),
+                        Pointer(Const(POD(numpy.intp, "dimensions"))),
+                        Pointer(Const(POD(numpy.intp, "steps"))),
+                        Pointer(Value("void", "data"))]),
+                Block([
+                    Initializer(Const(POD(numpy.intp, "n")), "dimensions[0]"),
+                    Line(),
+                    If(is_contiguous, contiguous_loop, strided_loop),
+                    ]))
+
+    loop_names = ["codepy_loop_%d" % k for k in range(len(dtype_signatures))]
+
+    body = [
+            Define("NPY_NO_DEPRECATED_API", "NPY_1_7_API_VERSION"),
+            Include("Python.h"),
+            Include("numpy/arrayobject.h"),
+            Include("numpy/ufuncobject.h"),
+            Line(),
+            ]
+
+    for loop_name, signature in zip(loop_names, dtype_signatures):
+        body.extend([make_loop(loop_name, signature), Line()])
+
+    body.extend([
+        Initializer(
+            Value("static PyUFuncGenericFunction", "codepy_funcs[]"),
+            "{%s}" % ", ".join(
+                "(PyUFuncGenericFunction) &%s" % loop_name
+                for loop_name in loop_names)),
+        Initializer(
+            Value("static void *", "codepy_data[]"),
+            "{%s}" % ", ".join("NULL" for loop_name in loop_names)),
+        Initializer(
+            Value("static char", "codepy_types[]"),
+            "{%s}" % ", ".join(
+                str(dtype.num)
+                for signature in dtype_signatures
+                for dtype in signature)),
+        Initializer(
+            Value("static PyMethodDef", "codepy_methods[]"),
+            "{{NULL, NULL, 0, NULL}}"),
+        Line(),
+        Line("#if PY_MAJOR_VERSION >= 3"),
+        Initializer(
+            Value("static struct PyModuleDef", "codepy_module_def"),
+            "{PyModuleDef_HEAD_INIT, \"module\", NULL, -1, codepy_methods}"),
+        Line(),
+        Line("PyMODINIT_FUNC PyInit_module(void)"),
+        Line("#else"),
+        Line("PyMODINIT_FUNC initmodule(void)"),
+        Line("#endif"),
+        Block([
+            S("import_array()"),
+            S("import_umath()"),
+            Line(),
+            Line("#if PY_MAJOR_VERSION >= 3"),
+            Initializer(Pointer(Value("PyObject", "mod")),
+                "PyModule_Create(&codepy_module_def)"),
+            Line("#else"),
+            Initializer(Pointer(Value("PyObject", "mod")),
+                "Py_InitModule(\"module\", codepy_methods)"),
+            Line("#endif"),
+            Line(),
+            Initializer(Pointer(Value("PyObject", "ufunc")),
+                "PyUFunc_FromFuncAndData(codepy_funcs, codepy_data, "
+                "codepy_types, %d, %d, %d, PyUFunc_None, \"%s\", NULL, 0)" % (
+                    len(dtype_signatures), len(arguments) - nout, nout,
+                    name)),
+            S("PyModule_AddObject(mod, \"%s\", ufunc)" % name),
+            Line(),
+            Line("#if PY_MAJOR_VERSION >= 3"),
+            S("return mod"),
+            Line("#endif"),
+            ]),
+        ])
+
+    return Module(body)
+
+
+
+
+def get_elwise_ufunc(arguments, operation, name="kernel", nout=1,
+        dtype_signatures=None, toolchain=None):
+    """Return a :class:`numpy.ufunc` applying *operation* to each element, as
+    described in :func:`get_elwise_ufunc_module_descriptor`.
+
+    Unlike :class:`ElementwiseKernel`, the resulting ufunc is driven by
+    numpy's iterator, which takes care of broadcasting, non-contiguous
+    arrays, ``out=`` arguments, dtype dispatch and buffering. Numpy
+    releases the global interpreter lock while the inner loops run.
+    """
+
+    if toolchain is None:
+        from codepy.toolchain import guess_toolchain
+        toolchain = guess_toolchain()
+
+    from codepy.libraries import add_numpy
+    toolchain = toolchain.copy()
+    add_numpy(toolchain)
+
+    from codepy.jit import extension_from_string
+    module = extension_from_string(toolchain, "module",
+            str(get_elwise_ufunc_module_descriptor(
+                arguments, operation, name, nout, dtype_signatures))+"\n")
+
+    return getattr(module, name)
+
+
+
+
+def get_reduction_module_descriptor(dtype_out, neutral, reduce_expr, map_expr,
+        arguments, name="reduce_kernel", parallel=False, block_size=128,
+        release_gil=False):
+    """Return a :class:`codepy.bpl.BoostPythonModule` exposing a function
+    *name* that reduces *map_expr*, evaluated at each index ``i``, using
+    *reduce_expr* in terms of ``a`` and ``b``. *neutral* is the neutral
+    element of the reduction.
+
+    Each block of *block_size* consecutive elements is accumulated
+    sequentially, and the results of the blocks are combined pairwise,
+    which keeps the rounding error growth logarithmic in the number of
+    blocks. If *parallel* is *True*, blocks are processed by multiple OpenMP
+    threads. The order of operations does not depend on the number of
+    threads.
+    """
+
+    from codepy.bpl import BoostPythonModule
+
+    from cgen import FunctionBody, FunctionDeclaration, \
+            Value, POD, Struct, For, Initializer, Include, Statement, \
+            Line, Block, If
+
+    S = Statement
+
+    dtype_out = numpy.dtype(dtype_out)
+    ctype_out = dtype_to_ctype(dtype_out)
+
+    mod = BoostPythonModule()
+    mod.add_to_preamble([
+        Include("pyublas/numpy.hpp"),
+        Include("vector"),
+        Include("algorithm"),
+        ])
+
+    mod.add_to_module([
+        S("namespace ublas = boost::numeric::ublas"),
+        S("using namespace pyublas"),
+        Line(),
+        FunctionBody(
+            FunctionDeclaration(
+                Value("inline %s" % ctype_out, "codepy_reduce"),
+                [POD(dtype_out, "a"), POD(dtype_out, "b")]),
+            Block([S("return %s" % reduce_expr)])),
+        Line(),
+        ])
+
+    body = Block(_get_arg_initializers(arguments))
+
+    block_loop = For("long codepy_block = 0",
+            "codepy_block < (long) codepy_block_count",
+            "++codepy_block",
+            Block([
+                Initializer(POD(numpy.uintp, "codepy_start"),
+                    "codepy_block*codepy_block_size"),
+                Initializer(POD(numpy.uintp, "codepy_stop"),
+                    "std::min<npy_uintp>(codepy_start + codepy_block_size, "
+                    "codepy_length)"),
+                Initializer(POD(dtype_out, "codepy_acc"), neutral),
+                For("npy_uintp i = codepy_start",
+                    "i < codepy_stop",
+                    "++i",
+                    S("codepy_acc = codepy_reduce(codepy_acc, %s)" % map_expr)),
+                S("codepy_partial[codepy_block] = codepy_acc"),
+                ]))
+
+    body.extend([
+        Line(),
+        Initializer(POD(numpy.uintp, "codepy_block_size"), block_size),
+        Initializer(POD(numpy.uintp, "codepy_block_count"),
+            "(codepy_length + codepy_block_size - 1) / codepy_block_size"),
+        If("codepy_block_count == 0", S("return %s" % neutral)),
+        Line(),
+        Initializer(Value("std::vector<%s >" % ctype_out, "codepy_partial"),
+            "std::vector<%s >(codepy_block_count)" % ctype_out),
+        Line(),
+        ]
+        + ([Line("#pragma omp parallel for schedule(static)")]
+            if parallel else [])
+        + [
+            block_loop,
+            Line(),
+            For("npy_uintp codepy_stride = 1",
+                "codepy_stride < codepy_block_count",
+                "codepy_stride *= 2",
+                For("npy_uintp codepy_block = 0",
+                    "codepy_block + codepy_stride < codepy_block_count",
+                    "codepy_block += 2*codepy_stride",
+                    S("codepy_partial[codepy_block] = codepy_reduce("
+                        "codepy_partial[codepy_block], "
+                        "codepy_partial[codepy_block + codepy_stride])"))),
+            Line(),
+            S("return codepy_partial[0]"),
+            ])
+
+    arg_struct = Struct("arg_struct",
+            [arg.declarator() for arg in arguments])
+    mod.add_struct(arg_struct, "ArgStruct")
+    mod.add_to_module([Line()])
+
+    mod.add_function(
+            FunctionBody(
+                FunctionDeclaration(
+                    Value(ctype_out, name),
+                    [POD(numpy.uintp, "codepy_length"),
+                        Value("arg_struct", "args")]),
+                body),
+            release_gil=release_gil)
+
+    return mod
+
+
+
+
+class ReductionKernel:
+    """A kernel reducing *map_expr*, evaluated at each index ``i`` of its
+    vector arguments, to a single value of type *dtype_out* in a single pass.
+    See :func:`get_reduction_module_descriptor` for the meaning of the
+    arguments.
+
+    For example, a dot product is obtained from::
+
+        ReductionKernel(numpy.float64, neutral="0",
+                reduce_expr="a+b", map_expr="x[i]*y[i]",
+                arguments=[VectorArg(numpy.float64, "x"),
+                    VectorArg(numpy.float64, "y")])
+    """
+
+    def __init__(self, dtype_out, neutral, reduce_expr, map_expr, arguments,
+            name="reduce_kernel", toolchain=None, parallel=False,
+            block_size=128, release_gil=False):
+        self.dtype_out = numpy.dtype(dtype_out)
+        self.arguments = arguments
+
+        toolchain = _get_kernel_toolchain(toolchain, parallel)
+        self.module = get_reduction_module_descriptor(
+                dtype_out, neutral, reduce_expr, map_expr, arguments, name,
+                parallel, block_size, release_gil).compile(toolchain)
+        self.func = getattr(self.module, name)
+
+        self.vec_arg_indices = [i for i, arg in enumerate(arguments)
+                if isinstance(arg, VectorArg)]
+
+        assert self.vec_arg_indices, \
+                "ReductionKernel can only be used with functions that have at " \
+                "least one vector argument"
+
+    def __call__(self, *args):
+        from pytools import single_valued
+        size = single_valued(args[i].size for i in self.vec_arg_indices)
+
+        arg_struct = self.module.ArgStruct()
+        for arg_descr, arg in zip(self.arguments, args):
+            setattr(arg_struct, arg_descr.arg_name(), arg)
+
+        assert not arg_struct.__dict__
+
+        return self.dtype_out.type(self.func(size, arg_struct))
+
+
+
+
+def get_scan_module_descriptor(dtype, arguments, input_expr, scan_expr,
+        output_statement, neutral=None, is_segment_start_expr=None,
+        inclusive=True, name="scan_kernel", parallel=False, block_size=4096,
+        release_gil=False):
+    """Return a :class:`codepy.bpl.BoostPythonModule` exposing a function
+    *name* that computes a prefix scan of *input_expr*, evaluated at each
+    index ``i``, using the associative operator *scan_expr* in terms of
+    ``a`` and ``b``. For each index, *output_statement* is executed with the
+    scan result available as ``item``. The function returns the scan result
+    over all elements (of the last segment, if segmented).
+
+    If *inclusive* is *False*, ``item`` does not include the element at
+    ``i``, and *neutral* must be given. If *is_segment_start_expr* is given,
+    the scan restarts at every index for which it evaluates to true. For
+    empty input, the function returns *neutral*, or a value-initialized
+    *dtype* if it is not given.
+
+    The scan proceeds in two passes over blocks of *block_size* elements.
+    The first pass computes the scan result of each block, the carries into
+    each block are then accumulated sequentially, and the second pass
+    rescans each block starting from its carry. If *parallel* is *True*,
+    both passes are spread over OpenMP threads.
+    """
+
+    if not inclusive and neutral is None:
+        raise ValueError("exclusive scans need a neutral element")
+
+    from codepy.bpl import BoostPythonModule
+
+    from cgen import FunctionBody, FunctionDeclaration, \
+            Value, POD, Struct, For, Initializer, Include, Statement, \
+            Line, Block, If, Assign
+
+    S = Statement
+
+    dtype = numpy.dtype(dtype)
+    ctype = dtype_to_ctype(dtype)
+
+    mod = BoostPythonModule()
+    mod.add_to_preamble([
+        Include("pyublas/numpy.hpp"),
+        Include("vector"),
+        Include("algorithm"),
+        ])
+
+    # a single name for the type, so that it can be used in functional
+    # casts even if it consists of several words
+    mod.add_to_module([
+        S("namespace ublas = boost::numeric::ublas"),
+        S("using namespace pyublas"),
+        S("typedef %s codepy_scan_type" % ctype),
+        Line(),
+        FunctionBody(
+            FunctionDeclaration(
+                Value("inline %s" % ctype, "codepy_scan_op"),
+                [POD(dtype, "a"), POD(dtype, "b")]),
+            Block([S("return %s" % scan_expr)])),
+        Line(),
+        ])
+
+    omp_pragma = ([Line("#pragma omp parallel for schedule(static)")]
+            if parallel else [])
+
+    def block_bounds():
+        return [
+                Initializer(POD(numpy.uintp, "codepy_start"),
+                    "codepy_block*codepy_block_size"),
+                Initializer(POD(numpy.uintp, "codepy_stop"),
+                    "std::min<npy_uintp>(codepy_start + codepy_block_size, "
+                    "codepy_length)"),
+                ]
+
+    def restart_at_segment_start(statements):
+        if is_segment_start_expr is None:
+            return []
+        return [If(is_segment_start_expr, Block(statements))]
+
+    # {{{ first pass: scan result of each block
+
+    first_pass = For("long codepy_block = 0",
+            "codepy_block < (long) codepy_block_count",
+            "++codepy_block",
+            Block(block_bounds() + [
+                Initializer(Value("bool", "codepy_has_acc"), "false"),
+                Initializer(Value("bool", "codepy_has_start"), "false"),
+                Initializer(POD(dtype, "codepy_acc"), "codepy_scan_type()"),
+                For("npy_uintp i = codepy_start",
+                    "i < codepy_stop",
+                    "++i",
+                    Block([
+                        Initializer(POD(dtype, "codepy_x"), input_expr),
+                        ]
+                        + restart_at_segment_start([
+                            Assign("codepy_has_acc", "false"),
+                            Assign("codepy_has_start", "true"),
+                            ])
+                        + [
+                            Assign("codepy_acc",
+                                "codepy_has_acc "
+                                "? codepy_scan_op(codepy_acc, codepy_x) "
+                                ": codepy_x"),
+                            Assign("codepy_has_acc", "true"),
+                            ])),
+                Assign("codepy_block_acc[codepy_block]", "codepy_acc"),
+                Assign("codepy_block_has_start[codepy_block]",
+                    "codepy_has_start"),
+                ]))
+
+    # }}}
+
+    # {{{ carries into each block
+
+    carry_loop = For("npy_uintp codepy_block = 1",
+            "codepy_block < codepy_block_count",
+            "++codepy_block",
+            Block([
+                Initializer(POD(numpy.uintp, "codepy_prev"), "codepy_block-1"),
+                If("codepy_block_has_carry[codepy_prev] "
+                    "&& !codepy_block_has_start[codepy_prev]",
+                    Assign("codepy_carry[codepy_block]",
+                        "codepy_scan_op(codepy_carry[codepy_prev], "
+                        "codepy_block_acc[codepy_prev])"),
+                    Assign("codepy_carry[codepy_block]",
+                        "codepy_block_acc[codepy_prev]")),
+                Assign("codepy_block_has_carry[codepy_block]", "true"),
+                ]))
+
+    # }}}
+
+    # {{{ second pass: rescan each block starting from its carry
+
+    if inclusive:
+        emit_item = [
+                Assign("codepy_acc",
+                    "codepy_has_acc "
+                    "? codepy_scan_op(codepy_acc, codepy_x) "
+                    ": codepy_x"),
+                Assign("codepy_has_acc", "true"),
+                Initializer(POD(dtype, "item"), "codepy_acc"),
+                S(output_statement),
+                ]
+    else:
+        emit_item = [
+                Initializer(POD(dtype, "item"),
+                    "codepy_has_acc ? codepy_acc : codepy_scan_type(%s)"
+                    % neutral),
+                S(output_statement),
+                Assign("codepy_acc",
+                    "codepy_has_acc "
+                    "? codepy_scan_op(codepy_acc, codepy_x) "
+                    ": codepy_x"),
+                Assign("codepy_has_acc", "true"),
+                ]
+
+    second_pass = For("long codepy_block = 0",
+            "codepy_block < (long) codepy_block_count",
+            "++codepy_block",
+            Block(block_bounds() + [
+                Initializer(Value("bool", "codepy_has_acc"),
+                    "codepy_block_has_carry[codepy_block]"),
+                Initializer(POD(dtype, "codepy_acc"),
+                    "codepy_carry[codepy_block]"),
+                For("npy_uintp i = codepy_start",
+                    "i < codepy_stop",
+                    "++i",
+                    Block([
+                        Initializer(POD(dtype, "codepy_x"), input_expr),
+                        ]
+                        + restart_at_segment_start([
+                            Assign("codepy_has_acc", "false"),
+                            ])
+                        + [Block(emit_item)])),
+                ]))
+
+    # }}}
+
+    body = Block(_get_arg_initializers(arguments))
+    body.extend([
+        Line(),
+        Initializer(POD(numpy.uintp, "codepy_block_size"), block_size),
+        Initializer(POD(numpy.uintp, "codepy_block_count"),
+            "(codepy_length + codepy_block_size - 1) / codepy_block_size"),
+        If("codepy_block_count == 0",
+            S("return codepy_scan_type(%s)"
+                % (neutral if neutral is not None else ""))),
+        Line(),
+        Initializer(Value("std::vector<%s >" % ctype, "codepy_block_acc"),
+            "std::vector<%s >(codepy_block_count)" % ctype),
+        Initializer(Value("std::vector<char>", "codepy_block_has_start"),
+            "std::vector<char>(codepy_block_count, 0)"),
+        Initializer(Value("std::vector<%s >" % ctype, "codepy_carry"),
+            "std::vector<%s >(codepy_block_count)" % ctype),
+        Initializer(Value("std::vector<char>", "codepy_block_has_carry"),
+            "std::vector<char>(codepy_block_count, 0)"),
+        Line(),
+        ]
+        + omp_pragma + [first_pass, Line(), carry_loop, Line()]
+        + omp_pragma + [second_pass, Line()]
+        + [
+            Initializer(POD(numpy.uintp, "codepy_last"),
+                "codepy_block_count-1"),
+            If("codepy_block_has_carry[codepy_last] "
+                "&& !codepy_block_has_start[codepy_last]",
+                S("return codepy_scan_op(codepy_carry[codepy_last], "
+                    "codepy_block_acc[codepy_last])"),
+                S("return codepy_block_acc[codepy_last]")),
+            ])
+
+    arg_struct = Struct("arg_struct",
+            [arg.declarator() for arg in arguments])
+    mod.add_struct(arg_struct, "ArgStruct")
+    mod.add_to_module([Line()])
+
+    mod.add_function(
+            FunctionBody(
+                FunctionDeclaration(
+                    Value(ctype, name),
+                    [POD(numpy.uintp, "codepy_length"),
+                        Value("arg_struct", "args")]),
+                body),
+            release_gil=release_gil)
+
+    return mod
+
+
+
+
+class ScanKernel:
+    """A kernel computing a prefix scan over its vector arguments. See
+    :func:`get_scan_module_descriptor` for the meaning of the arguments.
+    Calling it returns the scan result over all elements.
+
+    For example, stream compaction of the positive entries of *x* into
+    *out* is obtained from::
+
+        ScanKernel(numpy.intp, arguments=[
+                    VectorArg(numpy.float64, "x"),
+                    VectorArg(numpy.float64, "out")],
+                input_expr="x[i] > 0 ? 1 : 0", scan_expr="a+b",
+                output_statement="if (x[i] > 0) out[item] = x[i]",
+                neutral="0", inclusive=False)
+    """
+
+    def __init__(self, dtype, arguments, input_expr, scan_expr,
+            output_statement, neutral=None, is_segment_start_expr=None,
+            inclusive=True, name="scan_kernel", toolchain=None,
+            parallel=False, block_size=4096, release_gil=False):
+        self.dtype = numpy.dtype(dtype)
+        self.arguments = arguments
+
+        toolchain = _get_kernel_toolchain(toolchain, parallel)
+        self.module = get_scan_module_descriptor(
+                dtype, arguments, input_expr, scan_expr, output_statement,
+                neutral, is_segment_start_expr, inclusive, name,
+                parallel, block_size, release_gil).compile(toolchain)
+        self.func = getattr(self.module, name)
+
+        self.vec_arg_indices = [i for i, arg in enumerate(arguments)
+                if isinstance(arg, VectorArg)]
+
+        assert self.vec_arg_indices, \
+                "ScanKernel can only be used with functions that have at " \
+                "least one vector argument"
+
+    def __call__(self, *args):
+        from pytools import single_valued
+        size = single_valued(args[i].size for i in self.vec_arg_indices)
+
         arg_struct = self.module.ArgStruct()
         for arg_descr, arg in zip(self.arguments, args):
             setattr(arg_struct, arg_descr.arg_name(), arg)
 
         assert not arg_struct.__dict__
 
-        self.func(size, arg_struct)
+        return self.dtype.type(self.func(size, arg_struct))
 
 
 
@@ -0,0 +1,80 @@
+"""Communicators for compiling once on behalf of a group of processes.
+
+When many processes, such as the ranks of an MPI job, build the same
+extension modules, :func:`codepy.jit.extension_from_string` can let one of
+them (the leader, of rank 0) look up or compile each module and pass the
+result on to the others, which only load it. See
+:func:`codepy.jit.set_compile_group`.
+
+A communicator is any object with the attributes *rank* and *size* and a
+method *bcast(obj, root=0)* that returns the *obj* passed by the process of
+rank *root* in all processes, like those of :mod:`mpi4py`.
+"""
+
+from __future__ import division
+
+
+class MPICommunicator(object):
+    """A communicator for the processes of the :mod:`mpi4py` communicator
+    *comm*, by default ``MPI.COMM_WORLD``.
+    """
+
+    def __init__(self, comm=None):
+        if comm is None:
+            from mpi4py import MPI
+            comm = MPI.COMM_WORLD
+
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.size = comm.Get_size()
+
+    @classmethod
+    def per_node(cls, comm=None):
+        """Return a communicator for the processes of *comm* on the same
+        node as the calling process, so that there is one leader per node.
+        """
+        from mpi4py import MPI
+        if comm is None:
+            comm = MPI.COMM_WORLD
+
+        return cls(comm.Split_type(MPI.COMM_TYPE_SHARED))
+
+    def bcast(self, obj, root=0):
+        return self.comm.bcast(obj, root=root)
+
+
+class PipeCommunicator(object):
+    """A communicator for processes started by :mod:`multiprocessing`,
+    connected by pipes. Create them with :func:`make_pipe_communicators`.
+    Only broadcasts from rank 0 are supported.
+    """
+
+    def __init__(self, rank, size, connections):
+        self.rank = rank
+        self.size = size
+        self.connections = connections
+
+    def bcast(self, obj, root=0):
+        if root != 0:
+            raise ValueError("only broadcasts from rank 0 are supported")
+
+        if self.rank == 0:
+            for conn in self.connections:
+                conn.send(obj)
+            return obj
+        else:
+            conn, = self.connections
+            return conn.recv()
+
+
+def make_pipe_communicators(size):
+    """Return a list of *size* :class:`PipeCommunicator` instances, the one
+    at index *i* for the process of rank *i*.
+    """
+    from multiprocessing import Pipe
+
+    pipes = [Pipe() for i in range(size - 1)]
+    return (
+            [PipeCommunicator(0, size, [leader for leader, follower in pipes])]
+            + [PipeCommunicator(i + 1, size, [follower])
+                for i, (leader, follower) in enumerate(pipes)])
@@ -30,6 +30,7 @@ THE SOFTWARE.
 from codepy import CompileError
 from pytools import Record
 import six
+import threading
 
 import logging
 logger = logging.getLogger(__name__)
@@ -172,7 +173,8 @@ class ModuleCacheDirManager(CleanupBase):
 def extension_from_string(toolchain, name, source_string,
                           source_name="module.cpp", cache_dir=None,
                           debug=False, wait_on_error=None,
-                          debug_recompile=True):
+                          debug_recompile=True, isa_levels=None, pgo=False,
+                          group=None, key=None):
     """Return a reference to the extension module *name*, which can be built
     from the source code in *source_string* if necessary. Raise
     :exc:`CompileError` in case of error.
@@ -184,6 +186,8 @@ def extension_from_string(toolchain, name, source_string,
     If it is ``False``, no caching is performed. Proper locking is performed
     on the cache directory. Simultaneous use of the cache by multiple
     processes works as expected, but may lead to delays because of locking.
+    *cache_dir* may also be a list of layers, as described for
+    :func:`compile_from_string`.
 
     The code in *source_string* will be saved to a temporary file named
     *source_name* if it needs to be compiled.
@@ -197,30 +201,1404 @@ def extension_from_string(toolchain, name, source_string,
 
     If *debug_recompile*, messages are printed indicating whether a
     recompilation is taking place.
+
+    If *isa_levels* is given, the best of the named entries of
+    :data:`codepy.toolchain.ISA_LEVELS` supported by the host CPU is looked
+    up or built (see :meth:`codepy.toolchain.Toolchain.with_isa_level`) and
+    loaded. If it had to be built, the other variants are built as well,
+    so that a cache shared between machines with different CPUs has them.
+    If *isa_levels* is ``True``,
+    :func:`codepy.toolchain.get_default_isa_levels` is used. Packages built
+    ahead of time by :mod:`codepy.aot` are not used then.
+
+    If *pgo* is ``True``, profile-guided optimization is used, as described
+    for :func:`compile_from_string`: the module is instrumented until the
+    first process using it has exited, and optimized from then on.
+
+    If *group*, a :class:`CompileGroup`, is given, or a group has been set
+    with :func:`set_compile_group`, this is a collective operation over the
+    processes of the group: the leader builds the module or finds it in the
+    cache, and the others load the result.
+
+    If *key* is given, *source_string* may be a callable returning the
+    source, as described for :func:`compile_from_string`.
     """
-    checksum, mod_name, ext_file, recompiled = \
-        compile_from_string(toolchain,
-                            name, source_string,
-                            source_name,
-                            cache_dir, debug, wait_on_error, debug_recompile,
-                            False)
+    if callable(source_string):
+        generate_source = source_string
+        generated = []
+
+        def source_string():
+            # only generate once for all ISA levels
+            if not generated:
+                generated.append(generate_source())
+            return generated[0]
+
+    def compile():
+        if isa_levels is not None:
+            from codepy.toolchain import (get_default_isa_levels,
+                    select_isa_level)
+            levels = isa_levels
+            if levels is True:
+                levels = get_default_isa_levels()
+
+            def compile_level(isa_level):
+                return compile_from_string(
+                        toolchain.with_isa_level(isa_level),
+                        name, source_string,
+                        source_name,
+                        cache_dir, debug, wait_on_error,
+                        debug_recompile, False, pgo=pgo, key=key,
+                        # packages built ahead of time have one variant
+                        aot=False)
+
+            best_level = select_isa_level(levels)
+            checksum, mod_name, ext_file, recompiled = \
+                    compile_level(best_level)
+            if recompiled:
+                for isa_level in levels:
+                    if isa_level != best_level:
+                        compile_level(isa_level)
+        else:
+            checksum, mod_name, ext_file, recompiled = \
+                compile_from_string(toolchain,
+                                    name, source_string,
+                                    source_name,
+                                    cache_dir, debug, wait_on_error,
+                                    debug_recompile, False, pgo=pgo, key=key)
+        return mod_name, ext_file
+
+    if group is None:
+        group = _compile_group
+
+    if group is None or group.comm.size == 1:
+        mod_name, ext_file = compile()
+        temp_dir = None
+    else:
+        mod_name, ext_file, temp_dir = _compile_for_group(group, compile)
+
     # try loading it
     from imp import load_dynamic
-    return load_dynamic(mod_name, ext_file)
+    try:
+        return load_dynamic(mod_name, ext_file)
+    finally:
+        if temp_dir is not None:
+            # not needed any more once loaded
+            _erase_dir(temp_dir)
+
+
+# {{{ compiling for groups of processes
+
+class CompileGroup(Record):
+    """A group of processes building extension modules together. See
+    :func:`set_compile_group`.
+
+    .. attribute:: comm
+
+        A communicator as described in :mod:`codepy.group`.
+
+    .. attribute:: share
+
+        ``"path"`` or ``"bytes"``, see :func:`set_compile_group`.
+    """
+
+    def __init__(self, comm, share="path"):
+        if share not in ["path", "bytes"]:
+            raise ValueError("invalid share mode: %s" % share)
+
+        Record.__init__(self, comm=comm, share=share)
+
+
+_compile_group = None
+
+
+def set_compile_group(comm, share="path"):
+    """Make :func:`extension_from_string` (and the functions using it, such
+    as :meth:`codepy.bpl.BoostPythonModule.compile`) a collective operation
+    over the processes of the communicator *comm* (see :mod:`codepy.group`),
+    or an operation of each process by itself again if *comm* is *None*.
+
+    The process of rank 0 builds each module, or finds it in the cache, and
+    broadcasts the result, so that only it accesses the cache. All
+    processes in the group need to build the same modules in the same order.
+    If *share* is ``"path"``, the path of the module file is broadcast,
+    which therefore needs to be accessible to all processes. If it is
+    ``"bytes"``, its contents are, and the other processes load them from a
+    temporary file.
+    """
+    global _compile_group
+    if comm is None:
+        _compile_group = None
+    else:
+        _compile_group = CompileGroup(comm, share)
+
+
+def _compile_for_group(group, compile):
+    """Call *compile*, which returns a tuple *(mod_name, ext_file)*, in the
+    leader of *group*. Return a tuple *(mod_name, ext_file, temp_dir)* in all
+    processes, where *temp_dir* is a temporary directory containing
+    *ext_file* to be removed by the caller, or *None*.
+    """
+    from os.path import basename, join
+
+    comm = group.comm
+
+    if comm.rank == 0:
+        try:
+            mod_name, ext_file = compile()
+
+            if group.share == "bytes":
+                with open(ext_file, "rb") as inf:
+                    contents = inf.read()
+            else:
+                contents = None
+        except Exception as e:
+            # the other processes wait for the broadcast whatever happened
+            if isinstance(e, CompileError):
+                message = str(e)
+            else:
+                message = "%s in the leader of the compile group: %s" % (
+                        type(e).__name__, e)
+            comm.bcast(("error", message, getattr(e, "diagnostics", None)),
+                    root=0)
+            raise
+
+        comm.bcast(("ok", mod_name, ext_file, contents), root=0)
+        return mod_name, ext_file, None
+
+    message = comm.bcast(None, root=0)
+    if message[0] == "error":
+        _, error_message, diagnostics = message
+        raise CompileError(error_message, diagnostics=diagnostics)
+
+    _, mod_name, ext_file, contents = message
+    if contents is None:
+        return mod_name, ext_file, None
+
+    from tempfile import mkdtemp
+    local_dir = mkdtemp()
+    local_file = join(local_dir, basename(ext_file))
+    with open(local_file, "wb") as outf:
+        outf.write(contents)
+
+    return mod_name, local_file, local_dir
+
+# }}}
 
 
 class _InvalidInfoFile(RuntimeError):
     pass
 
 
+def _make_dirs(path):
+    import os
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        from errno import EEXIST
+        if e.errno != EEXIST:
+            raise
+
+
+def _calculate_hex_checksum(toolchain, source_string, source_is_binary,
+        profile_digest=None):
+    try:
+        import hashlib
+        checksum = hashlib.md5()
+    except ImportError:
+        # for Python << 2.5
+        import md5
+        checksum = md5.new()
+
+    for source in source_string:
+        if source_is_binary:
+            checksum.update(source)
+        else:
+            checksum.update(source.encode('utf-8'))
+    checksum.update(str(toolchain.abi_id()).encode('utf-8'))
+    if profile_digest is not None:
+        checksum.update(profile_digest.encode('utf-8'))
+    return checksum.hexdigest()
+
+
+# {{{ profile-guided optimization
+
+def _get_profile_digest(profile_dir):
+    """Return a digest of the profiles in *profile_dir*, or *None* if there
+    are none.
+    """
+    import hashlib
+    import os
+    from os.path import join, relpath
+
+    profiles = []
+    for dirpath, dirnames, filenames in os.walk(profile_dir):
+        for filename in filenames:
+            if filename.endswith(".gcda"):
+                profiles.append(join(dirpath, filename))
+
+    if not profiles:
+        return None
+
+    checksum = hashlib.md5()
+    for path in sorted(profiles):
+        checksum.update(relpath(path, profile_dir).encode("utf-8"))
+        with open(path, "rb") as inf:
+            checksum.update(inf.read())
+    return checksum.hexdigest()
+
+
+def _supports_pgo(toolchain):
+    try:
+        toolchain.with_profile_generate("profile")
+    except NotImplementedError:
+        return False
+    else:
+        return True
+
+
+def _compile_with_pgo(toolchain, name, source_string, source_name, cache_dir,
+        debug, debug_recompile, object, source_is_binary):
+    """Implement *pgo* for :func:`compile_from_string`.
+
+    The profiles identify code by the paths of the source and output files,
+    so both the instrumented and the optimized variant are built in the
+    same directory, from which the optimized one is moved to a location
+    keyed by the digest of the profiles. Instrumented processes still
+    running keep changing the profiles, so the digest of the optimized
+    variant in use is remembered, and it is only rebuilt if it is no longer
+    valid.
+    """
+    import os
+    from os.path import join, exists
+    from tempfile import mkstemp
+
+    pgo_dir = join(cache_dir, "pgo",
+            _calculate_hex_checksum(toolchain, source_string, source_is_binary))
+    build_dir = join(pgo_dir, "build")
+    profile_dir = join(pgo_dir, "profile")
+    current_file = join(pgo_dir, "current")
+    _make_dirs(build_dir)
+    _make_dirs(profile_dir)
+
+    if object:
+        suffix = toolchain.o_ext
+    else:
+        suffix = toolchain.so_ext
+
+    build_file = join(build_dir, name+suffix)
+
+    def build(toolchain):
+        _build_entry(toolchain, build_dir, name+suffix, source_string,
+                source_name, debug, object, source_is_binary)
+
+    def find(entry_dir):
+        return _find_entry(entry_dir, name+suffix, source_string,
+                source_is_binary, debug_recompile)
+
+    cleanup_m = CleanupManager()
+
+    try:
+        # Variable 'lock_m' is used for no other purpose than
+        # to keep lock manager alive.
+        lock_m = CacheLockManager(cleanup_m, pgo_dir)  # noqa
+
+        ext_file = None
+        try:
+            with open(current_file) as inf:
+                profile_digest = inf.read().strip()
+        except IOError:
+            pass
+        else:
+            ext_file = find(join(pgo_dir, "optimized-%s" % profile_digest))
+
+        if ext_file is None:
+            profile_digest = _get_profile_digest(profile_dir)
+
+        if profile_digest is None:
+            toolchain = toolchain.with_profile_generate(profile_dir)
+            hex_checksum = _calculate_hex_checksum(
+                    toolchain, source_string, source_is_binary)
+
+            ext_file = find(build_dir)
+            if ext_file is not None:
+                recompiled = False
+            else:
+                if debug_recompile:
+                    logger.info("building instrumented variant in %s."
+                            % build_dir)
+                build(toolchain)
+                ext_file = build_file
+                recompiled = True
+        else:
+            toolchain = toolchain.with_profile_use(profile_dir)
+            hex_checksum = _calculate_hex_checksum(
+                    toolchain, source_string, source_is_binary,
+                    profile_digest)
+
+            if ext_file is not None:
+                recompiled = False
+            else:
+                if debug_recompile:
+                    logger.info("building optimized variant for profile %s."
+                            % profile_digest)
+
+                opt_dir = join(pgo_dir, "optimized-%s" % profile_digest)
+                if exists(opt_dir):
+                    _erase_dir(opt_dir)
+                if exists(build_file):
+                    # may still be loaded by instrumented processes
+                    os.unlink(build_file)
+
+                build(toolchain)
+                os.mkdir(opt_dir)
+                for filename in [name+suffix, "info"]:
+                    os.rename(join(build_dir, filename), join(opt_dir, filename))
+                ext_file = join(opt_dir, name+suffix)
+
+                fd, temp_path = mkstemp(dir=pgo_dir)
+                with os.fdopen(fd, "w") as outf:
+                    outf.write(profile_digest)
+                os.rename(temp_path, current_file)
+
+                # superseded variants, which are no longer returned
+                for entry in os.listdir(pgo_dir):
+                    if (entry.startswith("optimized-")
+                            and entry != "optimized-%s" % profile_digest):
+                        _erase_dir(join(pgo_dir, entry))
+
+                recompiled = True
+
+        mod_name = "codepy.temp.%s.%s" % (hex_checksum, name)
+        return hex_checksum, mod_name, ext_file, recompiled
+    except:
+        cleanup_m.error_clean_up()
+        raise
+    finally:
+        cleanup_m.clean_up()
+
+# }}}
+
+
 class _SourceInfo(Record):
     pass
 
 
+def _get_file_md5sum(fname):
+    try:
+        import hashlib
+        checksum = hashlib.md5()
+    except ImportError:
+        # for Python << 2.5
+        import md5
+        checksum = md5.new()
+
+    inf = open(fname, "rb")
+    checksum.update(inf.read())
+
+    inf.close()
+    return checksum.hexdigest()
+
+
+def _load_info(info_path):
+    from six.moves.cPickle import loads
+
+    try:
+        info_file = open(info_path, 'rb')
+    except IOError:
+        raise _InvalidInfoFile()
+
+    try:
+        data = info_file.read()
+        if _is_compressed(data):
+            data = _decompress(data)
+        return loads(data)
+    except Exception:
+        # truncated, corrupt or compressed with an unavailable codec
+        raise _InvalidInfoFile()
+    finally:
+        info_file.close()
+
+
+def _write_info(entry_dir, info):
+    from os.path import join
+    from six.moves.cPickle import dumps
+
+    with open(join(entry_dir, "info"), "wb") as info_file:
+        info_file.write(_compress(dumps(info, protocol=2)))
+
+
+def _check_deps(deps, debug_recompile):
+    import os
+
+    for name, date, md5sum in deps:
+        try:
+            possibly_updated = os.stat(name).st_mtime != date
+        except OSError as e:
+            if debug_recompile:
+                logger.info("recompiling because dependency %s is "
+                "inaccessible (%s)." % (name, e))
+            return False
+        else:
+            if possibly_updated and md5sum != _get_file_md5sum(name):
+                if debug_recompile:
+                    logger.info("recompiling because dependency %s was "
+                    "updated." % name)
+                return False
+
+    return True
+
+
+def _check_source(source_path, source_string, source_is_binary,
+        debug_recompile):
+    valid = True
+    for i, path in enumerate(source_path):
+        source = source_string[i]
+        try:
+            src_f = open(path, "r" if not source_is_binary else "rb")
+        except IOError:
+            if debug_recompile:
+                logger.info("recompiling because cache directory does "
+                        "not contain source file '%s'." % path)
+            return False
+
+        valid = valid and src_f.read() == source
+        src_f.close()
+
+        if not valid:
+            from warnings import warn
+            warn("hash collision in compiler cache")
+    return valid
+
+
+def _find_entry(entry_dir, ext_name, source_string, source_is_binary,
+        debug_recompile):
+    """Return the path of the file *ext_name* as stored in the cache entry
+    *entry_dir*, possibly compressed, or *None* if the entry is missing or
+    not valid for *source_string*. If *source_string* is *None*, the
+    sources are not compared.
+    """
+    from os.path import exists, join
+
+    try:
+        info = _load_info(join(entry_dir, "info"))
+    except _InvalidInfoFile:
+        return None
+
+    if not _check_deps(info.dependencies, debug_recompile):
+        return None
+
+    stored_source_string = getattr(info, "source_string", None)
+    if source_string is None:
+        pass
+    elif stored_source_string is not None:
+        if list(stored_source_string) != list(source_string):
+            from warnings import warn
+            warn("hash collision in compiler cache")
+            return None
+    elif not _check_source(
+            [join(entry_dir, x) for x in info.source_name],
+            source_string, source_is_binary, debug_recompile):
+        # an entry of the v5 layout, holding the sources as files
+        return None
+
+    for stored_file in [
+            join(entry_dir, ext_name),
+            join(entry_dir, ext_name + COMPRESSED_SUFFIX)]:
+        if exists(stored_file):
+            return stored_file
+
+    return None
+
+
+def _find_in_layer(layer, hex_checksum, ext_name, source_string,
+        source_is_binary):
+    """Return the path of the file *ext_name* as stored in the valid entry
+    for *hex_checksum* in the read-only cache *layer*, in the current or
+    the v5 layout, or *None*. Takes no locks, as nothing writes to such
+    layers.
+    """
+    from os.path import join
+
+    for entry_dir in [
+            _get_entry_dir(layer, hex_checksum),
+            join(layer, hex_checksum)]:
+        stored_file = _find_entry(entry_dir, ext_name, source_string,
+                source_is_binary, False)
+        if stored_file is not None:
+            return stored_file
+
+    return None
+
+
+def _build_entry(toolchain, entry_dir, ext_name, source_string, source_name,
+        debug, object, source_is_binary, compress_artifact=False):
+    """Build *ext_name* from the sources in the cache entry directory
+    *entry_dir*, and write the entry's info file, which keeps the sources.
+    Return the path of the stored file.
+    """
+    import os
+    from os.path import join
+
+    source_paths = [join(entry_dir, source) for source in source_name]
+    for source, path in zip(source_string, source_paths):
+        with open(path, "w" if not source_is_binary else "wb") as outf:
+            outf.write(source)
+
+    from time import time
+    start_time = time()
+
+    ext_file = join(entry_dir, ext_name)
+    if object:
+        toolchain.build_object(ext_file, source_paths, debug=debug)
+    else:
+        toolchain.build_extension(ext_file, source_paths, debug=debug)
+
+    build_time = time() - start_time
+
+    deps = sorted(toolchain.get_dependencies(source_paths))
+
+    _write_info(entry_dir, _SourceInfo(
+            dependencies=[
+                (dep, os.stat(dep).st_mtime, _get_file_md5sum(dep))
+                for dep in deps if dep not in source_paths],
+            source_name=source_name,
+            source_string=list(source_string),
+            created=time(),
+            build_time=build_time,
+            compiler=_describe_compiler(toolchain)))
+
+    for path in source_paths:
+        os.unlink(path)
+
+    if compress_artifact:
+        return _copy_file(ext_file, entry_dir, compress=True)
+    else:
+        return ext_file
+
+
+def _describe_compiler(toolchain):
+    """Return a short description of the compiler of *toolchain*, kept in
+    cache entries so that they can be pruned by compiler.
+    """
+    try:
+        version = toolchain.get_version().strip().split("\n")[0]
+    except Exception:
+        version = "unknown version"
+
+    return "%s: %s" % (toolchain.cc, version)
+
+
+def _get_base_layers(cache_dir):
+    """Split *cache_dir*, as passed to :func:`compile_from_string`, into a
+    list of read-only cache layers and the writable one.
+    """
+    import os
+
+    if isinstance(cache_dir, (list, tuple)):
+        base_layers = list(cache_dir[:-1])
+        cache_dir = cache_dir[-1]
+    else:
+        base_layers = []
+
+    base_layers.extend(
+            layer for layer in os.environ.get(
+                "CODEPY_CACHE_BASE_LAYERS", "").split(os.pathsep)
+            if layer)
+
+    return base_layers, cache_dir
+
+
+def _get_default_cache_dir(layout_version=6):
+    import appdirs
+    import sys
+    from os.path import join
+
+    return join(
+            appdirs.user_cache_dir("codepy", "codepy"),
+            "codepy-compiler-cache-v%d-py%s" % (
+                layout_version,
+                ".".join(str(i) for i in sys.version_info),))
+
+
+# {{{ cache entries
+
+# Each entry of a cache lives in <cache_dir>/<shard>/<checksum>, where the
+# shard consists of the first two digits of the checksum, and is locked
+# through <cache_dir>/<shard>/<checksum>.lock. It holds the compressed info
+# file, which includes the sources, and the built file, compressed if
+# COMPRESSED_SUFFIX is appended to its name. Entries are built in temporary
+# directories next to them and published by renaming those. Entries of the
+# v5 layout lived in <cache_dir>/<checksum> and held their sources
+# uncompressed; they are migrated when found.
+
+COMPRESSED_SUFFIX = ".z"
+
+# Compressed data starts with one of these headers, naming the codec. No
+# pickle starts with a zero byte, so that uncompressed info files of the v5
+# layout can be told apart.
+_ZSTD_HEADER = b"\0zstd\n"
+_ZLIB_HEADER = b"\0zlib\n"
+
+
+def _compress(data):
+    try:
+        import zstandard
+    except ImportError:
+        import zlib
+        return _ZLIB_HEADER + zlib.compress(data)
+    else:
+        return _ZSTD_HEADER + zstandard.ZstdCompressor().compress(data)
+
+
+def _is_compressed(data):
+    return data.startswith((_ZSTD_HEADER, _ZLIB_HEADER))
+
+
+def _decompress(data):
+    if data.startswith(_ZSTD_HEADER):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(
+                data[len(_ZSTD_HEADER):])
+    elif data.startswith(_ZLIB_HEADER):
+        import zlib
+        return zlib.decompress(data[len(_ZLIB_HEADER):])
+    else:
+        raise ValueError("unknown compression format")
+
+
+_compress_artifacts = None
+
+
+def set_artifact_compression(enabled):
+    """Make :func:`compile_from_string` store built files compressed in the
+    cache if *enabled*. Sources and metadata are always compressed, with
+    :mod:`zstandard` if available, and :mod:`zlib` otherwise. Compressed
+    files are unpacked to a temporary directory of the process (or the fast
+    tier, see :func:`set_fast_cache_dir`) before use. If *enabled* is
+    *None*, the environment variable
+    :envvar:`CODEPY_CACHE_COMPRESS_ARTIFACTS` decides. Disabled by default.
+    """
+    global _compress_artifacts
+    _compress_artifacts = enabled
+
+
+def _get_artifact_compression():
+    import os
+
+    if _compress_artifacts is not None:
+        return _compress_artifacts
+    return os.environ.get("CODEPY_CACHE_COMPRESS_ARTIFACTS", "0") not in [
+            "", "0", "no", "false"]
+
+
+def _get_entry_dir(cache_dir, hex_checksum):
+    from os.path import join
+    return join(cache_dir, hex_checksum[:2], hex_checksum)
+
+
+class EntryLockManager(CleanupBase):
+    """Holds an exclusive lock on the cache entry *entry_dir*, so that
+    processes building different modules do not wait for each other.
+    """
+
+    def __init__(self, cleanup_m, entry_dir):
+        import os
+        import fcntl
+        from os.path import dirname
+        from time import sleep
+
+        _make_dirs(dirname(entry_dir))
+        self.lock_file = entry_dir + ".lock"
+
+        attempts = 0
+        while True:
+            self.fd = os.open(self.lock_file, os.O_CREAT | os.O_RDWR, 0o666)
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                os.close(self.fd)
+            else:
+                if self._holds_lock_file():
+                    break
+
+                # removed by its previous holder, see remove_lock_file
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                os.close(self.fd)
+                continue
+
+            sleep(0.1)
+
+            attempts += 1
+
+            if attempts == 100:
+                from warnings import warn
+                warn("waiting for lock on cache entry '%s'" % entry_dir)
+
+        cleanup_m.register(self)
+
+    def _holds_lock_file(self):
+        import os
+        try:
+            st = os.stat(self.lock_file)
+        except OSError:
+            return False
+        fst = os.fstat(self.fd)
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+    def remove_lock_file(self):
+        """Remove the lock file, which is still held until :meth:`clean_up`.
+        Processes waiting for it notice and lock a new one instead.
+        """
+        import os
+        os.unlink(self.lock_file)
+
+    def clean_up(self):
+        import os
+        import fcntl
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+
+    def error_clean_up(self):
+        pass
+
+
+def _copy_file(path, to_dir, compress):
+    """Copy the file at *path* to *to_dir*, compressing or decompressing it
+    as indicated by *compress*. Return the path of the copy.
+    """
+    import os
+    import shutil
+    from os.path import basename, join
+
+    name = basename(path)
+    is_compressed = name.endswith(COMPRESSED_SUFFIX)
+
+    if is_compressed == compress:
+        shutil.copy2(path, join(to_dir, name))
+        return join(to_dir, name)
+
+    if compress:
+        to_path = join(to_dir, name + COMPRESSED_SUFFIX)
+    else:
+        to_path = join(to_dir, name[:-len(COMPRESSED_SUFFIX)])
+
+    with open(path, "rb") as inf:
+        data = inf.read()
+
+    with open(to_path, "wb") as outf:
+        outf.write(_compress(data) if compress else _decompress(data))
+
+    shutil.copymode(path, to_path)
+    if os.path.dirname(path) == to_dir:
+        os.unlink(path)
+
+    return to_path
+
+
+def _copy_entry(from_dir, to_dir, compress_artifacts=False):
+    import os
+    import shutil
+    from os.path import join
+
+    # the info file marks the entry as complete, so it goes last
+    for fn in sorted(os.listdir(from_dir), key=lambda fn: fn == "info"):
+        if fn == "info":
+            shutil.copy2(join(from_dir, fn), join(to_dir, fn))
+        else:
+            _copy_file(join(from_dir, fn), to_dir, compress_artifacts)
+
+
+def _publish_entry(temp_dir, entry_dir):
+    """Atomically make the entry built in *temp_dir* available as
+    *entry_dir*, replacing a stale one.
+    """
+    import os
+    import shutil
+    from os.path import basename, dirname, join
+    from tempfile import mkdtemp
+
+    try:
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        # Readers do not take the lock, so the stale entry is moved out of
+        # the way as a whole before it is erased.
+        stale_dir = mkdtemp(prefix="tmp-", dir=dirname(entry_dir))
+        try:
+            os.rename(entry_dir, join(stale_dir, basename(entry_dir)))
+        except OSError:
+            pass
+        shutil.rmtree(stale_dir, ignore_errors=True)
+
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # another process just published it
+            _erase_dir(temp_dir)
+
+
+def _migrate_v5_entry(cache_dir, hex_checksum, ext_name, source_string,
+        source_is_binary):
+    """Move a valid entry for *hex_checksum* of the v5 layout, in
+    *cache_dir* or the former default cache directory, to the current
+    layout. Return the path of the stored file, or *None*. The caller holds
+    the entry's lock.
+    """
+    import os
+    import shutil
+    from os.path import basename, dirname, getmtime, join
+    from tempfile import mkdtemp
+    from time import sleep
+
+    v5_dirs = [join(cache_dir, hex_checksum)]
+    if cache_dir == _get_default_cache_dir():
+        v5_dirs.append(join(_get_default_cache_dir(5), hex_checksum))
+
+    entry_dir = _get_entry_dir(cache_dir, hex_checksum)
+    for v5_dir in v5_dirs:
+        stored_file = _find_entry(v5_dir, ext_name, source_string,
+                source_is_binary, False)
+        if stored_file is None:
+            continue
+
+        info = _load_info(join(v5_dir, "info"))
+
+        temp_dir = mkdtemp(prefix="tmp-", dir=dirname(entry_dir))
+        try:
+            stored_file = _copy_file(stored_file, temp_dir,
+                    _get_artifact_compression())
+            _write_info(temp_dir, _SourceInfo(
+                    dependencies=info.dependencies,
+                    source_name=info.source_name,
+                    source_string=list(source_string),
+                    created=getmtime(join(v5_dir, "info"))))
+        except:
+            _erase_dir(temp_dir)
+            raise
+
+        _publish_entry(temp_dir, entry_dir)
+
+        # Processes of older versions hold the lock of the whole cache
+        # while using its entries. If it stays busy, the old entry is left
+        # in place, which is harmless.
+        v5_lock_file = join(dirname(v5_dir), "lock")
+        for attempt in range(10):
+            try:
+                fd = os.open(v5_lock_file,
+                        os.O_CREAT | os.O_WRONLY | os.O_EXCL)
+            except OSError:
+                sleep(0.1)
+                continue
+
+            try:
+                shutil.rmtree(v5_dir, ignore_errors=True)
+            finally:
+                os.close(fd)
+                os.unlink(v5_lock_file)
+            break
+
+        logger.info("migrated cache entry %s to the current layout."
+                % hex_checksum)
+        return join(entry_dir, basename(stored_file))
+
+    return None
+
+
+def _find_in_cache(cache_dir, hex_checksum, ext_name, source_string,
+        source_is_binary, debug_recompile):
+    """Return the path of the file *ext_name* as stored in the valid entry
+    for *hex_checksum* in the writable cache *cache_dir*, migrating it from
+    the v5 layout if necessary, or *None*. The caller holds the entry's
+    lock.
+    """
+    stored_file = _find_entry(_get_entry_dir(cache_dir, hex_checksum),
+            ext_name, source_string, source_is_binary, debug_recompile)
+    if stored_file is None:
+        stored_file = _migrate_v5_entry(cache_dir, hex_checksum, ext_name,
+                source_string, source_is_binary)
+
+    return stored_file
+
+
+_unpack_dir = None
+
+
+def _get_unpacked_file(stored_file, hex_checksum):
+    """Return the path of an uncompressed copy of *stored_file*."""
+    if not stored_file.endswith(COMPRESSED_SUFFIX):
+        return stored_file
+
+    global _unpack_dir
+    if _unpack_dir is None:
+        import atexit
+        import shutil
+        from tempfile import mkdtemp
+        _unpack_dir = mkdtemp(prefix="codepy-unpacked-")
+        atexit.register(shutil.rmtree, _unpack_dir, True)
+
+    import os
+    from os.path import join, exists, basename
+    from tempfile import mkdtemp
+
+    unpacked_file = join(_unpack_dir, hex_checksum,
+            basename(stored_file)[:-len(COMPRESSED_SUFFIX)])
+    if not exists(unpacked_file):
+        _make_dirs(join(_unpack_dir, hex_checksum))
+        temp_dir = mkdtemp(dir=_unpack_dir)
+        os.rename(_copy_file(stored_file, temp_dir, compress=False),
+                unpacked_file)
+        os.rmdir(temp_dir)
+
+    return unpacked_file
+
+# }}}
+
+
+# {{{ access recording
+
+_record_accesses = None
+
+
+def set_access_recording(enabled):
+    """Make :func:`compile_from_string` log its hits and misses in the cache
+    directory if *enabled*, for the statistics shown by :mod:`codepy.cache`.
+    If *enabled* is *None*, the environment variable
+    :envvar:`CODEPY_CACHE_RECORD_ACCESSES` decides. Disabled by default.
+
+    Accesses are written in batches, at the latest when the process exits.
+    """
+    global _record_accesses
+    _record_accesses = enabled
+
+
+def _get_access_recording():
+    import os
+
+    if _record_accesses is not None:
+        return _record_accesses
+    return os.environ.get("CODEPY_CACHE_RECORD_ACCESSES", "0") not in [
+            "", "0", "no", "false"]
+
+
+# Accesses are written in batches, so that hits, especially in the fast
+# tier, do not each cost a write to a cache directory that may be on a
+# network file system. A batch is written once it has this many lines, or
+# once its first line is this many seconds old.
+ACCESS_BATCH_SIZE = 64
+ACCESS_BATCH_AGE = 10
+
+_access_lock = threading.Lock()
+_pending_accesses = {}
+_first_pending_access = None
+_access_flush_registered = False
+
+
+def _record_access(cache_dir, hex_checksum, hit):
+    if not cache_dir or not _get_access_recording():
+        return
+
+    from time import time
+    global _first_pending_access, _access_flush_registered
+
+    now = time()
+    line = "%d %s %s\n" % (now, "hit" if hit else "miss", hex_checksum)
+    with _access_lock:
+        if not _access_flush_registered:
+            import atexit
+            atexit.register(_flush_accesses)
+            _access_flush_registered = True
+        if not _pending_accesses:
+            _first_pending_access = now
+
+        lines = _pending_accesses.setdefault(cache_dir, [])
+        lines.append(line)
+        flush = (len(lines) >= ACCESS_BATCH_SIZE
+                or now - _first_pending_access >= ACCESS_BATCH_AGE)
+
+    if flush:
+        _flush_accesses()
+
+
+def _flush_accesses():
+    """Write the accesses recorded by this process to their cache
+    directories.
+    """
+    import os
+    from os.path import join
+    global _pending_accesses
+
+    with _access_lock:
+        pending = _pending_accesses
+        _pending_accesses = {}
+
+    for cache_dir, lines in pending.items():
+        # writes shorter than PIPE_BUF are appended atomically
+        data = "".join(lines).encode("ascii")
+        try:
+            fd = os.open(join(cache_dir, "accesses"),
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.warning("could not record cache accesses: %s" % e)
+
+# }}}
+
+
+# {{{ negative cache
+
+_negative_cache_ttl = None
+
+
+def set_negative_cache_ttl(ttl):
+    """Make :func:`compile_from_string` remember failed builds for *ttl*
+    seconds in the cache directory, and raise the same :exc:`CompileError`
+    for them again during that time without running the compiler, so that
+    code that cannot be built is not built again by each process using the
+    cache. If *ttl* is *None*, the environment variable
+    :envvar:`CODEPY_NEGATIVE_CACHE_TTL` is used, if set. By default, and
+    if *ttl* is 0, failures are not remembered.
+
+    See also :func:`clear_negative_cache`.
+    """
+    global _negative_cache_ttl
+    _negative_cache_ttl = ttl
+
+
+def _get_negative_cache_ttl():
+    import os
+
+    if _negative_cache_ttl is not None:
+        return _negative_cache_ttl
+    return float(os.environ.get("CODEPY_NEGATIVE_CACHE_TTL", 0))
+
+
+def _check_failure(cache_dir, hex_checksum):
+    """Raise the :exc:`CompileError` recorded for *hex_checksum* in
+    *cache_dir*, if it has not expired.
+    """
+    ttl = _get_negative_cache_ttl()
+    if not ttl:
+        return
+
+    from os.path import join
+    from time import time
+    from six.moves.cPickle import load
+
+    try:
+        with open(join(cache_dir, "failures", hex_checksum), "rb") as inf:
+            failed_at, message, diagnostics = load(inf)
+    except (IOError, EOFError, ValueError):
+        return
+
+    age = time() - failed_at
+    if 0 <= age < ttl:
+        logger.info("not recompiling %s, which failed %.0f s ago."
+                % (hex_checksum, age))
+        raise CompileError(message, diagnostics=diagnostics)
+
+
+def _record_failure(cache_dir, hex_checksum, error):
+    from codepy import CompileLimitError
+
+    ttl = _get_negative_cache_ttl()
+    # exceeding the limits may be due to load at the time
+    if not ttl or isinstance(error, CompileLimitError):
+        return
+
+    import os
+    from os.path import join
+    from tempfile import mkstemp
+    from time import time
+    from six.moves.cPickle import dump
+
+    failures_dir = join(cache_dir, "failures")
+    _make_dirs(failures_dir)
+
+    fd, temp_path = mkstemp(dir=failures_dir)
+    with os.fdopen(fd, "wb") as outf:
+        dump((time(), str(error), getattr(error, "diagnostics", None)), outf)
+    os.rename(temp_path, join(failures_dir, hex_checksum))
+
+
+def clear_negative_cache(cache_dir=None):
+    """Forget the failed builds remembered in *cache_dir* (see
+    :func:`set_negative_cache_ttl`), by default the default cache directory
+    of :func:`compile_from_string`. As there, *cache_dir* may be a list of
+    layers, of which the failures are remembered in the writable one.
+    """
+    import shutil
+    from os.path import join
+
+    cache_dir = _get_base_layers(cache_dir)[1]
+    if cache_dir is None:
+        cache_dir = _get_default_cache_dir()
+
+    shutil.rmtree(join(cache_dir, "failures"), ignore_errors=True)
+
+# }}}
+
+
+# {{{ fast cache tier
+
+_fast_cache_dir = None
+
+
+def set_fast_cache_dir(fast_cache_dir):
+    """Keep copies of the cache entries used by :func:`compile_from_string`
+    in *fast_cache_dir*, a directory on a fast local file system such as
+    :file:`/dev/shm`, so that modules found there are loaded without
+    touching the (possibly network-mounted) cache directory. Entries
+    missing there are copied from the cache directory, or built in
+    *fast_cache_dir* and written to the cache directory in the background
+    (see :func:`wait_for_cache_writes`).
+
+    If *fast_cache_dir* is *None*, the environment variable
+    :envvar:`CODEPY_FAST_CACHE_DIR` is used, if set. *False* disables the
+    fast tier.
+    """
+    global _fast_cache_dir
+    _fast_cache_dir = fast_cache_dir
+
+
+def _get_fast_cache_dir():
+    import os
+
+    fast_cache_dir = _fast_cache_dir
+    if fast_cache_dir is None:
+        fast_cache_dir = os.environ.get("CODEPY_FAST_CACHE_DIR") or None
+    if not fast_cache_dir:
+        return None
+
+    _make_dirs(fast_cache_dir)
+    return fast_cache_dir
+
+
+def _compile_with_fast_tier(toolchain, name, source_string, source_name,
+        cache_dir, fast_cache_dir, hex_checksum, ext_name, debug,
+        debug_recompile, object, source_is_binary):
+    """Implement a miss in the fast tier for :func:`compile_from_string`.
+    Return a tuple *(ext_file, recompiled)*.
+    """
+    from os.path import dirname, join
+    from tempfile import mkdtemp
+
+    entry_dir = _get_entry_dir(fast_cache_dir, hex_checksum)
+    _make_dirs(dirname(entry_dir))
+
+    # processes sharing the fast tier build each entry only once
+    fast_cleanup_m = CleanupManager()
+    try:
+        # Variable 'fast_lock_m' is used for no other purpose than
+        # to keep lock manager alive.
+        fast_lock_m = EntryLockManager(fast_cleanup_m, entry_dir)  # noqa
+
+        ext_file = _find_entry(entry_dir, ext_name, source_string,
+                source_is_binary, False)
+        if ext_file is not None:
+            _record_access(cache_dir, hex_checksum, True)
+            return ext_file, False
+
+        temp_dir = mkdtemp(prefix="tmp-", dir=dirname(entry_dir))
+        try:
+            cleanup_m = CleanupManager()
+            try:
+                # Variable 'lock_m' is used for no other purpose than
+                # to keep lock manager alive.
+                lock_m = EntryLockManager(cleanup_m,  # noqa
+                        _get_entry_dir(cache_dir, hex_checksum))
+
+                cached_file = _find_in_cache(cache_dir, hex_checksum,
+                        ext_name, source_string, source_is_binary,
+                        debug_recompile)
+                if cached_file is not None:
+                    _copy_entry(dirname(cached_file), temp_dir)
+            finally:
+                cleanup_m.clean_up()
+
+            if cached_file is None:
+                _check_failure(cache_dir, hex_checksum)
+
+                if debug_recompile:
+                    logger.info("recompiling in fast cache tier (%s)."
+                            % fast_cache_dir)
+
+                try:
+                    _build_entry(toolchain, temp_dir, ext_name, source_string,
+                            source_name, debug, object, source_is_binary)
+                except CompileError as e:
+                    _record_failure(cache_dir, hex_checksum, e)
+                    raise
+        except:
+            _erase_dir(temp_dir)
+            raise
+
+        _publish_entry(temp_dir, entry_dir)
+    finally:
+        fast_cleanup_m.clean_up()
+
+    _record_access(cache_dir, hex_checksum, cached_file is not None)
+    if cached_file is None:
+        _submit_cache_write(entry_dir, cache_dir, hex_checksum)
+
+    return join(entry_dir, ext_name), cached_file is None
+
+
+_cache_writer = None
+
+
+def _submit_cache_write(entry_dir, cache_dir, hex_checksum):
+    global _cache_writer
+    if _cache_writer is None:
+        import atexit
+        from concurrent.futures import ThreadPoolExecutor
+        _cache_writer = ThreadPoolExecutor(max_workers=1)
+        atexit.register(wait_for_cache_writes)
+
+    _cache_writer.submit(_write_cache_entry, entry_dir, cache_dir, hex_checksum)
+
+
+def _write_cache_entry(fast_entry_dir, cache_dir, hex_checksum):
+    from os.path import dirname
+    from tempfile import mkdtemp
+
+    entry_dir = _get_entry_dir(cache_dir, hex_checksum)
+
+    cleanup_m = CleanupManager()
+    try:
+        # Variable 'lock_m' is used for no other purpose than
+        # to keep lock manager alive.
+        lock_m = EntryLockManager(cleanup_m, entry_dir)  # noqa
+
+        temp_dir = mkdtemp(prefix="tmp-", dir=dirname(entry_dir))
+        try:
+            _copy_entry(fast_entry_dir, temp_dir, _get_artifact_compression())
+        except:
+            _erase_dir(temp_dir)
+            raise
+
+        _publish_entry(temp_dir, entry_dir)
+    except Exception as e:
+        cleanup_m.error_clean_up()
+        logger.warning("could not write cache entry %s to %s: %s"
+                % (hex_checksum, cache_dir, e))
+    finally:
+        cleanup_m.clean_up()
+
+
+def wait_for_cache_writes():
+    """Wait until the entries built in the fast tier (see
+    :func:`set_fast_cache_dir`) have been written to the cache directory.
+    This happens automatically when the interpreter exits.
+    """
+    global _cache_writer
+    if _cache_writer is not None:
+        _cache_writer.shutdown(wait=True)
+        _cache_writer = None
+
+# }}}
+
+
+# {{{ user keys
+
+def _get_key_digest(toolchain, name, key, object):
+    """Return a digest of the user *key* of the module *name* and the ABI of
+    *toolchain*, or *None* if the compiler cannot be run.
+    """
+    import hashlib
+    from pytools.prefork import ExecError
+
+    try:
+        abi_id = toolchain.abi_id()
+    except (ExecError, RuntimeError):
+        return None
+
+    checksum = hashlib.md5()
+    checksum.update(repr((name, key, bool(object))).encode("utf-8"))
+    checksum.update(str(abi_id).encode("utf-8"))
+    return checksum.hexdigest()
+
+
+def _get_key_file(cache_dir, key_digest):
+    from os.path import join
+    return join(cache_dir, "keys", key_digest[:2], key_digest)
+
+
+def _compile_with_key(toolchain, name, source_string, source_name, cache_dir,
+        debug, debug_recompile, object, source_is_binary, key, aot):
+    """Implement *key* for :func:`compile_from_string`."""
+    import os
+    from os.path import dirname
+    from tempfile import mkstemp
+
+    base_layers, writable_cache_dir = _get_base_layers(cache_dir)
+    if writable_cache_dir is None:
+        writable_cache_dir = _get_default_cache_dir()
+
+    from codepy.aot import _get_record_file
+
+    key_digest = None
+    if writable_cache_dir is not False and (
+            not aot or _get_record_file() is None):
+        # recording for ahead-of-time builds needs the sources
+        key_digest = _get_key_digest(toolchain, name, key, object)
+
+    if key_digest is not None:
+        # keys may be published in any layer, as entries may
+        hex_checksums = []
+        for layer in base_layers + [writable_cache_dir]:
+            try:
+                with open(_get_key_file(layer, key_digest)) as inf:
+                    hex_checksum = inf.read().strip()
+            except IOError:
+                continue
+            if hex_checksum and hex_checksum not in hex_checksums:
+                hex_checksums.append(hex_checksum)
+
+        ext_name = name + (toolchain.o_ext if object else toolchain.so_ext)
+        fast_cache_dir = _get_fast_cache_dir()
+
+        for hex_checksum in hex_checksums:
+            # entries are published atomically, so that none of these
+            # lookups need a lock
+            for layer in (
+                    ([fast_cache_dir] if fast_cache_dir is not None else [])
+                    + [writable_cache_dir] + base_layers):
+                stored_file = _find_entry(_get_entry_dir(layer, hex_checksum),
+                        ext_name, None, source_is_binary, False)
+                if stored_file is not None:
+                    _record_access(writable_cache_dir, hex_checksum, True)
+                    mod_name = "codepy.temp.%s.%s" % (hex_checksum, name)
+                    return (hex_checksum, mod_name,
+                            _get_unpacked_file(stored_file, hex_checksum),
+                            False)
+
+    if callable(source_string):
+        source_string = source_string()
+
+    result = compile_from_string(toolchain, name, source_string, source_name,
+            cache_dir, debug, None, debug_recompile, object, source_is_binary,
+            aot=aot)
+
+    if key_digest is not None:
+        key_file = _get_key_file(writable_cache_dir, key_digest)
+        _make_dirs(dirname(key_file))
+        fd, temp_path = mkstemp(dir=dirname(key_file))
+        with os.fdopen(fd, "w") as outf:
+            outf.write(result[0])
+        os.rename(temp_path, key_file)
+
+    return result
+
+# }}}
+
+
 def compile_from_string(toolchain, name, source_string,
                         source_name=["module.cpp"], cache_dir=None,
                         debug=False, wait_on_error=None, debug_recompile=True,
-                        object=False, source_is_binary=False):
+                        object=False, source_is_binary=False, pgo=False,
+                        key=None, aot=True):
     """Returns a tuple: mod_name, file_name, recompiled.
     mod_name is the name of the module represented by a compiled object,
     file_name is the name of the compiled object, which can be built from the
@@ -236,9 +1614,19 @@ def compile_from_string(toolchain, name, source_string,
     versions as well as versions of include files are taken into account when
     examining the cache. If *cache_dir* is ``None``, a default location is
     assumed. If it is ``False``, no caching is perfomed.  Proper locking is
-    performed on the cache directory.  Simultaneous use of the cache by
-    multiple processes works as expected, but may lead to delays because of
-    locking.
+    performed on each cache entry.  Simultaneous use of the cache by
+    multiple processes works as expected, but may lead to delays while
+    another process builds the same code. Sources and metadata are stored
+    compressed, and built files as well if enabled by
+    :func:`set_artifact_compression`. Caches of the previous layout are
+    migrated as their entries are used.
+
+    *cache_dir* may also be a list of cache directories. All but the last
+    one are read-only layers, such as caches built into a container image,
+    which are searched first, without any locking or writing. The last one
+    is used as described above. Further read-only layers may be given in the
+    environment variable :envvar:`CODEPY_CACHE_BASE_LAYERS`, separated by
+    :data:`os.pathsep`.
 
     The code in *source_string* will be saved to a temporary file named
     *source_name* if it needs to be compiled.
@@ -255,192 +1643,177 @@ def compile_from_string(toolchain, name, source_string,
 
     If *source_is_binary*, the source string is a compile object file and
     should be treated as binary for read/write purposes
-    """
-
-    # first ensure that source strings and names are lists
-    if isinstance(source_string, six.string_types) \
-            or (source_is_binary and isinstance(source_string, six.binary_type)):
-        source_string = [source_string]
 
-    if isinstance(source_name, str):
-        source_name = [source_name]
+    If *pgo* is ``True``, profile-guided optimization is used (see
+    :meth:`codepy.toolchain.Toolchain.with_profile_generate`). As long as
+    no profiles have been collected, a variant instrumented to collect them
+    is built, which writes them when the process using it exits. Once there
+    are profiles, a variant optimized according to them is built, keyed by
+    the source and a digest of the profiles, and returned from then on.
+    Toolchains that do not support it build without it, with a warning.
+
+    Unless *aot* is ``False`` or *pgo* is ``True``, extension modules are
+    first looked up in the installed packages built ahead of time by
+    :mod:`codepy.aot`, which need no compiler, and recorded for them.
+
+    If a time to live is set with :func:`set_negative_cache_ttl`, failed
+    builds are remembered in *cache_dir* and fail again without running the
+    compiler until it expires.
+
+    If a fast cache tier is set with :func:`set_fast_cache_dir`, it is
+    searched before all other layers, without locking, and entries are
+    built there and written to *cache_dir* in the background.
+
+    *key*, if given, is a stable description of the sources, such as a
+    tuple of the parameters they are generated from, with a :func:`repr`
+    that does not change between runs. The cache entry built for it is
+    remembered, so that later calls with the same *key*, *name* and
+    toolchain find it without looking at the sources, which may then be
+    given as a callable returning *source_string*, called only if the
+    entry needs to be built. *key* is ignored with *pgo*.
+    """
 
     if wait_on_error is not None:
         from warnings import warn
         warn("wait_on_error is deprecated and has no effect",
                 DeprecationWarning)
 
-    import os
-    from os.path import join
+    if pgo and not _supports_pgo(toolchain):
+        from warnings import warn
+        warn("%s does not support profile-guided optimization, building "
+                "without it" % type(toolchain).__name__)
+        pgo = False
 
-    if cache_dir is None:
-        import appdirs
-        import sys
-        cache_dir = join(
-                appdirs.user_cache_dir("codepy", "codepy"),
-                "codepy-compiler-cache-v5-py%s" % (
-                    ".".join(str(i) for i in sys.version_info),))
+    if key is not None and not pgo:
+        return _compile_with_key(toolchain, name, source_string, source_name,
+                cache_dir, debug, debug_recompile, object, source_is_binary,
+                key, aot)
 
-        try:
-            os.makedirs(cache_dir)
-        except OSError as e:
-            from errno import EEXIST
-            if e.errno != EEXIST:
-                raise
+    if callable(source_string):
+        source_string = source_string()
 
-    def get_file_md5sum(fname):
-        try:
-            import hashlib
-            checksum = hashlib.md5()
-        except ImportError:
-            # for Python << 2.5
-            import md5
-            checksum = md5.new()
-
-        inf = open(fname, "rb")
-        checksum.update(inf.read())
-
-        inf.close()
-        return checksum.hexdigest()
-
-    def get_dep_structure(source_paths):
-        deps = list(toolchain.get_dependencies(source_paths))
-        deps.sort()
-        return [(dep, os.stat(dep).st_mtime, get_file_md5sum(dep)) for dep in deps
-                if dep not in source_paths]
-
-    def write_source(name):
-        for i, source in enumerate(source_string):
-            outf = open(name[i], "w" if not source_is_binary else "wb")
-            outf.write(source)
-            outf.close()
+    # ensure that source strings and names are lists
+    if isinstance(source_string, six.string_types) \
+            or (source_is_binary and isinstance(source_string, six.binary_type)):
+        source_string = [source_string]
 
-    def calculate_hex_checksum():
-        try:
-            import hashlib
-            checksum = hashlib.md5()
-        except ImportError:
-            # for Python << 2.5
-            import md5
-            checksum = md5.new()
-
-        for source in source_string:
-            if source_is_binary:
-                checksum.update(source)
-            else:
-                checksum.update(source.encode('utf-8'))
-        checksum.update(str(toolchain.abi_id()).encode('utf-8'))
-        return checksum.hexdigest()
+    if isinstance(source_name, str):
+        source_name = [source_name]
 
-    def load_info(info_path):
-        from six.moves.cPickle import load
+    if aot and not pgo and not object and not source_is_binary:
+        from codepy.aot import (record_module, find_aot_module, get_aot_key,
+                _get_toolchain_attributes)
+        record_module(toolchain, name, source_string, source_name)
 
-        try:
-            info_file = open(info_path, 'rb')
-        except IOError:
-            raise _InvalidInfoFile()
+        ext_file = find_aot_module(toolchain, name, source_string)
+        if ext_file is not None:
+            aot_key = get_aot_key(name, source_string,
+                    _get_toolchain_attributes(toolchain))
+            mod_name = "codepy.temp.%s.%s" % (aot_key, name)
+            return aot_key, mod_name, ext_file, False
 
-        try:
-            return load(info_file)
-        except EOFError:
-            raise _InvalidInfoFile()
-        finally:
-            info_file.close()
-
-    def check_deps(deps):
-        for name, date, md5sum in deps:
-            try:
-                possibly_updated = os.stat(name).st_mtime != date
-            except OSError as e:
-                if debug_recompile:
-                    logger.info("recompiling because dependency %s is "
-                    "inaccessible (%s)." % (name, e))
-                return False
-            else:
-                if possibly_updated and md5sum != get_file_md5sum(name):
-                    if debug_recompile:
-                        logger.info("recompiling because dependency %s was "
-                        "updated." % name)
-                    return False
-
-        return True
+    from os.path import basename, dirname, join
+    from tempfile import mkdtemp
 
-    def check_source(source_path):
-        valid = True
-        for i, path in enumerate(source_path):
-            source = source_string[i]
-            try:
-                src_f = open(path, "r" if not source_is_binary else "rb")
-            except IOError:
-                if debug_recompile:
-                    logger.info("recompiling because cache directory does "
-                            "not contain source file '%s'." % path)
-                return False
+    base_layers, cache_dir = _get_base_layers(cache_dir)
 
-            valid = valid and src_f.read() == source
-            src_f.close()
+    if object:
+        suffix = toolchain.o_ext
+    else:
+        suffix = toolchain.so_ext
+
+    fast_cache_dir = None
+    if not pgo:
+        fast_cache_dir = _get_fast_cache_dir()
+
+    if fast_cache_dir is not None or (base_layers and not pgo):
+        hex_checksum = _calculate_hex_checksum(
+                toolchain, source_string, source_is_binary)
+
+    if fast_cache_dir is not None:
+        ext_file = _find_entry(_get_entry_dir(fast_cache_dir, hex_checksum),
+                name+suffix, source_string, source_is_binary, False)
+        if ext_file is not None:
+            _record_access(
+                    cache_dir if cache_dir is not None
+                    else _get_default_cache_dir(),
+                    hex_checksum, True)
+            mod_name = "codepy.temp.%s.%s" % (hex_checksum, name)
+            return hex_checksum, mod_name, ext_file, False
+
+    if base_layers and not pgo:
+        for layer in base_layers:
+            stored_file = _find_in_layer(layer, hex_checksum, name+suffix,
+                    source_string, source_is_binary)
+            if stored_file is not None:
+                mod_name = "codepy.temp.%s.%s" % (hex_checksum, name)
+                return (hex_checksum, mod_name,
+                        _get_unpacked_file(stored_file, hex_checksum), False)
 
-            if not valid:
-                from warnings import warn
-                warn("hash collision in compiler cache")
-        return valid
+    if cache_dir is None:
+        cache_dir = _get_default_cache_dir()
+        _make_dirs(cache_dir)
+
+    if pgo:
+        if cache_dir is False:
+            raise ValueError("profile-guided optimization needs a cache "
+                    "directory")
+
+        return _compile_with_pgo(toolchain, name, source_string, source_name,
+                cache_dir, debug, debug_recompile, object, source_is_binary)
+
+    if fast_cache_dir is not None and cache_dir is not False:
+        ext_file, recompiled = _compile_with_fast_tier(toolchain, name,
+                source_string, source_name, cache_dir, fast_cache_dir,
+                hex_checksum, name+suffix, debug, debug_recompile, object,
+                source_is_binary)
+        mod_name = "codepy.temp.%s.%s" % (hex_checksum, name)
+        return hex_checksum, mod_name, ext_file, recompiled
 
     cleanup_m = CleanupManager()
 
     try:
-        # Variable 'lock_m' is used for no other purpose than
-        # to keep lock manager alive.
-        lock_m = CacheLockManager(cleanup_m, cache_dir)  # noqa
-
-        hex_checksum = calculate_hex_checksum()
+        hex_checksum = _calculate_hex_checksum(
+                toolchain, source_string, source_is_binary)
         mod_name = "codepy.temp.%s.%s" % (hex_checksum, name)
-        if object:
-            suffix = toolchain.o_ext
-        else:
-            suffix = toolchain.so_ext
-
-        mod_cache_dir_m = ModuleCacheDirManager(cleanup_m,
-                join(cache_dir, hex_checksum))
-        info_path = mod_cache_dir_m.sub("info")
-        ext_file = mod_cache_dir_m.sub(name+suffix)
-
-        if mod_cache_dir_m.existed:
-            try:
-                info = load_info(info_path)
-            except _InvalidInfoFile:
-                mod_cache_dir_m.reset()
+        entry_dir = _get_entry_dir(cache_dir, hex_checksum)
 
-                if debug_recompile:
-                    logger.info("recompiling for invalid cache dir (%s)." % (
-                            mod_cache_dir_m.path))
-            else:
-                if check_deps(info.dependencies) and check_source(
-                        [mod_cache_dir_m.sub(x) for x in info.source_name]):
-                    return hex_checksum, mod_name, ext_file, False
-        else:
-            if debug_recompile:
-                logger.info("recompiling for non-existent cache dir (%s)." % (
-                        mod_cache_dir_m.path))
+        # Variable 'lock_m' is used for no other purpose than
+        # to keep lock manager alive.
+        lock_m = EntryLockManager(cleanup_m, entry_dir)  # noqa
 
-        source_paths = [mod_cache_dir_m.sub(source) for source in source_name]
+        stored_file = _find_in_cache(cache_dir, hex_checksum, name+suffix,
+                source_string, source_is_binary, debug_recompile)
+        if stored_file is not None:
+            _record_access(cache_dir, hex_checksum, True)
+            return (hex_checksum, mod_name,
+                    _get_unpacked_file(stored_file, hex_checksum), False)
 
-        write_source(source_paths)
+        if debug_recompile:
+            logger.info("recompiling for non-existent or invalid cache entry "
+                    "(%s)." % entry_dir)
 
-        if object:
-            toolchain.build_object(ext_file, source_paths, debug=debug)
-        else:
-            toolchain.build_extension(ext_file, source_paths, debug=debug)
+        _check_failure(cache_dir, hex_checksum)
 
-        if info_path is not None:
-            from six.moves.cPickle import dump
+        temp_dir = mkdtemp(prefix="tmp-", dir=dirname(entry_dir))
+        try:
+            stored_file = _build_entry(toolchain, temp_dir, name+suffix,
+                    source_string, source_name, debug, object,
+                    source_is_binary, _get_artifact_compression())
+        except CompileError as e:
+            _erase_dir(temp_dir)
+            _record_failure(cache_dir, hex_checksum, e)
+            raise
+        except:
+            _erase_dir(temp_dir)
+            raise
 
-            info_file = open(info_path, "wb")
-            dump(_SourceInfo(
-                dependencies=get_dep_structure(source_paths),
-                source_name=source_name), info_file)
-            info_file.close()
+        _publish_entry(temp_dir, entry_dir)
+        _record_access(cache_dir, hex_checksum, False)
 
-        return hex_checksum, mod_name, ext_file, True
+        stored_file = join(entry_dir, basename(stored_file))
+        return (hex_checksum, mod_name,
+                _get_unpacked_file(stored_file, hex_checksum), True)
     except:
         cleanup_m.error_clean_up()
         raise
@@ -0,0 +1,224 @@
+"""Lazily evaluated array expressions fused into elementwise kernels."""
+
+from __future__ import division
+
+import numpy
+from cgen import dtype_to_ctype
+
+
+class LazyExpression(object):
+    """An elementwise expression over :class:`numpy.ndarray` instances and
+    scalars that is only evaluated when its result is needed.
+
+    Arithmetic on instances records an expression tree. :meth:`evaluate`
+    turns the whole tree into a single
+    :class:`codepy.elementwise.ElementwiseKernel`, which computes the result
+    in one pass without intermediate arrays. Kernels are memoized by the
+    structure of the expression and the dtypes involved, so evaluating an
+    expression of the same shape again reuses the kernel.
+    """
+
+    # make numpy defer to our reflected operators
+    __array_ufunc__ = None
+
+    def __add__(self, other):
+        return BinaryOperation("+", self, other)
+
+    def __radd__(self, other):
+        return BinaryOperation("+", other, self)
+
+    def __sub__(self, other):
+        return BinaryOperation("-", self, other)
+
+    def __rsub__(self, other):
+        return BinaryOperation("-", other, self)
+
+    def __mul__(self, other):
+        return BinaryOperation("*", self, other)
+
+    def __rmul__(self, other):
+        return BinaryOperation("*", other, self)
+
+    def __truediv__(self, other):
+        return BinaryOperation("/", self, other)
+
+    def __rtruediv__(self, other):
+        return BinaryOperation("/", other, self)
+
+    __div__ = __truediv__
+    __rdiv__ = __rtruediv__
+
+    def __neg__(self):
+        return Negation(self)
+
+    def __pos__(self):
+        return self
+
+    def __array__(self, dtype=None, copy=None):
+        result = self.evaluate()
+        if dtype is not None:
+            result = result.astype(dtype)
+        return result
+
+    @property
+    def shape(self):
+        from pytools import single_valued
+        return single_valued(leaf.value.shape
+                for leaf in _get_leaves(self) if leaf.is_vector)
+
+    def fuse(self):
+        """Return a tuple *(arguments, operation, values)*, where *arguments*
+        and *operation* describe an
+        :class:`codepy.elementwise.ElementwiseKernel` writing this expression
+        to its first argument ``result``, and *values* are the arguments
+        to be passed for the leaves of the expression.
+        """
+        from codepy.elementwise import VectorArg, ScalarArg
+
+        leaves = _get_leaves(self)
+        leaf_names = {}
+        arguments = [VectorArg(self.dtype, "result")]
+        values = []
+        for i, leaf in enumerate(leaves):
+            leaf_names[id(leaf.value)] = name = "_x%d" % i
+            if leaf.is_vector:
+                arguments.append(VectorArg(leaf.dtype, name))
+            else:
+                arguments.append(ScalarArg(leaf.dtype, name))
+            values.append(leaf.value)
+
+        operation = "result[i] = %s" % self.generate(leaf_names)
+        return arguments, operation, values
+
+    def evaluate(self, out=None, toolchain=None):
+        """Compute the value of the expression, in *out* if given, and return
+        it.
+        """
+        arguments, operation, values = self.fuse()
+        kernel = _get_fused_kernel(arguments, operation, toolchain)
+
+        if out is None:
+            out = numpy.empty(self.shape, dtype=self.dtype)
+
+        kernel(out, *values)
+        return out
+
+
+class Leaf(LazyExpression):
+    def __init__(self, value):
+        if isinstance(value, numpy.ndarray):
+            if value.ndim == 0:
+                value = value[()]
+            elif not value.flags.c_contiguous:
+                raise ValueError("lazy expressions need contiguous arrays")
+            self.dtype = value.dtype
+        else:
+            self.dtype = numpy.asarray(value).dtype
+
+        self.value = value
+
+    @property
+    def is_vector(self):
+        return isinstance(self.value, numpy.ndarray)
+
+    @property
+    def promotion_key(self):
+        if isinstance(self.value, (numpy.ndarray, numpy.generic)):
+            return self.dtype
+        else:
+            # Python scalars take part in type promotion by value
+            return self.value
+
+    def generate(self, leaf_names):
+        name = leaf_names[id(self.value)]
+        if self.is_vector:
+            return "%s[i]" % name
+        else:
+            return name
+
+
+class BinaryOperation(LazyExpression):
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = as_lazy(left)
+        self.right = as_lazy(right)
+
+        self.dtype = numpy.result_type(
+                self.left.promotion_key, self.right.promotion_key)
+        if operator == "/" and self.dtype.kind in "biu":
+            self.dtype = numpy.dtype(numpy.float64)
+
+    @property
+    def promotion_key(self):
+        return self.dtype
+
+    def generate(self, leaf_names):
+        ctype = dtype_to_ctype(self.dtype)
+        return "((%s) %s %s (%s) %s)" % (
+                ctype, self.left.generate(leaf_names),
+                self.operator,
+                ctype, self.right.generate(leaf_names))
+
+
+class Negation(LazyExpression):
+    def __init__(self, child):
+        self.child = as_lazy(child)
+        self.dtype = self.child.dtype
+
+    @property
+    def promotion_key(self):
+        return self.child.promotion_key
+
+    def generate(self, leaf_names):
+        return "(-%s)" % self.child.generate(leaf_names)
+
+
+def as_lazy(value):
+    """Return *value* as a :class:`LazyExpression`, wrapping arrays and
+    scalars as necessary.
+    """
+    if isinstance(value, LazyExpression):
+        return value
+    return Leaf(value)
+
+
+def _get_leaves(expr):
+    """Return the leaves of *expr* in order of first appearance, with
+    repeated occurrences of the same value removed.
+    """
+    result = []
+    seen = set()
+
+    def visit(node):
+        if isinstance(node, Leaf):
+            if id(node.value) not in seen:
+                seen.add(id(node.value))
+                result.append(node)
+        elif isinstance(node, BinaryOperation):
+            visit(node.left)
+            visit(node.right)
+        elif isinstance(node, Negation):
+            visit(node.child)
+        else:
+            raise TypeError("unexpected expression node: %r" % node)
+
+    visit(expr)
+    return result
+
+
+_fused_kernel_cache = {}
+
+
+def _get_fused_kernel(arguments, operation, toolchain):
+    key = (operation,
+            tuple((type(arg).__name__, arg.dtype) for arg in arguments),
+            repr(toolchain))
+
+    try:
+        return _fused_kernel_cache[key]
+    except KeyError:
+        from codepy.elementwise import ElementwiseKernel
+        result = ElementwiseKernel(arguments, operation,
+                name="fused_kernel", toolchain=toolchain)
+        _fused_kernel_cache[key] = result
+        return result
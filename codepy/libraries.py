@@ -118,10 +118,8 @@ def add_boost_numeric_bindings(toolchain):
 
 def add_numpy(toolchain):
     def get_numpy_incpath():
-        from imp import find_module
-        file, pathname, descr = find_module("numpy")
-        from os.path import join
-        return join(pathname, "core", "include")
+        import numpy
+        return numpy.get_include()
 
     toolchain.add_library("numpy", [get_numpy_incpath()], [], [])
 
@@ -0,0 +1,596 @@
+"""A local server running compiler invocations on behalf of other processes.
+
+Starting a compiler from a process with a large address space means forking
+that process, which is slow and may fail for lack of memory. Once
+:func:`start_compile_server` or :func:`connect_compile_server` has been
+called (or if :envvar:`CODEPY_COMPILE_SERVER` names the socket of a running
+server), the toolchains in :mod:`codepy.toolchain` send their compiler
+invocations to a small server process over a Unix socket instead. The server
+starts them with :func:`os.posix_spawn`, most urgent first, and sends their
+output back while they run.
+
+The server can also be run directly as ``python -m codepy.server``.
+"""
+
+from __future__ import division, print_function
+
+from contextlib import contextmanager
+import threading
+
+from codepy import CompileLimitError
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Priorities of compiler invocations, lower values running first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PREFETCH = 10
+
+
+_priority = threading.local()
+
+
+@contextmanager
+def compile_priority(priority):
+    """A context manager running the compiler invocations made by the
+    current thread within the block at *priority*, e.g.
+    :data:`PRIORITY_PREFETCH` for code that is not needed yet.
+    """
+    old_priority = getattr(_priority, "value", PRIORITY_INTERACTIVE)
+    _priority.value = priority
+    try:
+        yield
+    finally:
+        _priority.value = old_priority
+
+
+def get_default_socket_path():
+    import getpass
+    from tempfile import gettempdir
+    from os.path import join
+    return join(gettempdir(),
+            "codepy-compile-server-%s" % getpass.getuser(), "socket")
+
+
+# {{{ protocol
+
+# Messages consist of a JSON header, which states the size of a binary
+# payload following it. Requests are headers with a "type"; the server
+# answers a "run" request with any number of "stdout" and "stderr" messages
+# carrying the output as their payload, followed by either an "exit"
+# message with the "status" of the process or a "timeout" message.
+
+def _send_message(sock, header, payload=b""):
+    import json
+    import struct
+    header = dict(header, payload_size=len(payload))
+    data = json.dumps(header).encode("utf-8")
+    sock.sendall(struct.pack("!I", len(data)) + data + payload)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_message(sock):
+    import json
+    import struct
+    size, = struct.unpack("!I", _recv_exactly(sock, 4))
+    header = json.loads(_recv_exactly(sock, size).decode("utf-8"))
+    return header, _recv_exactly(sock, header["payload_size"])
+
+
+def _check_socket_dir(socket_dir):
+    """Raise :exc:`RuntimeError` unless *socket_dir* is a directory (and not
+    a symbolic link to one) owned by the current user and accessible to
+    nobody else, as anybody able to write to it could take the place of
+    the server.
+    """
+    import os
+    import stat
+
+    st = os.lstat(socket_dir)
+    if not stat.S_ISDIR(st.st_mode):
+        raise RuntimeError("compile server socket directory '%s' "
+                "is not a directory" % socket_dir)
+    if st.st_uid != os.getuid():
+        raise RuntimeError("compile server socket directory '%s' "
+                "is not owned by the current user" % socket_dir)
+    if stat.S_IMODE(st.st_mode) != 0o700:
+        raise RuntimeError("compile server socket directory '%s' "
+                "has mode %o instead of 700"
+                % (socket_dir, stat.S_IMODE(st.st_mode)))
+
+# }}}
+
+
+# {{{ server
+
+class _Job(object):
+    def __init__(self, conn, request):
+        self.conn = conn
+        self.request = request
+
+    def run(self):
+        import os
+        import selectors
+        import signal
+        from time import time
+
+        request = self.request
+        cmdline = list(request["cmdline"])
+        cwd = request.get("cwd")
+        memory = request.get("memory")
+        if cwd is not None or memory is not None:
+            # posix_spawn can neither change directories nor set limits by
+            # itself. The limit is set before the compiler driver starts,
+            # so that the processes it starts inherit it.
+            script = []
+            if memory is not None:
+                script.append("ulimit -v %d" % (memory // 1024))
+            if cwd is not None:
+                script.append('cd "$0"')
+            script.append('exec "$@"')
+            cmdline = ["/bin/sh", "-c", " && ".join(script),
+                    cwd if cwd is not None else "sh"] + cmdline
+
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        devnull = os.open(os.devnull, os.O_RDONLY)
+
+        try:
+            pid = os.posix_spawnp(cmdline[0], cmdline, request["env"],
+                    file_actions=[
+                        (os.POSIX_SPAWN_DUP2, devnull, 0),
+                        (os.POSIX_SPAWN_DUP2, out_w, 1),
+                        (os.POSIX_SPAWN_DUP2, err_w, 2),
+                        ],
+                    # so that the processes started by the compiler driver
+                    # can be terminated along with it
+                    setsid=True)
+        except OSError as e:
+            for fd in [out_r, out_w, err_r, err_w]:
+                os.close(fd)
+            _send_message(self.conn, {"type": "error", "message": str(e)})
+            return
+        finally:
+            os.close(devnull)
+
+        os.close(out_w)
+        os.close(err_w)
+
+        timeout = request.get("timeout")
+        deadline = None if timeout is None else time() + timeout
+        timed_out = False
+
+        sel = selectors.DefaultSelector()
+        sel.register(out_r, selectors.EVENT_READ, "stdout")
+        sel.register(err_r, selectors.EVENT_READ, "stderr")
+
+        try:
+            while sel.get_map():
+                if deadline is None:
+                    wait = None
+                else:
+                    wait = deadline - time()
+                    if wait <= 0:
+                        os.killpg(pid, signal.SIGKILL)
+                        timed_out = True
+                        break
+
+                for key, events in sel.select(wait):
+                    data = os.read(key.fd, 1 << 16)
+                    if data:
+                        _send_message(self.conn, {"type": key.data}, data)
+                    else:
+                        sel.unregister(key.fd)
+                        os.close(key.fd)
+        finally:
+            for key in list(sel.get_map().values()):
+                os.close(key.fd)
+            sel.close()
+
+            _, status = os.waitpid(pid, 0)
+
+        if timed_out:
+            _send_message(self.conn, {"type": "timeout", "seconds": timeout})
+        elif os.WIFSIGNALED(status):
+            _send_message(self.conn,
+                    {"type": "exit", "status": -os.WTERMSIG(status)})
+        else:
+            _send_message(self.conn,
+                    {"type": "exit", "status": os.WEXITSTATUS(status)})
+
+
+class CompileServer(object):
+    """Accept compiler invocations on the Unix socket *socket_path* and run
+    up to *max_jobs* of them at a time, by default as many as there are
+    CPUs. If *idle_timeout* is not *None*, :meth:`serve_forever` returns
+    once no request has arrived for that many seconds.
+
+    The directory containing the socket is created accessible only to the
+    user running the server. If it exists but is accessible to anybody
+    else, the server refuses to start, as do clients to connect.
+    """
+
+    def __init__(self, socket_path=None, max_jobs=None, idle_timeout=None):
+        if socket_path is None:
+            socket_path = get_default_socket_path()
+        if max_jobs is None:
+            from multiprocessing import cpu_count
+            max_jobs = cpu_count()
+
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+        self.idle_timeout = idle_timeout
+
+        from six.moves.queue import PriorityQueue
+        from itertools import count
+        self.queue = PriorityQueue()
+        self.sequence = count()
+
+        self.shutdown_requested = threading.Event()
+
+    def _handle_connection(self, conn):
+        queued = False
+        try:
+            while True:
+                try:
+                    request, _ = _recv_message(conn)
+                except EOFError:
+                    break
+
+                if request["type"] == "run":
+                    # ties are broken by order of arrival
+                    self.queue.put((request["priority"], next(self.sequence),
+                        _Job(conn, request)))
+                    # the job answers and closes the connection
+                    queued = True
+                    break
+                elif request["type"] == "ping":
+                    _send_message(conn, {"type": "pong"})
+                elif request["type"] == "shutdown":
+                    self.shutdown_requested.set()
+                    break
+                else:
+                    _send_message(conn, {"type": "error", "message":
+                        "unknown request type: %s" % request["type"]})
+        except Exception:
+            logger.exception("error handling compile server connection")
+        finally:
+            if not queued:
+                conn.close()
+
+    def _work(self):
+        while True:
+            priority, seq, job = self.queue.get()
+            if job is None:
+                return
+
+            try:
+                job.run()
+            except Exception:
+                logger.exception("error running compile job")
+            finally:
+                job.conn.close()
+
+    def serve_forever(self):
+        import os
+        import socket
+        from os.path import dirname
+
+        socket_dir = dirname(self.socket_path)
+        try:
+            os.makedirs(socket_dir, 0o700)
+        except OSError as e:
+            from errno import EEXIST
+            if e.errno != EEXIST:
+                raise
+        else:
+            # in case the umask took away more than it should
+            os.chmod(socket_dir, 0o700)
+
+        _check_socket_dir(socket_dir)
+
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(64)
+        listener.settimeout(1)
+
+        workers = [threading.Thread(target=self._work)
+                for i in range(self.max_jobs)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        from time import time
+        last_request = time()
+
+        try:
+            while not self.shutdown_requested.is_set():
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    if (self.idle_timeout is not None
+                            and self.queue.empty()
+                            and time() - last_request > self.idle_timeout):
+                        break
+                    continue
+
+                last_request = time()
+                conn.settimeout(None)
+                thread = threading.Thread(
+                        target=self._handle_connection, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            listener.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+            for worker in workers:
+                self.queue.put((float("inf"), next(self.sequence), None))
+            for worker in workers:
+                worker.join()
+
+# }}}
+
+
+# {{{ client
+
+class CompileServerClient(object):
+    """A connection to the :class:`CompileServer` listening on
+    *socket_path*.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    def _connect(self):
+        import socket
+        from os.path import dirname
+        _check_socket_dir(dirname(self.socket_path))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        return sock
+
+    def ping(self):
+        """Return *True* if the server responds.
+
+        Like all other requests, this raises :exc:`RuntimeError` if the
+        directory containing the socket is accessible to other users.
+        """
+        import socket
+        try:
+            sock = self._connect()
+        except (socket.error, OSError):
+            return False
+
+        try:
+            _send_message(sock, {"type": "ping"})
+            return _recv_message(sock)[0]["type"] == "pong"
+        except (socket.error, EOFError):
+            return False
+        finally:
+            sock.close()
+
+    def shutdown(self):
+        """Ask the server to exit once the running invocations are done."""
+        sock = self._connect()
+        try:
+            _send_message(sock, {"type": "shutdown"})
+        finally:
+            sock.close()
+
+    def run(self, cmdline, cwd=None, on_stdout=None, on_stderr=None,
+            priority=None, memory=None, timeout=None):
+        """Run *cmdline* in the server and return its exit status.
+
+        *on_stdout* and *on_stderr* are called with each piece of output
+        as it arrives. *priority* defaults to the one set by
+        :func:`compile_priority`. *memory* limits the address space of the
+        process and of the processes it starts in bytes. If it runs longer
+        than *timeout* seconds, it is killed and
+        :exc:`codepy.CompileLimitError` is raised.
+        """
+        import os
+
+        if priority is None:
+            priority = getattr(_priority, "value", PRIORITY_INTERACTIVE)
+
+        sock = self._connect()
+        try:
+            _send_message(sock, {
+                "type": "run",
+                "cmdline": list(cmdline),
+                "cwd": cwd,
+                "env": dict(os.environ),
+                "priority": priority,
+                "memory": memory,
+                "timeout": timeout,
+                })
+
+            while True:
+                header, payload = _recv_message(sock)
+                if header["type"] == "stdout":
+                    if on_stdout is not None:
+                        on_stdout(payload)
+                elif header["type"] == "stderr":
+                    if on_stderr is not None:
+                        on_stderr(payload)
+                elif header["type"] == "exit":
+                    return header["status"]
+                elif header["type"] == "timeout":
+                    raise CompileLimitError(
+                            "compilation timed out after %g s: %s"
+                            % (header["seconds"], " ".join(cmdline)))
+                elif header["type"] == "error":
+                    from pytools.prefork import ExecError
+                    raise ExecError("error invoking '%s': %s"
+                            % (" ".join(cmdline), header["message"]))
+                else:
+                    raise RuntimeError("unexpected message from compile "
+                            "server: %r" % (header,))
+        finally:
+            sock.close()
+
+    def call(self, cmdline, cwd=None, **kwargs):
+        """Like :func:`pytools.prefork.call`, passing the output through to
+        :data:`sys.stdout` and :data:`sys.stderr`.
+        """
+        import sys
+
+        def write_to(stream_name):
+            def write(data):
+                stream = getattr(sys, stream_name)
+                stream.write(data.decode(sys.getdefaultencoding(), "replace"))
+                stream.flush()
+
+            return write
+
+        return self.run(cmdline, cwd,
+                on_stdout=write_to("stdout"), on_stderr=write_to("stderr"),
+                **kwargs)
+
+    def call_capture_output(self, cmdline, cwd=None, error_on_nonzero=True,
+            **kwargs):
+        """Like :func:`pytools.prefork.call_capture_output`."""
+        stdout = []
+        stderr = []
+        result = self.run(cmdline, cwd,
+                on_stdout=stdout.append, on_stderr=stderr.append, **kwargs)
+        stdout = b"".join(stdout)
+        stderr = b"".join(stderr)
+
+        if error_on_nonzero and result:
+            from pytools.prefork import ExecError
+            raise ExecError("status %d invoking '%s': %s"
+                    % (result, " ".join(cmdline),
+                        stderr.decode("utf-8", "replace")))
+
+        return result, stdout, stderr
+
+
+_client = None
+
+
+def connect_compile_server(socket_path=None):
+    """Send compiler invocations to the server listening on *socket_path*
+    from now on, and return its :class:`CompileServerClient`.
+    """
+    global _client
+    if socket_path is None:
+        socket_path = get_default_socket_path()
+    _client = CompileServerClient(socket_path)
+    return _client
+
+
+def disconnect_compile_server():
+    """Run compiler invocations in this process again."""
+    global _client
+    _client = None
+
+
+def get_compile_server():
+    """Return the :class:`CompileServerClient` in use, or *None*."""
+    global _client
+    if _client is None:
+        import os
+        socket_path = os.environ.get("CODEPY_COMPILE_SERVER")
+        if socket_path:
+            _client = CompileServerClient(socket_path)
+    return _client
+
+
+def start_compile_server(socket_path=None, max_jobs=None, idle_timeout=600,
+        startup_timeout=30):
+    """Start a :class:`CompileServer` in a new process, unless one is already
+    listening on *socket_path*, and connect to it as in
+    :func:`connect_compile_server`. The server exits after *idle_timeout*
+    seconds without requests.
+
+    This is best done early, while the process is small, but since the
+    server is started with :func:`os.posix_spawn`, it is cheap at any time.
+    """
+    import os
+    import sys
+    from time import time, sleep
+    from os.path import dirname, abspath
+
+    if socket_path is None:
+        socket_path = get_default_socket_path()
+
+    client = CompileServerClient(socket_path)
+    if not client.ping():
+        cmdline = [sys.executable, "-m", "codepy.server",
+                "--socket", socket_path]
+        if max_jobs is not None:
+            cmdline.extend(["--max-jobs", str(max_jobs)])
+        if idle_timeout is not None:
+            cmdline.extend(["--idle-timeout", str(idle_timeout)])
+
+        # make sure this copy of codepy is found
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+                [dirname(dirname(abspath(__file__)))]
+                + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+
+        devnull = os.open(os.devnull, os.O_RDWR)
+        try:
+            pid = os.posix_spawn(sys.executable, cmdline, env,
+                    file_actions=[
+                        (os.POSIX_SPAWN_DUP2, devnull, 0),
+                        (os.POSIX_SPAWN_DUP2, devnull, 1),
+                        (os.POSIX_SPAWN_DUP2, devnull, 2),
+                        ],
+                    setsid=True)
+        finally:
+            os.close(devnull)
+
+        # reap the server when it exits
+        reaper = threading.Thread(target=os.waitpid, args=(pid, 0))
+        reaper.daemon = True
+        reaper.start()
+
+        deadline = time() + startup_timeout
+        while not client.ping():
+            if time() > deadline:
+                raise RuntimeError("compile server did not start")
+            sleep(0.05)
+
+    return connect_compile_server(socket_path)
+
+# }}}
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a codepy compile server.")
+    parser.add_argument("--socket", default=None)
+    parser.add_argument("--max-jobs", type=int, default=None)
+    parser.add_argument("--idle-timeout", type=float, default=None)
+    args = parser.parse_args()
+
+    CompileServer(args.socket, args.max_jobs, args.idle_timeout).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: foldmethod=marker
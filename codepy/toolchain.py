@@ -27,8 +27,10 @@ THE SOFTWARE.
 """
 
 
-from codepy import CompileError
-from pytools import Record
+from contextlib import contextmanager
+
+from codepy import CompileError, CompileLimitError
+from pytools import Record, memoize
 from pytools.prefork import ExecError
 
 
@@ -126,6 +128,47 @@ class Toolchain(Record):
 
         raise NotImplementedError
 
+    def with_executor(self, executor):
+        """Return a new Toolchain object that leaves :meth:`build_object`
+        and :meth:`build_extension` to *executor*, such as a
+        :class:`codepy.distributed.RemoteExecutor`, or runs them itself again
+        if *executor* is *None*. The executor's methods of the same names
+        are called with the toolchain as an additional first argument.
+        """
+
+        return self.copy(executor=executor)
+
+    def with_isa_level(self, isa_level):
+        """Return a new Toolchain object generating code for the entry of
+        :data:`ISA_LEVELS` named *isa_level*, instead of any architecture
+        specified so far.
+
+        Implemented by subclasses.
+        """
+
+        raise NotImplementedError
+
+    def with_profile_generate(self, profile_dir):
+        """Return a new Toolchain object building code instrumented to write
+        execution profiles to *profile_dir*, for use with
+        :meth:`with_profile_use`.
+
+        Implemented by subclasses.
+        """
+
+        raise NotImplementedError
+
+    def with_profile_use(self, profile_dir):
+        """Return a new Toolchain object optimizing code according to the
+        execution profiles in *profile_dir*, as written by code built with
+        :meth:`with_profile_generate`. The profiles only apply to the same
+        source files compiled into the same output files.
+
+        Implemented by subclasses.
+        """
+
+        raise NotImplementedError
+
     def with_optimization_level(self, level, **extra):
         """Return a new Toolchain object with the optimization level
         set to `level` , on the scale defined by the gcc -O option.
@@ -142,14 +185,396 @@ class Toolchain(Record):
         raise NotImplementedError
 
 
+# {{{ cpu features
+
+# ISA levels for multiversioned builds, best first: name, compiler flags,
+# and the CPU feature flags (as reported in /proc/cpuinfo) needed to run
+# the resulting code.
+ISA_LEVELS = [
+        ("avx512",
+            ["-mavx512f", "-mavx512cd", "-mavx512bw", "-mavx512dq",
+                "-mavx512vl", "-mavx2", "-mfma", "-mbmi", "-mbmi2", "-mf16c"],
+            frozenset(["avx512f", "avx512cd", "avx512bw", "avx512dq",
+                "avx512vl", "avx2", "fma", "bmi1", "bmi2", "f16c"])),
+        ("avx2",
+            ["-mavx2", "-mfma", "-mbmi", "-mbmi2", "-mf16c"],
+            frozenset(["avx2", "fma", "bmi1", "bmi2", "f16c"])),
+        ("baseline", [], frozenset()),
+        ]
+
+ISA_FLAGS = frozenset(
+        flag for name, flags, features in ISA_LEVELS for flag in flags)
+
+
+def get_default_isa_levels():
+    """Return the names of the entries of :data:`ISA_LEVELS` that apply to
+    the architecture of the host.
+    """
+    import platform
+    if platform.machine().lower() in ["x86_64", "amd64"]:
+        return [name for name, flags, features in ISA_LEVELS]
+    else:
+        return ["baseline"]
+
+
+@memoize
+def get_cpu_features():
+    """Return a :class:`frozenset` of the feature flags of the host CPU, as
+    reported by the operating system, or an empty set if they cannot be
+    determined.
+    """
+    import sys
+
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/cpuinfo") as inf:
+                for line in inf:
+                    key, _, value = line.partition(":")
+                    if key.strip() in ["flags", "Features"]:
+                        return frozenset(value.split())
+        except IOError:
+            pass
+
+    elif sys.platform == "darwin":
+        features = set()
+        for key in ["machdep.cpu.features", "machdep.cpu.leaf7_features"]:
+            try:
+                result, stdout, stderr = call_capture_output(
+                        ["sysctl", "-n", key], None, False)
+            except ExecError:
+                continue
+            if result == 0:
+                # sysctl names agree with /proc/cpuinfo up to case
+                features.update(stdout.lower().split())
+
+        return frozenset(features)
+
+    return frozenset()
+
+
+def select_isa_level(isa_levels):
+    """Return the best of the ISA level names in *isa_levels* whose code
+    runs on the host CPU.
+    """
+    cpu_features = get_cpu_features()
+
+    for name, flags, features in ISA_LEVELS:
+        if name in isa_levels and features <= cpu_features:
+            return name
+
+    raise RuntimeError("none of the ISA levels %s is supported by this CPU"
+            % ", ".join(isa_levels))
+
+# }}}
+
+
+# {{{ compile limits
+
+class CompileLimits(Record):
+    """Limits on compiler invocations.
+
+    .. attribute:: slots
+
+        The number of compilers that may run at the same time on this host,
+        across all processes of the user that use the same *slot_dir*, or
+        *None* for no limit.
+
+    .. attribute:: memory
+
+        The maximum size in bytes of the address space of a compiler, or
+        *None* for no limit.
+
+    .. attribute:: timeout
+
+        The number of seconds after which a compiler is terminated and a
+        :exc:`codepy.CompileLimitError` raised, or *None* for no limit.
+
+    .. attribute:: slot_dir
+
+        The directory holding the lock files that represent the slots. It
+        should be on a local file system.
+    """
+
+    def __init__(self, slots=None, memory=None, timeout=None, slot_dir=None):
+        if slot_dir is None:
+            import getpass
+            from tempfile import gettempdir
+            from os.path import join
+            slot_dir = join(gettempdir(),
+                    "codepy-compile-slots-%s" % getpass.getuser())
+
+        Record.__init__(self, slots=slots, memory=memory, timeout=timeout,
+                slot_dir=slot_dir)
+
+
+def _parse_size(value):
+    factors = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    value = value.strip().upper().rstrip("B")
+    if value[-1:] in factors:
+        return int(float(value[:-1]) * factors[value[-1]])
+    return int(value)
+
+
+def _get_default_compile_limits():
+    import os
+
+    slots = os.environ.get("CODEPY_COMPILE_SLOTS")
+    if slots is None:
+        try:
+            from multiprocessing import cpu_count
+            slots = cpu_count()
+        except NotImplementedError:
+            slots = None
+    else:
+        # 0 disables the limit
+        slots = int(slots) or None
+
+    memory = os.environ.get("CODEPY_COMPILE_MEMORY")
+    if memory is not None:
+        memory = _parse_size(memory)
+
+    timeout = os.environ.get("CODEPY_COMPILE_TIMEOUT")
+    if timeout is not None:
+        timeout = float(timeout)
+
+    return CompileLimits(slots=slots, memory=memory, timeout=timeout,
+            slot_dir=os.environ.get("CODEPY_COMPILE_SLOT_DIR"))
+
+
+_compile_limits = None
+
+
+def get_compile_limits():
+    """Return the :class:`CompileLimits` in effect.
+
+    Unless set by :func:`set_compile_limits`, they are taken from the
+    environment variables :envvar:`CODEPY_COMPILE_SLOTS` (default: the number
+    of CPUs, 0 for no limit), :envvar:`CODEPY_COMPILE_MEMORY` (in bytes,
+    with an optional suffix ``K``, ``M`` or ``G``),
+    :envvar:`CODEPY_COMPILE_TIMEOUT` (in seconds) and
+    :envvar:`CODEPY_COMPILE_SLOT_DIR`.
+    """
+    global _compile_limits
+    if _compile_limits is None:
+        _compile_limits = _get_default_compile_limits()
+    return _compile_limits
+
+
+def set_compile_limits(slots=None, memory=None, timeout=None, slot_dir=None):
+    """Set the :class:`CompileLimits` used for compiler invocations in this
+    process. All processes sharing a *slot_dir* should use the same number
+    of *slots*.
+    """
+    global _compile_limits
+    _compile_limits = CompileLimits(slots=slots, memory=memory,
+            timeout=timeout, slot_dir=slot_dir)
+
+
+@contextmanager
+def compile_slot(limits=None):
+    """A context manager that waits for one of the compile slots of *limits*
+    (by default, :func:`get_compile_limits`) and holds it while the block
+    runs.
+
+    The slots are :func:`fcntl.flock` locks on files, so they are released
+    even if the process holding them dies.
+    """
+    if limits is None:
+        limits = get_compile_limits()
+
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    if not limits.slots or fcntl is None:
+        yield
+        return
+
+    import os
+    from os.path import join
+    from random import randrange
+    from time import sleep
+
+    try:
+        os.makedirs(limits.slot_dir)
+    except OSError as e:
+        from errno import EEXIST
+        if e.errno != EEXIST:
+            raise
+
+    # start at a random slot, to keep processes from contending for the
+    # same ones
+    start = randrange(limits.slots)
+    delay = 0.01
+
+    while True:
+        for i in range(limits.slots):
+            fd = os.open(
+                    join(limits.slot_dir, "slot-%d" % ((start + i) % limits.slots)),
+                    os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                os.close(fd)
+                continue
+
+            try:
+                yield
+            finally:
+                # releases the lock
+                os.close(fd)
+            return
+
+        sleep(delay)
+        delay = min(2*delay, 1)
+
+
+@contextmanager
+def _client_compile_slot(limits=None):
+    """Like :func:`compile_slot`, but without waiting for a slot if
+    compiler invocations go to a compile server. The server decides which
+    of its queued invocations run first by their priority, which a slot
+    held by the client while waiting would defeat.
+    """
+    from codepy.server import get_compile_server
+    if get_compile_server() is not None:
+        yield
+    else:
+        with compile_slot(limits):
+            yield
+
+
+# What compilers report when they run out of memory, or what their drivers
+# report when they are killed for it.
+_OUT_OF_MEMORY_MESSAGES = ["out of memory", "virtual memory exhausted",
+        "std::bad_alloc", "Cannot allocate memory", "Killed signal"]
+
+
+def _make_tee(chunks, stream_name):
+    """Return a function appending its argument to *chunks* and writing it
+    to the :mod:`sys` stream *stream_name*.
+    """
+    import codecs
+    import sys
+    decoder = codecs.getincrementaldecoder(sys.getdefaultencoding())("replace")
+
+    def tee(data):
+        chunks.append(data)
+        stream = getattr(sys, stream_name)
+        stream.write(decoder.decode(data))
+        stream.flush()
+
+    return tee
+
+
+def _call_with_limits(cmdline, limits, echo=False):
+    """Run *cmdline* within *limits*. Return a tuple *(result, stdout,
+    stderr)*, with the output as :class:`bytes`. If *echo* is *True*, the
+    output is also passed through to :data:`sys.stdout` and
+    :data:`sys.stderr`. This happens as it arrives, unless no limits are
+    set, in which case *cmdline* is run through :mod:`pytools.prefork` and
+    its output is passed through once it has finished.
+    """
+    from codepy.server import get_compile_server
+
+    stdout = []
+    stderr = []
+    if echo:
+        on_stdout = _make_tee(stdout, "stdout")
+        on_stderr = _make_tee(stderr, "stderr")
+    else:
+        on_stdout = stdout.append
+        on_stderr = stderr.append
+
+    server = get_compile_server()
+    if server is not None:
+        result = server.run(cmdline, on_stdout=on_stdout, on_stderr=on_stderr,
+                memory=limits.memory, timeout=limits.timeout)
+        return result, b"".join(stdout), b"".join(stderr)
+
+    if limits.memory is None and limits.timeout is None:
+        from pytools.prefork import call_capture_output
+        result, stdout, stderr = call_capture_output(cmdline,
+                error_on_nonzero=False)
+        if echo:
+            for data, callback in [(stdout, on_stdout), (stderr, on_stderr)]:
+                if data:
+                    callback(data)
+        return result, stdout, stderr
+
+    import os
+    import subprocess
+
+    def set_memory_limit():
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS,
+                (limits.memory, limits.memory))
+
+    # in a session of its own, so that the processes started by the
+    # compiler driver can be terminated along with it
+    proc = subprocess.Popen(cmdline,
+            preexec_fn=None if limits.memory is None else set_memory_limit,
+            start_new_session=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def read(pipe, callback):
+        with pipe:
+            for data in iter(lambda: os.read(pipe.fileno(), 1 << 16), b""):
+                callback(data)
+
+    from threading import Thread
+    readers = [
+            Thread(target=read, args=(proc.stdout, on_stdout)),
+            Thread(target=read, args=(proc.stderr, on_stderr)),
+            ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    try:
+        proc.wait(timeout=limits.timeout)
+    except subprocess.TimeoutExpired:
+        import signal
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        raise CompileLimitError("compilation timed out after %g s: %s"
+                % (limits.timeout, " ".join(cmdline)))
+    finally:
+        for reader in readers:
+            reader.join()
+
+    return proc.returncode, b"".join(stdout), b"".join(stderr)
+
+# }}}
+
+
 # {{{ gcc-like tool chain
 
+@memoize
+def _get_compiler_version(cc):
+    # queried for every cache lookup, through abi_id
+    result, stdout, stderr = call_capture_output([cc, "--version"])
+    if result != 0:
+        raise RuntimeError("version query failed: "+stderr)
+    return stdout
+
+
 class GCCLikeToolchain(Toolchain):
     def get_version(self):
-        result, stdout, stderr = call_capture_output([self.cc, "--version"])
-        if result != 0:
-            raise RuntimeError("version query failed: "+stderr)
-        return stdout
+        return _get_compiler_version(self.cc)
+
+    def _native_arch_abi_id(self):
+        """Return the CPU features of the host if the flags of *self* let the
+        compiler target it specifically, since the resulting code may then
+        not run on other machines.
+        """
+        if any(flag.startswith(prefix) and flag.endswith("=native")
+                for flag in " ".join(self.cflags).replace(",", " ").split()
+                for prefix in ["-march", "-mtune", "-mcpu"]):
+            return [sorted(get_cpu_features())]
+        else:
+            return []
 
     def enable_debugging(self):
         self.cflags = [f for f in self.cflags if not f.startswith("-O")] + ["-g"]
@@ -174,41 +599,53 @@ class GCCLikeToolchain(Toolchain):
         return set(flatten(
             line.split()[2:] for line in lines))
 
+    def _run_compiler(self, cc_cmdline, debug=False):
+        if debug:
+            print(" ".join(cc_cmdline))
+
+        limits = get_compile_limits()
+        with _client_compile_slot(limits):
+            result, stdout, stderr = _call_with_limits(cc_cmdline, limits,
+                    echo=True)
+
+        import sys
+        encoding = sys.getdefaultencoding()
+        stdout = stdout.decode(encoding, "replace")
+        stderr = stderr.decode(encoding, "replace")
+
+        if result != 0:
+            print("FAILED compiler invocation:" + " ".join(cc_cmdline),
+                  file=sys.stderr)
+            if limits.memory is not None and (result < 0 or any(
+                    message in stderr for message in _OUT_OF_MEMORY_MESSAGES)):
+                raise CompileLimitError("module compilation ran out of memory",
+                        diagnostics=stdout + stderr)
+            raise CompileError("module compilation failed",
+                    diagnostics=stdout + stderr)
+
     def build_object(self, ext_file, source_files, debug=False):
+        executor = getattr(self, "executor", None)
+        if executor is not None:
+            return executor.build_object(self, ext_file, source_files, debug)
+
         cc_cmdline = (
                 self._cmdline(source_files, True)
                 + ["-o", ext_file]
                 )
 
-        from pytools.prefork import call
-        if debug:
-            print(" ".join(cc_cmdline))
-
-        result = call(cc_cmdline)
-
-        if result != 0:
-            import sys
-            print("FAILED compiler invocation:" +
-                  " ".join(cc_cmdline), file=sys.stderr)
-            raise CompileError("module compilation failed")
+        self._run_compiler(cc_cmdline, debug)
 
     def build_extension(self, ext_file, source_files, debug=False):
+        executor = getattr(self, "executor", None)
+        if executor is not None:
+            return executor.build_extension(self, ext_file, source_files, debug)
+
         cc_cmdline = (
                 self._cmdline(source_files, False)
                 + ["-o", ext_file]
                 )
 
-        from pytools.prefork import call
-        if debug:
-            print(" ".join(cc_cmdline))
-
-        result = call(cc_cmdline)
-
-        if result != 0:
-            import sys
-            print("FAILED compiler invocation:" + " ".join(cc_cmdline),
-                  file=sys.stderr)
-            raise CompileError("module compilation failed")
+        self._run_compiler(cc_cmdline, debug)
 
     def link_extension(self, ext_file, object_files, debug=False):
         cc_cmdline = (
@@ -216,17 +653,7 @@ class GCCLikeToolchain(Toolchain):
                 + ["-o", ext_file]
                 )
 
-        from pytools.prefork import call
-        if debug:
-            print(" ".join(cc_cmdline))
-
-        result = call(cc_cmdline)
-
-        if result != 0:
-            import sys
-            print("FAILED compiler invocation:" + " ".join(cc_cmdline),
-                  file=sys.stderr)
-            raise CompileError("module compilation failed")
+        self._run_compiler(cc_cmdline, debug)
 
 # }}}
 
@@ -234,6 +661,10 @@ class GCCLikeToolchain(Toolchain):
 # {{{ gcc toolchain
 
 class GCCToolchain(GCCLikeToolchain):
+    # linkers usable with -fuse-ld, fastest first, with the compiler
+    # version needed to select them
+    fast_linkers = [("mold", (12, 1)), ("lld", (9,)), ("gold", (4, 8))]
+
     def get_version_tuple(self):
         ver = self.get_version()
         lines = ver.split("\n")
@@ -270,16 +701,95 @@ class GCCToolchain(GCCLikeToolchain):
             )
 
     def abi_id(self):
-        return Toolchain.abi_id(self) + [self._cmdline([])]
+        return (Toolchain.abi_id(self) + [self._cmdline([])]
+                + self._native_arch_abi_id())
+
+    def with_isa_level(self, isa_level):
+        for name, flags, features in ISA_LEVELS:
+            if name == isa_level:
+                break
+        else:
+            raise ValueError("unknown ISA level: %s" % isa_level)
+
+        cflags = [f for f in self.cflags
+                if not f.startswith("-march") and not f.startswith("-mtune")
+                and f not in ISA_FLAGS]
+
+        return self.copy(cflags=cflags + flags)
+
+    def _remove_profile_flags(self):
+        return [f for f in self.cflags
+                if not f.startswith("-fprofile-generate")
+                and not f.startswith("-fprofile-use")
+                and not f.startswith("-fprofile-update")
+                and f != "-fprofile-correction"]
+
+    def with_profile_generate(self, profile_dir):
+        pflags = ["-fprofile-generate=%s" % profile_dir]
+        if self.get_version_tuple() >= (7,):
+            # profiled code may run in several threads
+            pflags.append("-fprofile-update=atomic")
+
+        return self.copy(cflags=self._remove_profile_flags() + pflags)
+
+    def with_profile_use(self, profile_dir):
+        return self.copy(cflags=self._remove_profile_flags() + [
+            "-fprofile-use=%s" % profile_dir, "-fprofile-correction"])
+
+    def find_fast_linker(self):
+        """Return the name of the fastest linker available to the compiler
+        as an argument to ``-fuse-ld``, or *None* if there is none besides
+        the default.
+        """
+        import sys
+        if sys.platform == "darwin":
+            return None
+
+        version = self.get_version_tuple()
+        for linker, min_version in self.fast_linkers:
+            if version >= min_version and _which("ld.%s" % linker):
+                return linker
+
+        return None
+
+    def _get_lto_flag(self, linker):
+        """Return the flag enabling link-time optimization with *linker*
+        (as in ``-fuse-ld``, or *None* for the default), and the linker to
+        use instead.
+        """
+        # "auto" runs the link-time code generation in parallel
+        if self.get_version_tuple() >= (10,):
+            return "-flto=auto", linker
+        else:
+            return "-flto", linker
+
+    def with_optimization_level(self, level, debug=False, lto=False,
+            linker=None, gc_sections=False, strip=False, **extra):
+        """See :meth:`Toolchain.with_optimization_level`. In addition,
+
+        * *lto* enables link-time optimization, including across the objects
+          linked by :meth:`link_extension`,
+        * *linker* names the linker to use (as in ``-fuse-ld``), or is
+          ``"auto"`` to use :meth:`find_fast_linker`,
+        * *gc_sections* removes unused functions and data when linking,
+        * *strip* removes symbols not needed for loading the result.
+        """
+        import sys
 
-    def with_optimization_level(self, level, debug=False, **extra):
         def remove_prefix(l, prefix):
             return [f for f in l if not f.startswith(prefix)]
 
         cflags = self.cflags
-        for pfx in ["-O", "-g", "-march", "-mtune", "-DNDEBUG"]:
+        for pfx in ["-O", "-g", "-march", "-mtune", "-DNDEBUG", "-flto",
+                "-ffunction-sections", "-fdata-sections"]:
             cflags = remove_prefix(cflags, pfx)
 
+        ldflags = self.ldflags
+        for pfx in ["-fuse-ld", "-Wl,--gc-sections", "-Wl,-dead_strip",
+                "-Wl,-x"]:
+            ldflags = remove_prefix(ldflags, pfx)
+        ldflags = [f for f in ldflags if f != "-s"]
+
         if level == "debug":
             oflags = ["-g"]
         else:
@@ -288,7 +798,138 @@ class GCCToolchain(GCCLikeToolchain):
             if level >= 2 and self.get_version_tuple() >= (4, 3):
                 oflags.extend(["-march=native", "-mtune=native", ])
 
-        return self.copy(cflags=cflags + oflags)
+        lflags = []
+
+        if linker == "auto":
+            linker = self.find_fast_linker()
+
+        if lto:
+            # the compiler flags are also passed when linking
+            lto_flag, linker = self._get_lto_flag(linker)
+            oflags.append(lto_flag)
+
+        if linker is not None:
+            lflags.append("-fuse-ld=%s" % linker)
+
+        if gc_sections:
+            oflags.extend(["-ffunction-sections", "-fdata-sections"])
+            if sys.platform == "darwin":
+                lflags.append("-Wl,-dead_strip")
+            else:
+                lflags.append("-Wl,--gc-sections")
+
+        if strip:
+            if sys.platform == "darwin":
+                lflags.append("-Wl,-x")
+            else:
+                lflags.append("-s")
+
+        return self.copy(cflags=cflags + oflags, ldflags=ldflags + lflags)
+
+# }}}
+
+
+# {{{ clang toolchain
+
+class ClangToolchain(GCCToolchain):
+    fast_linkers = [("mold", (12,)), ("lld", (3, 9)), ("gold", (3, 4))]
+
+    def get_version_tuple(self):
+        import re
+        match = re.search(r"clang version ([0-9]+(?:\.[0-9]+)*)",
+                self.get_version())
+        if match is None:
+            return ()
+
+        return tuple(int(n) for n in match.group(1).split("."))
+
+    def _get_lto_flag(self, linker):
+        # ThinLTO scales to large modules much better than full LTO, but
+        # needs lld, or plugins that the default linker does not load
+        if linker is None and _which("ld.lld"):
+            linker = "lld"
+        if linker == "lld":
+            return "-flto=thin", linker
+        else:
+            return "-flto", linker
+
+    def with_profile_generate(self, profile_dir):
+        raise NotImplementedError("clang profiles need to be merged with "
+                "llvm-profdata, which is not supported")
+
+    def with_profile_use(self, profile_dir):
+        raise NotImplementedError("clang profiles need to be merged with "
+                "llvm-profdata, which is not supported")
+
+    def with_time_trace(self, trace_dir=None, granularity=None):
+        """Return a new Toolchain object whose compiler writes a trace of the
+        time spent on each part of the compilation, such as parsing headers
+        and instantiating templates, in Chrome's trace event format. See
+        :func:`summarize_time_trace`.
+
+        The traces are written to *trace_dir* if given, which needs clang 16
+        or later, and next to the object files otherwise. *granularity*
+        is the minimum duration in microseconds of the entries recorded.
+        """
+        cflags = [f for f in self.cflags if not f.startswith("-ftime-trace")]
+
+        if trace_dir is not None:
+            if self.get_version_tuple() < (16,):
+                raise ValueError("trace_dir needs clang 16 or later")
+            cflags.append("-ftime-trace=%s" % trace_dir)
+        else:
+            cflags.append("-ftime-trace")
+
+        if granularity is not None:
+            cflags.append("-ftime-trace-granularity=%d" % granularity)
+
+        return self.copy(cflags=cflags)
+
+
+def summarize_time_trace(trace_files, count=20):
+    """Return a list of tuples *(seconds, kind, detail)* for the *count*
+    most time-consuming entries of the traces in *trace_files*, as written
+    by :meth:`ClangToolchain.with_time_trace`. *trace_files* may also
+    name a directory, all traces in which are included.
+
+    Entries with the same *kind* (such as ``"Source"`` for an included file
+    or ``"InstantiateFunction"``) and *detail* (such as the name of the file
+    or template) are added up. Durations include those of nested entries.
+    """
+    import json
+    import os
+    from os.path import isdir, join
+
+    if isinstance(trace_files, str):
+        trace_files = [trace_files]
+
+    paths = []
+    for path in trace_files:
+        if isdir(path):
+            paths.extend(join(path, name) for name in sorted(os.listdir(path))
+                    if name.endswith(".json"))
+        else:
+            paths.append(path)
+
+    totals = {}
+    for path in paths:
+        with open(path) as inf:
+            trace = json.load(inf)
+
+        for event in trace["traceEvents"]:
+            if (event.get("ph") != "X"
+                    or event["name"].startswith("Total ")
+                    or event["name"] in ["ExecuteCompiler", "Frontend",
+                        "Backend"]):
+                continue
+
+            key = (event["name"], event.get("args", {}).get("detail", ""))
+            totals[key] = totals.get(key, 0) + event["dur"]
+
+    return sorted(
+            ((dur * 1e-6, name, detail)
+                for (name, detail), dur in totals.items()),
+            reverse=True)[:count]
 
 # }}}
 
@@ -332,7 +973,8 @@ class NVCCToolchain(GCCLikeToolchain):
                 )
 
     def abi_id(self):
-        return Toolchain.abi_id(self) + [self._cmdline([])]
+        return (Toolchain.abi_id(self) + [self._cmdline([])]
+                + self._native_arch_abi_id())
 
     def build_object(self, ext_file, source_files, debug=False):
         cc_cmdline = (
@@ -343,7 +985,8 @@ class NVCCToolchain(GCCLikeToolchain):
         if debug:
             print(" ".join(cc_cmdline))
 
-        result, stdout, stderr = call_capture_output(cc_cmdline)
+        with _client_compile_slot():
+            result, stdout, stderr = call_capture_output(cc_cmdline)
         print(stderr)
         print(stdout)
 
@@ -423,59 +1066,98 @@ def _guess_toolchain_kwargs_from_python_config():
             )
 
 
+def _which(program):
+    try:
+        from shutil import which
+    except ImportError:
+        # Python 2
+        from distutils.spawn import find_executable as which
+
+    return which(program)
+
+
 def call_capture_output(*args):
-    from pytools.prefork import call_capture_output
+    from codepy.server import get_compile_server
     import sys
 
+    server = get_compile_server()
+    if server is not None:
+        call_capture_output = server.call_capture_output
+    else:
+        from pytools.prefork import call_capture_output
+
     encoding = sys.getdefaultencoding()
     result, stdout, stderr = call_capture_output(*args)
     return result, stdout.decode(encoding), stderr.decode(encoding)
 
 
+def _fix_gcc_like_kwargs(kwargs, version):
+    if "-Wstrict-prototypes" in kwargs["cflags"]:
+        kwargs["cflags"].remove("-Wstrict-prototypes")
+    if "darwin" in version:
+        # Are we running in 32-bit mode?
+        # The python interpreter may have been compiled as a Fat binary
+        # So we need to check explicitly how we're running
+        # And update the cflags accordingly
+        import sys
+        if sys.maxsize == 0x7fffffff:
+            kwargs["cflags"].extend(['-arch', 'i386'])
+
+
 def guess_toolchain():
     """Guess and return a :class:`Toolchain` instance.
 
-    Raise :exc:`ToolchainGuessError` if no toolchain could be found.
+    Raise :exc:`ToolchainGuessError` if no toolchain could be found, unless
+    packages built by :mod:`codepy.aot` are installed.
     """
     kwargs = _guess_toolchain_kwargs_from_python_config()
     try:
         result, version, stderr = call_capture_output([kwargs["cc"], "--version"])
     except ExecError:
+        from codepy.aot import have_aot_modules
+        if have_aot_modules():
+            # without a compiler, modules can still be found in the packages
+            # built ahead of time, for which the toolchain is not used
+            return GCCToolchain(**kwargs)
+
         raise ToolchainGuessError("System compiler {} not found".format(
             kwargs['cc']))
     if result != 0:
         raise ToolchainGuessError("compiler version query failed: "+stderr)
 
     if "Free Software Foundation" in version:
-        if "-Wstrict-prototypes" in kwargs["cflags"]:
-            kwargs["cflags"].remove("-Wstrict-prototypes")
-        if "darwin" in version:
-            # Are we running in 32-bit mode?
-            # The python interpreter may have been compiled as a Fat binary
-            # So we need to check explicitly how we're running
-            # And update the cflags accordingly
-            import sys
-            if sys.maxsize == 0x7fffffff:
-                kwargs["cflags"].extend(['-arch', 'i386'])
-
+        _fix_gcc_like_kwargs(kwargs, version)
         return GCCToolchain(**kwargs)
     elif "Apple LLVM" in version and "clang" in version:
-        if "-Wstrict-prototypes" in kwargs["cflags"]:
-            kwargs["cflags"].remove("-Wstrict-prototypes")
-        if "darwin" in version:
-            # Are we running in 32-bit mode?
-            # The python interpreter may have been compiled as a Fat binary
-            # So we need to check explicitly how we're running
-            # And update the cflags accordingly
-            import sys
-            if sys.maxsize == 0x7fffffff:
-                kwargs["cflags"].extend(['-arch', 'i386'])
-
+        _fix_gcc_like_kwargs(kwargs, version)
         return GCCToolchain(**kwargs)
+    elif "clang version" in version:
+        _fix_gcc_like_kwargs(kwargs, version)
+        return ClangToolchain(**kwargs)
     else:
         raise ToolchainGuessError("unknown compiler")
 
 
+def guess_clang_toolchain(cc="clang++"):
+    """Return a :class:`ClangToolchain` using the compiler *cc*, with flags
+    and libraries as for :func:`guess_toolchain`.
+
+    Raise :exc:`ToolchainGuessError` if *cc* cannot be run.
+    """
+    kwargs = _guess_toolchain_kwargs_from_python_config()
+    kwargs["cc"] = cc
+
+    try:
+        result, version, stderr = call_capture_output([cc, "--version"])
+    except ExecError:
+        raise ToolchainGuessError("compiler {} not found".format(cc))
+    if result != 0:
+        raise ToolchainGuessError("compiler version query failed: "+stderr)
+
+    _fix_gcc_like_kwargs(kwargs, version)
+    return ClangToolchain(**kwargs)
+
+
 def guess_nvcc_toolchain():
     gcc_kwargs = _guess_toolchain_kwargs_from_python_config()
 
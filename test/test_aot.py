@@ -0,0 +1,76 @@
+import sys
+import pytest
+from subprocess import check_call
+
+MODULE_CODE = """
+extern "C" {
+    int const greet()
+    {
+        return 42;
+    }
+}
+"""
+
+
+def test_aot_export(tmpdir, monkeypatch):
+    from ctypes import CDLL
+    import codepy.aot
+    from pytools.prefork import ExecError
+    from codepy.aot import recording, export_package, find_aot_module
+    from codepy.jit import compile_from_string
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    record_file = str(tmpdir.join("record"))
+    with recording(record_file):
+        compile_from_string(toolchain, "module", MODULE_CODE,
+                cache_dir=str(tmpdir.mkdir("cache")))
+
+    output_dir = tmpdir.mkdir("package")
+    keys = export_package(record_file, str(output_dir), "codepy_aot_test")
+    assert len(keys) == 1
+
+    check_call([sys.executable, "setup.py", "-q", "build_ext", "--inplace"],
+            cwd=str(output_dir))
+
+    monkeypatch.syspath_prepend(str(output_dir))
+    monkeypatch.setenv("CODEPY_AOT_PACKAGES", "codepy_aot_test")
+    monkeypatch.setattr(codepy.aot, "_packages", None)
+
+    # found without running the compiler
+    toolchain = toolchain.copy(cc="codepy-no-such-compiler")
+    key, _, ext_file, recompiled = compile_from_string(toolchain, "module",
+            MODULE_CODE, cache_dir=str(tmpdir.mkdir("empty-cache")))
+    assert not recompiled
+    assert key == keys[0]
+    assert ext_file.startswith(str(output_dir))
+    assert CDLL(ext_file).greet() == 42
+
+    # not built with these flags
+    assert find_aot_module(toolchain.copy(defines=["CODEPY_TEST"]), "module",
+            [MODULE_CODE]) is None
+    with pytest.raises(ExecError):
+        compile_from_string(toolchain, "module", MODULE_CODE,
+                cache_dir=str(tmpdir.join("empty-cache")), aot=False)
+
+
+def test_aot_key():
+    from codepy.aot import get_aot_key, _get_toolchain_attributes
+    from codepy.toolchain import GCCToolchain
+
+    toolchain = GCCToolchain(cc="gcc", ld="gcc", cflags=["-O2"],
+            ldflags=[], include_dirs=[], library_dirs=[], libraries=[],
+            defines=[], undefines=[], so_ext=".so", o_ext=".o")
+
+    def key(toolchain, source=MODULE_CODE):
+        return get_aot_key("module", [source],
+                _get_toolchain_attributes(toolchain))
+
+    assert key(toolchain) == key(toolchain.copy())
+    assert key(toolchain) != key(toolchain, MODULE_CODE + "\n")
+    assert key(toolchain) != key(toolchain.copy(defines=["NDEBUG"]))
+    assert key(toolchain) != key(toolchain.copy(undefines=["NDEBUG"]))
+    assert key(toolchain) != key(toolchain.copy(cflags=["-O2", "-ffast-math"]))
+
+    # flags left out of exported packages
+    assert key(toolchain) == key(toolchain.copy(cflags=["-O2", "-march=native"]))
@@ -0,0 +1,81 @@
+import numpy
+import pytest
+
+
+def test_autotune(tmpdir):
+    from codepy.autotune import autotune
+
+    variants = [(2, []), (3, []), (3, ["-funroll-loops"])]
+    timings = {0: 3., 1: 1., 2: 2.}
+    built = []
+
+    def build(variant):
+        built.append(variant)
+        return variants.index(variant)
+
+    def benchmark(index):
+        return timings[index]
+
+    variant, result = autotune("key", variants, build, benchmark,
+            autotune_dir=str(tmpdir))
+    assert variant == (3, [])
+    assert result == 1
+    assert len(built) == 3
+
+    # the choice is remembered
+    del built[:]
+    variant, result = autotune("key", variants, build, benchmark,
+            autotune_dir=str(tmpdir))
+    assert variant == (3, [])
+    assert built == [(3, [])]
+
+
+@pytest.mark.parametrize("dtype", [numpy.float64, None])
+def test_autotune_lazy_kernels(tmpdir, monkeypatch, dtype):
+    import codepy.elementwise
+    from codepy import CompileError
+    from codepy.autotune import autotune_elementwise_kernel
+    from codepy.elementwise import VectorArg, set_compilation_mode
+
+    fields = {}
+    built = []
+
+    class FakeArgStruct(object):
+        def __setattr__(self, name, value):
+            fields[name] = value
+
+    class FakeModule(object):
+        ArgStruct = FakeArgStruct
+
+        def __init__(self, cflags):
+            self.cflags = cflags
+
+        def kernel(self, size, arg_struct):
+            pass
+
+        def kernel_range(self, start, stop, arg_struct):
+            pass
+
+    def get_elwise_module_binary(arguments, operation, name, toolchain,
+            *args):
+        built.append(toolchain.cflags)
+        if "-funroll-loops" in toolchain.cflags:
+            raise CompileError("unsupported variant")
+        return FakeModule(toolchain.cflags)
+
+    monkeypatch.setattr(codepy.elementwise, "get_elwise_module_binary",
+            get_elwise_module_binary)
+
+    set_compilation_mode(lazy=True)
+    try:
+        kernel = autotune_elementwise_kernel(
+                [VectorArg(dtype, "x")], "x[i] = 0", [numpy.zeros(10)],
+                variants=[(2, []), (3, ["-funroll-loops"])],
+                autotune_dir=str(tmpdir))
+    finally:
+        set_compilation_mode()
+
+    # all variants were built before the benchmarks ran
+    assert len(built) == 2
+    assert "-funroll-loops" not in kernel.specializations[
+            (numpy.dtype(numpy.float64),)].module.cflags
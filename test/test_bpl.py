@@ -0,0 +1,40 @@
+def make_function(name):
+    from cgen import FunctionBody, FunctionDeclaration, Value, Block, Statement
+    return FunctionBody(
+            FunctionDeclaration(Value("void", name), [Value("int", "n")]),
+            Block([Statement("compute(n)")]))
+
+
+def test_gil_release_guard():
+    from codepy.bpl import BoostPythonModule
+
+    mod = BoostPythonModule()
+    mod.add_function(make_function("holding"))
+    assert "codepy_scoped_gil_release" not in str(mod.generate())
+
+    mod.add_function(make_function("releasing"), release_gil=True)
+    mod.add_function(make_function("releasing_too"), release_gil=True)
+    source = str(mod.generate())
+
+    # declared once, before the functions using it
+    assert source.count("class codepy_scoped_gil_release") == 1
+    assert source.index("class codepy_scoped_gil_release") \
+            < source.index("void holding")
+
+    def function_source(name):
+        start = source.index("void %s(" % name)
+        return source[start:source.index("\n  }", start)]
+
+    assert "codepy_scoped_gil_release" not in function_source("holding")
+    for name in ["releasing", "releasing_too"]:
+        body = function_source(name)
+        # the guard is in scope for the whole call
+        assert body.index("codepy_scoped_gil_release codepy_gil_release;") \
+                < body.index("compute(n);")
+
+    # exposed under their original names
+    assert 'boost::python::def("releasing", &releasing);' in source
+
+
+if __name__ == "__main__":
+    test_gil_release_guard()
@@ -0,0 +1,420 @@
+MODULE_CODE = """
+extern "C" {
+    int const greet()
+    {
+        return %d;
+    }
+}
+"""
+
+
+def test_cache_layers(tmpdir):
+    from ctypes import CDLL
+    from codepy.jit import compile_from_string
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    base = tmpdir.mkdir("base")
+    overlay = tmpdir.mkdir("overlay")
+
+    _, _, base_file, recompiled = compile_from_string(toolchain, "module",
+            MODULE_CODE % 1, cache_dir=str(base))
+    assert recompiled
+
+    # served from the base layer, without touching the overlay
+    _, _, ext_file, recompiled = compile_from_string(toolchain, "module",
+            MODULE_CODE % 1, cache_dir=[str(base), str(overlay)])
+    assert not recompiled
+    assert ext_file == base_file
+    assert overlay.listdir() == []
+
+    # new entries go to the overlay
+    _, _, ext_file, recompiled = compile_from_string(toolchain, "module",
+            MODULE_CODE % 2, cache_dir=[str(base), str(overlay)])
+    assert recompiled
+    assert ext_file.startswith(str(overlay))
+    assert CDLL(ext_file).greet() == 2
+
+
+def test_fast_cache_tier(tmpdir, monkeypatch):
+    import shutil
+    from ctypes import CDLL
+    import codepy.jit
+    from codepy.jit import compile_from_string, wait_for_cache_writes
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    cache = tmpdir.mkdir("cache")
+    fast = tmpdir.mkdir("fast")
+    monkeypatch.setattr(codepy.jit, "_fast_cache_dir", str(fast))
+
+    checksum, _, ext_file, recompiled = compile_from_string(toolchain,
+            "module", MODULE_CODE % 3, cache_dir=str(cache))
+    assert recompiled
+    assert ext_file.startswith(str(fast))
+    assert CDLL(ext_file).greet() == 3
+
+    # written to the persistent cache in the background
+    wait_for_cache_writes()
+    assert cache.join(checksum[:2], checksum, "info").check()
+
+    _, _, ext_file_2, recompiled = compile_from_string(toolchain,
+            "module", MODULE_CODE % 3, cache_dir=str(cache))
+    assert not recompiled
+    assert ext_file_2 == ext_file
+
+    # copied back from the persistent cache
+    shutil.rmtree(str(fast.join(checksum[:2], checksum)))
+    _, _, ext_file_3, recompiled = compile_from_string(toolchain,
+            "module", MODULE_CODE % 3, cache_dir=str(cache))
+    assert not recompiled
+    assert ext_file_3 == ext_file
+
+
+def test_fast_cache_tier_concurrency(tmpdir, monkeypatch):
+    from threading import Thread
+    import codepy.jit
+    from codepy.cache import read_accesses
+    from codepy.jit import compile_from_string, wait_for_cache_writes
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    cache = tmpdir.mkdir("cache")
+    monkeypatch.setattr(codepy.jit, "_fast_cache_dir", str(tmpdir.mkdir("fast")))
+    monkeypatch.setattr(codepy.jit, "_record_accesses", True)
+
+    builds = []
+    build_entry = codepy.jit._build_entry
+
+    def counting_build_entry(*args, **kwargs):
+        builds.append(args)
+        return build_entry(*args, **kwargs)
+
+    monkeypatch.setattr(codepy.jit, "_build_entry", counting_build_entry)
+
+    results = []
+
+    def compile():
+        results.append(compile_from_string(toolchain, "module",
+            MODULE_CODE % 4, cache_dir=str(cache)))
+
+    threads = [Thread(target=compile) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wait_for_cache_writes()
+
+    assert len(builds) == 1
+    assert len(set(ext_file for _, _, ext_file, _ in results)) == 1
+
+    # written in batches, but complete once read
+    assert not cache.join("accesses").check()
+    checksum = results[0][0]
+    hits, misses, _ = read_accesses(str(cache))[checksum]
+    assert (hits, misses) == (3, 1)
+
+
+def test_negative_cache(tmpdir, monkeypatch):
+    import pytest
+    import codepy.jit
+    import codepy.toolchain
+    from codepy import CompileError
+    from codepy.jit import compile_from_string, clear_negative_cache
+    from codepy.toolchain import guess_toolchain
+
+    calls = []
+    call_with_limits = codepy.toolchain._call_with_limits
+
+    def counting_call_with_limits(cmdline, limits, **kwargs):
+        calls.append(cmdline)
+        return call_with_limits(cmdline, limits, **kwargs)
+
+    monkeypatch.setattr(codepy.toolchain, "_call_with_limits",
+            counting_call_with_limits)
+    monkeypatch.setattr(codepy.jit, "_negative_cache_ttl", 3600)
+
+    toolchain = guess_toolchain()
+    cache = str(tmpdir)
+
+    with pytest.raises(CompileError) as exc_info:
+        compile_from_string(toolchain, "module", "this is not C++",
+                cache_dir=cache)
+    assert "error" in exc_info.value.diagnostics
+    assert len(calls) == 1
+
+    # fails again without running the compiler
+    with pytest.raises(CompileError) as exc_info_2:
+        compile_from_string(toolchain, "module", "this is not C++",
+                cache_dir=cache)
+    assert exc_info_2.value.diagnostics == exc_info.value.diagnostics
+    assert len(calls) == 1
+
+    clear_negative_cache(cache)
+    with pytest.raises(CompileError):
+        compile_from_string(toolchain, "module", "this is not C++",
+                cache_dir=cache)
+    assert len(calls) == 2
+
+    # with layers, failures are remembered in the writable one
+    layers = [str(tmpdir.mkdir("base")), str(tmpdir.mkdir("overlay"))]
+    for i in range(2):
+        with pytest.raises(CompileError):
+            compile_from_string(toolchain, "module", "this is not C++ either",
+                    cache_dir=layers)
+    assert len(calls) == 3
+    clear_negative_cache(layers)
+    with pytest.raises(CompileError):
+        compile_from_string(toolchain, "module", "this is not C++ either",
+                cache_dir=layers)
+    assert len(calls) == 4
+
+
+def test_negative_cache_limits(tmpdir, monkeypatch):
+    import pytest
+    import codepy.jit
+    import codepy.toolchain
+    from codepy import CompileLimitError
+    from codepy.jit import compile_from_string
+    from codepy.toolchain import guess_toolchain
+
+    calls = []
+
+    def failing_call_with_limits(cmdline, limits, **kwargs):
+        calls.append(cmdline)
+        raise CompileLimitError("compilation timed out")
+
+    monkeypatch.setattr(codepy.toolchain, "_call_with_limits",
+            failing_call_with_limits)
+    monkeypatch.setattr(codepy.jit, "_negative_cache_ttl", 3600)
+
+    # not remembered, as it may succeed under less load
+    for i in range(2):
+        with pytest.raises(CompileLimitError):
+            compile_from_string(guess_toolchain(), "module", MODULE_CODE % 30,
+                    cache_dir=str(tmpdir))
+    assert len(calls) == 2
+
+
+def test_compile_error():
+    from six.moves.cPickle import dumps, loads
+    from codepy import CompileError
+
+    assert CompileError().args == ()
+    assert CompileError().diagnostics is None
+
+    error = loads(dumps(CompileError("failed", 1, diagnostics="error: x")))
+    assert error.args == ("failed", 1)
+    assert error.diagnostics == "error: x"
+
+
+def test_v5_migration_and_compression(tmpdir, monkeypatch):
+    import os
+    import shutil
+    from ctypes import CDLL
+    from six.moves.cPickle import dump
+    import codepy.jit
+    from codepy.jit import compile_from_string, _SourceInfo, _load_info
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    monkeypatch.setattr(codepy.jit, "_compress_artifacts", True)
+
+    cache = tmpdir.mkdir("cache")
+    built = tmpdir.mkdir("built")
+
+    def make_v5_entry(i):
+        """Return the checksum and directory of an entry of the v5 layout,
+        with uncompressed sources and info.
+        """
+        checksum, _, ext_file, _ = compile_from_string(toolchain, "module",
+                MODULE_CODE % i, cache_dir=str(built))
+        info = _load_info(str(built.join(checksum[:2], checksum, "info")))
+
+        v5_entry = cache.mkdir(checksum)
+        shutil.copy(ext_file, str(v5_entry.join(os.path.basename(ext_file))))
+        v5_entry.join("module.cpp").write(MODULE_CODE % i)
+        with open(str(v5_entry.join("info")), "wb") as outf:
+            dump(_SourceInfo(dependencies=info.dependencies,
+                source_name=info.source_name), outf)
+
+        return checksum, v5_entry
+
+    checksum, v5_entry = make_v5_entry(4)
+    _, _, ext_file, recompiled = compile_from_string(toolchain, "module",
+            MODULE_CODE % 4, cache_dir=str(cache))
+    assert not recompiled
+    assert CDLL(ext_file).greet() == 4
+
+    assert not v5_entry.check()
+    stored = os.listdir(str(cache.join(checksum[:2], checksum)))
+    assert sorted(stored) == sorted(
+            ["info", os.path.basename(ext_file) + codepy.jit.COMPRESSED_SUFFIX])
+
+    # left in place while a process of an older version holds the cache
+    _, v5_entry = make_v5_entry(5)
+    cache.join("lock").write("")
+    _, _, ext_file, recompiled = compile_from_string(toolchain, "module",
+            MODULE_CODE % 5, cache_dir=str(cache))
+    assert not recompiled
+    assert CDLL(ext_file).greet() == 5
+    assert v5_entry.check()
+
+
+def test_compression_format():
+    from six.moves.cPickle import dumps
+    from codepy.jit import _compress, _decompress, _is_compressed
+
+    data = dumps({"x": 1}, protocol=2)
+    assert not _is_compressed(data)
+    assert _is_compressed(_compress(data))
+    assert _decompress(_compress(data)) == data
+
+    import zlib
+    assert not _is_compressed(zlib.compress(data))
+
+
+def test_publish_entry(tmpdir):
+    from codepy.jit import _publish_entry
+
+    shard = tmpdir.mkdir("ab")
+    shard.mkdir("entry").join("old").write("old")
+    shard.mkdir("tmp-new").join("new").write("new")
+
+    _publish_entry(str(shard.join("tmp-new")), str(shard.join("entry")))
+    assert shard.listdir() == [shard.join("entry")]
+    assert shard.join("entry").listdir() == [shard.join("entry", "new")]
+
+
+def test_cache_administration(tmpdir, monkeypatch):
+    import os
+    import codepy.jit
+    from codepy.cache import (iter_entries, get_stats, verify_entry, prune,
+            export_entries, import_entries, read_accesses)
+    from codepy.jit import compile_from_string
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    cache = str(tmpdir.mkdir("cache"))
+    monkeypatch.setattr(codepy.jit, "_record_accesses", True)
+
+    for i in range(2):
+        compile_from_string(toolchain, "module", MODULE_CODE % (10 + i),
+                cache_dir=cache)
+    compile_from_string(toolchain, "module", MODULE_CODE % 10,
+            cache_dir=cache)
+
+    stats = get_stats(cache)
+    assert stats["entries"] == 2
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+    assert len(stats["slowest"]) == 2
+
+    entries = list(iter_entries(cache))
+    assert all(entry.compiler.startswith(toolchain.cc) for entry in entries)
+    assert [verify_entry(entry) for entry in entries] == [[], []]
+
+    archive = str(tmpdir.join("entries.tar.gz"))
+    assert export_entries(archive, cache) == 2
+    other_cache = str(tmpdir.mkdir("other-cache"))
+    assert import_entries(archive, other_cache) == 2
+    assert import_entries(archive, other_cache) == 0
+
+    # served from the imported entries
+    _, _, _, recompiled = compile_from_string(toolchain, "module",
+            MODULE_CODE % 11, cache_dir=other_cache)
+    assert not recompiled
+
+    compile_from_string(toolchain, "module", MODULE_CODE % 10,
+            cache_dir=cache, key=("greet", 10))
+
+    assert len(prune(cache, max_size=0, dry_run=True)) == 2
+    assert len(list(iter_entries(cache))) == 2
+    assert len(prune(cache, max_size=0)) == 2
+    assert list(iter_entries(cache)) == []
+
+    # nothing else of them is left behind
+    from glob import glob
+    assert glob(os.path.join(cache, "*", "*.lock")) == []
+    assert glob(os.path.join(cache, "keys", "*", "*")) == []
+    assert read_accesses(cache) == {}
+
+
+def test_removed_lock_file(tmpdir):
+    import os
+    from threading import Thread
+    from codepy.jit import CleanupManager, EntryLockManager
+
+    entry_dir = str(tmpdir.join("ab", "entry"))
+    holder_m = CleanupManager()
+    holder = EntryLockManager(holder_m, entry_dir)
+
+    waiter_m = CleanupManager()
+    waiters = []
+    thread = Thread(target=lambda:
+            waiters.append(EntryLockManager(waiter_m, entry_dir)))
+    thread.start()
+
+    holder.remove_lock_file()
+    holder_m.clean_up()
+    thread.join()
+
+    # locked anew, rather than the removed file
+    assert os.fstat(waiters[0].fd).st_ino == os.stat(entry_dir + ".lock").st_ino
+    waiter_m.clean_up()
+
+
+def test_user_keys(tmpdir):
+    from ctypes import CDLL
+    from codepy.jit import compile_from_string
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    cache = str(tmpdir)
+    generated = []
+
+    def make_generator(value):
+        def generate():
+            generated.append(value)
+            return MODULE_CODE % value
+        return generate
+
+    _, _, ext_file, recompiled = compile_from_string(toolchain, "module",
+            make_generator(20), cache_dir=cache, key=("greet", 20))
+    assert recompiled
+    assert generated == [20]
+
+    # found by the key, without generating the source
+    _, _, ext_file_2, recompiled = compile_from_string(toolchain, "module",
+            make_generator(20), cache_dir=cache, key=("greet", 20))
+    assert not recompiled
+    assert ext_file_2 == ext_file
+    assert generated == [20]
+    assert CDLL(ext_file_2).greet() == 20
+
+    _, _, ext_file_3, recompiled = compile_from_string(toolchain, "module",
+            make_generator(21), cache_dir=cache, key=("greet", 21))
+    assert recompiled
+    assert generated == [20, 21]
+    assert CDLL(ext_file_3).greet() == 21
+
+
+def test_user_keys_in_base_layer(tmpdir):
+    from codepy.jit import compile_from_string
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    base = tmpdir.mkdir("base")
+    overlay = tmpdir.mkdir("overlay")
+
+    _, _, base_file, recompiled = compile_from_string(toolchain, "module",
+            MODULE_CODE % 22, cache_dir=str(base), key=("greet", 22))
+    assert recompiled
+
+    def generate():
+        raise AssertionError("source generated despite the key")
+
+    # found by the key published in the base layer
+    _, _, ext_file, recompiled = compile_from_string(toolchain, "module",
+            generate, cache_dir=[str(base), str(overlay)], key=("greet", 22))
+    assert not recompiled
+    assert ext_file == base_file
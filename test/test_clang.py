@@ -0,0 +1,88 @@
+import json
+
+
+def test_clang_version():
+    from codepy.toolchain import ClangToolchain
+
+    toolchain = ClangToolchain(cc="clang++", cflags=[])
+    toolchain.get_version = lambda: (
+            "Ubuntu clang version 14.0.6-2\n"
+            "Target: x86_64-pc-linux-gnu\n")
+    assert toolchain.get_version_tuple() == (14, 0, 6)
+
+
+def test_summarize_time_trace(tmpdir):
+    from codepy.toolchain import summarize_time_trace
+
+    def event(name, dur, detail=None):
+        result = {"ph": "X", "name": name, "ts": 0, "dur": dur}
+        if detail is not None:
+            result["args"] = {"detail": detail}
+        return result
+
+    for i in range(2):
+        with open(str(tmpdir.join("module%d.json" % i)), "w") as outf:
+            json.dump({"traceEvents": [
+                event("ExecuteCompiler", 9000000),
+                event("Total Source", 5000000),
+                event("Source", 3000000, "vector"),
+                event("InstantiateFunction", 1000000, "f<int>"),
+                {"ph": "M", "name": "process_name"},
+                ]}, outf)
+
+    assert summarize_time_trace(str(tmpdir)) == [
+            (6.0, "Source", "vector"),
+            (2.0, "InstantiateFunction", "f<int>"),
+            ]
+    assert summarize_time_trace(
+            [str(tmpdir.join("module0.json"))], count=1) == [
+            (3.0, "Source", "vector"),
+            ]
+
+
+def test_clang_lto(monkeypatch):
+    import codepy.toolchain
+    from codepy.toolchain import ClangToolchain
+
+    toolchain = ClangToolchain(cc="clang++", cflags=["-O2"], ldflags=[])
+    toolchain.get_version = lambda: "clang version 14.0.6\n"
+
+    def set_linkers(linkers):
+        monkeypatch.setattr(codepy.toolchain, "_which",
+                lambda program: "/usr/bin/" + program
+                if program in linkers else None)
+
+    def get_lto_flags(**kwargs):
+        result = toolchain.with_optimization_level(3, lto=True, **kwargs)
+        return ([f for f in result.cflags if f.startswith("-flto")],
+                [f for f in result.ldflags if f.startswith("-fuse-ld")])
+
+    # the default linker cannot do ThinLTO
+    set_linkers([])
+    assert get_lto_flags() == (["-flto"], [])
+    assert get_lto_flags(linker="gold") == (["-flto"], ["-fuse-ld=gold"])
+
+    set_linkers(["ld.lld"])
+    assert get_lto_flags() == (["-flto=thin"], ["-fuse-ld=lld"])
+    assert get_lto_flags(linker="auto") == (["-flto=thin"], ["-fuse-ld=lld"])
+
+
+def test_pgo_fallback(tmpdir, monkeypatch):
+    import pytest
+    from ctypes import CDLL
+    from codepy.jit import compile_from_string
+    from codepy.toolchain import GCCToolchain, guess_toolchain
+
+    def with_profile_generate(self, profile_dir):
+        raise NotImplementedError
+
+    monkeypatch.setattr(GCCToolchain, "with_profile_generate",
+            with_profile_generate)
+
+    with pytest.warns(UserWarning, match="profile-guided"):
+        _, _, ext_file, recompiled = compile_from_string(guess_toolchain(),
+                "module", 'extern "C" int greet() { return 7; }',
+                cache_dir=str(tmpdir), pgo=True)
+    assert recompiled
+    assert not tmpdir.join("pgo").check()
+    assert CDLL(ext_file).greet() == 7
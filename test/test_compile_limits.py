@@ -0,0 +1,122 @@
+import pytest
+
+
+def test_compile_slots(tmpdir):
+    from threading import Thread, Lock
+    from time import sleep
+    from codepy.toolchain import CompileLimits, compile_slot
+
+    limits = CompileLimits(slots=2, slot_dir=str(tmpdir))
+    lock = Lock()
+    running = [0]
+    max_running = [0]
+
+    def compile():
+        with compile_slot(limits):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            sleep(0.1)
+            with lock:
+                running[0] -= 1
+
+    threads = [Thread(target=compile) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max_running[0] == 2
+
+
+def test_compile_timeout(tmpdir):
+    from time import time
+    from codepy import CompileError
+    from codepy.toolchain import CompileLimits, _call_with_limits
+
+    limits = CompileLimits(timeout=0.2, slot_dir=str(tmpdir))
+    start = time()
+    with pytest.raises(CompileError):
+        _call_with_limits(["sleep", "10"], limits)
+    assert time() - start < 5
+
+    assert _call_with_limits(["true"], limits)[0] == 0
+
+
+def test_output_streaming(tmpdir, monkeypatch):
+    import sys
+    from time import time
+    from codepy.toolchain import CompileLimits, _call_with_limits
+
+    writes = []
+
+    class RecordingStream(object):
+        def write(self, text):
+            writes.append((time(), text))
+
+        def flush(self):
+            pass
+
+    monkeypatch.setattr(sys, "stderr", RecordingStream())
+
+    limits = CompileLimits(timeout=10, slot_dir=str(tmpdir))
+    result, stdout, stderr = _call_with_limits(
+            ["sh", "-c", "echo first >&2; sleep 0.5; echo second >&2"],
+            limits, echo=True)
+    finished = time()
+
+    assert result == 0
+    assert stderr == b"first\nsecond\n"
+    assert "".join(text for _, text in writes) == "first\nsecond\n"
+    # passed through while the compiler was still running
+    assert finished - writes[0][0] > 0.3
+
+
+def test_output_without_limits(monkeypatch):
+    import sys
+    import pytools.prefork
+    from six import StringIO
+    from codepy.toolchain import CompileLimits, _call_with_limits
+
+    calls = []
+    call_capture_output = pytools.prefork.call_capture_output
+
+    def recording_call_capture_output(cmdline, **kwargs):
+        calls.append(cmdline)
+        return call_capture_output(cmdline, **kwargs)
+
+    monkeypatch.setattr(pytools.prefork, "call_capture_output",
+            recording_call_capture_output)
+    output = StringIO()
+    monkeypatch.setattr(sys, "stderr", output)
+
+    cmdline = ["sh", "-c", "echo out; echo err >&2"]
+    assert _call_with_limits(cmdline, CompileLimits(), echo=True) \
+            == (0, b"out\n", b"err\n")
+
+    # forked through pytools.prefork, not by this process
+    assert calls == [cmdline]
+    assert output.getvalue() == "err\n"
+
+
+def test_out_of_memory(tmpdir, monkeypatch):
+    import codepy.toolchain
+    from codepy import CompileError, CompileLimitError
+    from codepy.toolchain import CompileLimits, guess_toolchain
+
+    def set_limits(memory):
+        monkeypatch.setattr(codepy.toolchain, "get_compile_limits",
+                lambda: CompileLimits(memory=memory, slot_dir=str(tmpdir)))
+
+    toolchain = guess_toolchain()
+    cmdline = ["sh", "-c", "echo 'cc1plus: out of memory' >&2; exit 1"]
+
+    set_limits(1 << 30)
+    with pytest.raises(CompileLimitError):
+        toolchain._run_compiler(cmdline)
+
+    # only the limits make running out of memory a limit error
+    set_limits(None)
+    with pytest.raises(CompileError) as exc_info:
+        toolchain._run_compiler(cmdline)
+    assert not isinstance(exc_info.value, CompileLimitError)
@@ -0,0 +1,111 @@
+import pytest
+
+
+@pytest.fixture
+def server_socket(tmpdir):
+    from threading import Thread
+    from codepy.server import CompileServer, CompileServerClient
+
+    socket_path = str(tmpdir.join("server", "socket"))
+    server = CompileServer(socket_path, max_jobs=2)
+    thread = Thread(target=server.serve_forever)
+    thread.start()
+
+    client = CompileServerClient(socket_path)
+    from time import sleep
+    while not client.ping():
+        sleep(0.01)
+
+    yield socket_path
+
+    client.shutdown()
+    thread.join()
+
+
+def test_compile_server(server_socket):
+    from codepy import CompileError
+    from codepy.server import CompileServerClient
+
+    client = CompileServerClient(server_socket)
+
+    assert client.call_capture_output(["sh", "-c", "echo out; echo err >&2"]) \
+            == (0, b"out\n", b"err\n")
+    assert client.call_capture_output(["pwd"], "/")[1] == b"/\n"
+    assert client.run(["false"]) == 1
+
+    with pytest.raises(CompileError):
+        client.run(["sleep", "10"], timeout=0.2)
+
+
+def test_memory_limit(server_socket):
+    import sys
+    from codepy.server import CompileServerClient
+
+    client = CompileServerClient(server_socket)
+    memory = 256 << 20
+
+    # inherited by the processes the command starts
+    result, stdout, _ = client.call_capture_output(
+            ["sh", "-c", "sh -c 'ulimit -v'"], memory=memory)
+    assert (result, stdout) == (0, b"%d\n" % (memory // 1024))
+    assert client.call_capture_output(["sh", "-c", "ulimit -v"], "/",
+            memory=memory)[1] == b"%d\n" % (memory // 1024)
+
+    allocate = [sys.executable, "-c", "bytearray(%d)" % (2*memory)]
+    assert client.run(allocate) == 0
+    assert client.run(["sh", "-c", '"$@"', "sh"] + allocate,
+            memory=memory) != 0
+
+
+def test_compile_through_server(server_socket, tmpdir):
+    from ctypes import CDLL
+    from codepy.jit import compile_from_string
+    from codepy.server import connect_compile_server, disconnect_compile_server
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    connect_compile_server(server_socket)
+    try:
+        _, _, ext_file, _ = compile_from_string(toolchain, "module",
+                'extern "C" int greet() { return 1; }',
+                cache_dir=str(tmpdir))
+    finally:
+        disconnect_compile_server()
+
+    assert CDLL(ext_file).greet() == 1
+
+
+def test_insecure_socket_dir(tmpdir):
+    import os
+    from codepy.server import CompileServer, CompileServerClient
+
+    socket_dir = tmpdir.join("shared")
+    socket_dir.mkdir()
+    os.chmod(str(socket_dir), 0o777)
+    socket_path = str(socket_dir.join("socket"))
+
+    with pytest.raises(RuntimeError):
+        CompileServer(socket_path).serve_forever()
+    with pytest.raises(RuntimeError):
+        CompileServerClient(socket_path).ping()
+
+    os.symlink(str(tmpdir.mkdir("private")), str(tmpdir.join("link")))
+    os.chmod(str(tmpdir.join("private")), 0o700)
+    with pytest.raises(RuntimeError):
+        CompileServerClient(str(tmpdir.join("link", "socket"))).ping()
+
+
+def test_no_client_slots_with_server(server_socket, tmpdir):
+    from codepy.server import connect_compile_server, disconnect_compile_server
+    from codepy.toolchain import (CompileLimits, compile_slot,
+            _client_compile_slot)
+
+    limits = CompileLimits(slots=1, slot_dir=str(tmpdir))
+    connect_compile_server(server_socket)
+    try:
+        # would wait forever if it took the slot
+        with compile_slot(limits):
+            with _client_compile_slot(limits):
+                pass
+    finally:
+        disconnect_compile_server()
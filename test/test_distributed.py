@@ -0,0 +1,118 @@
+MODULE_CODE = """
+extern "C" {
+    int const greet()
+    {
+        return %d;
+    }
+}
+"""
+
+
+def test_remote_build(tmpdir):
+    from ctypes import CDLL
+    from codepy.distributed import RemoteExecutor, spawn_local_workers
+    from codepy.jit import compile_from_string
+    from codepy.toolchain import guess_toolchain
+
+    addresses, processes = spawn_local_workers(2, max_jobs=1, token="secret")
+    executor = RemoteExecutor(addresses, token="secret")
+    try:
+        toolchain = guess_toolchain().with_optimization_level(2) \
+                .with_executor(executor)
+
+        for i in range(3):
+            _, _, ext_file, _ = compile_from_string(toolchain, "module",
+                    MODULE_CODE % i, cache_dir=str(tmpdir))
+            assert CDLL(ext_file).greet() == i
+
+        assert executor.stats == {"remote": 3, "local": 0}
+    finally:
+        executor.shutdown_workers()
+        for proc in processes:
+            proc.wait()
+
+
+def test_remote_build_fallback(tmpdir):
+    import socket
+    from ctypes import CDLL
+    from codepy.distributed import RemoteExecutor
+    from codepy.jit import compile_from_string
+    from codepy.toolchain import guess_toolchain
+
+    # a port nobody listens on
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    address = sock.getsockname()
+    sock.close()
+
+    executor = RemoteExecutor([address])
+    toolchain = guess_toolchain().with_executor(executor)
+    _, _, ext_file, _ = compile_from_string(toolchain, "module",
+            MODULE_CODE % 5, cache_dir=str(tmpdir))
+    assert CDLL(ext_file).greet() == 5
+    assert executor.stats == {"remote": 0, "local": 1}
+
+
+def test_worker_checks_requests(monkeypatch):
+    import pytest
+    from threading import Thread
+    from codepy.distributed import BuildWorker, RemoteExecutor
+
+    monkeypatch.delenv("CODEPY_BUILD_TOKEN", raising=False)
+    with pytest.raises(ValueError):
+        BuildWorker()
+
+    worker = BuildWorker(token="secret")
+    thread = Thread(target=worker.serve_forever)
+    thread.start()
+
+    executor = RemoteExecutor([worker.address], token="secret")
+    try:
+        with pytest.raises(RuntimeError, match="token"):
+            RemoteExecutor([worker.address], token="guess")._request(
+                    worker.address, {"type": "version", "cc": "gcc"})
+
+        for cc in ["/tmp/gcc", "./gcc", "sh"]:
+            with pytest.raises(RuntimeError, match="not allowed"):
+                executor._request(worker.address,
+                        {"type": "version", "cc": cc})
+
+        for flag in ["-B/tmp", "-wrapper", "-fplugin=/tmp/evil.so",
+                "-specs=/tmp/evil", "-o/tmp/out", "@/etc/passwd",
+                "-Wa,-a=/tmp/out", "-Xassembler", "-Xlinker", "-Wl,-v",
+                "-fopt-info-all=/tmp/out", "-fopt-info", "-aux-info",
+                "-fdump-tree-all", "-fprofile-generate=/tmp/out",
+                "-fprofile-use=profile", "-ftime-trace=/tmp/out", "-MF",
+                "-include", "-I/etc", "/etc/passwd", "-fplugin=evil",
+                "-mllvm"]:
+            with pytest.raises(RuntimeError, match="not allowed"):
+                executor._request(worker.address, {"type": "compile",
+                    "cc": "gcc", "args": ["-O2", flag], "suffix": ".i"},
+                    b"int x;")
+
+        header, obj = executor._request(worker.address, {"type": "compile",
+            "cc": "gcc", "args": ["-O2", "-fPIC", "-march=x86-64", "-DX=1",
+                "-std=c99", "-Wall", "-Wno-unused", "-g",
+                "--param=max-inline-insns-single=100"],
+            "suffix": ".i"}, b"int x;")
+        assert header["returncode"] == 0 and obj
+    finally:
+        executor.shutdown_workers()
+        thread.join()
+
+
+def test_remote_flags():
+    from codepy.distributed import RemoteExecutor
+    from codepy.toolchain import guess_toolchain
+
+    executor = RemoteExecutor([])
+    toolchain = guess_toolchain()
+
+    # link flags do not matter for object files
+    flags = executor._get_remote_flags(toolchain.copy(
+        cflags=["-O2", "-L/usr/lib", "-Wl,-rpath,/usr/lib", "-fPIC"]))
+    assert flags == ["-O2", "-fPIC"]
+
+    # built locally rather than refused
+    assert executor._get_remote_flags(toolchain.copy(
+        cflags=["-O2", "-include", "config.h"])) is None
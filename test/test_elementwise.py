@@ -0,0 +1,380 @@
+import numpy
+import pytest
+
+from codepy.elementwise import VectorArg
+
+
+def require_pyublas():
+    # building the kernels needs Boost.Python and PyUblas, which you
+    # probably don't have installed where I am looking for them
+    pytest.importorskip("pyublas")
+
+
+def test_scan_inclusive():
+    require_pyublas()
+    from codepy.elementwise import ScanKernel
+
+    scan = ScanKernel(numpy.int64,
+            [VectorArg(numpy.int64, "x"), VectorArg(numpy.int64, "out")],
+            input_expr="x[i]", scan_expr="a+b",
+            output_statement="out[i] = item", block_size=16)
+
+    x = numpy.random.randint(-10, 10, 1000).astype(numpy.int64)
+    out = numpy.empty_like(x)
+    assert scan(x, out) == x.sum()
+    assert (out == numpy.cumsum(x)).all()
+
+    empty = numpy.empty(0, numpy.int64)
+    assert scan(empty, empty) == 0
+
+
+def test_scan_exclusive():
+    require_pyublas()
+    from codepy.elementwise import ScanKernel
+
+    scan = ScanKernel(numpy.int64,
+            [VectorArg(numpy.int64, "x"), VectorArg(numpy.int64, "out")],
+            input_expr="x[i]", scan_expr="a > b ? a : b",
+            output_statement="out[i] = item",
+            neutral="-100", inclusive=False, block_size=16)
+
+    x = numpy.random.randint(-10, 10, 1000).astype(numpy.int64)
+    out = numpy.empty_like(x)
+    assert scan(x, out) == x.max()
+    assert out[0] == -100
+    assert (out[1:] == numpy.maximum.accumulate(x)[:-1]).all()
+
+    empty = numpy.empty(0, numpy.int64)
+    assert scan(empty, empty) == -100
+
+
+def test_scan_segmented():
+    require_pyublas()
+    from codepy.elementwise import ScanKernel
+
+    scan = ScanKernel(numpy.int64,
+            [VectorArg(numpy.int64, "x"), VectorArg(numpy.int8, "starts"),
+                VectorArg(numpy.int64, "out")],
+            input_expr="x[i]", scan_expr="a+b",
+            output_statement="out[i] = item",
+            is_segment_start_expr="starts[i]", block_size=16)
+
+    x = numpy.random.randint(-10, 10, 1000).astype(numpy.int64)
+    starts = (numpy.random.rand(1000) < 0.05).astype(numpy.int8)
+    out = numpy.empty_like(x)
+    result = scan(x, starts, out)
+
+    expected = numpy.empty_like(x)
+    acc = 0
+    for i in range(len(x)):
+        acc = x[i] if starts[i] or i == 0 else acc + x[i]
+        expected[i] = acc
+
+    assert (out == expected).all()
+    assert result == expected[-1]
+
+
+def test_scan_empty_source():
+    from codepy.elementwise import get_scan_module_descriptor
+
+    source = str(get_scan_module_descriptor(numpy.uint64,
+        [VectorArg(numpy.uint64, "x")], "x[i]", "a+b", "",
+        neutral="7", inclusive=False).generate())
+    assert "typedef unsigned long codepy_scan_type;" in source
+    assert "return codepy_scan_type(7);" in source
+
+
+def test_reduction():
+    require_pyublas()
+    from codepy.elementwise import ReductionKernel
+
+    x = numpy.random.rand(10000)
+
+    dot = ReductionKernel(numpy.float64, neutral="0",
+            reduce_expr="a+b", map_expr="x[i]*x[i]",
+            arguments=[VectorArg(numpy.float64, "x")], block_size=64)
+    assert numpy.allclose(dot(x), numpy.dot(x, x))
+
+    maximum = ReductionKernel(numpy.float64, neutral="-1",
+            reduce_expr="a > b ? a : b", map_expr="x[i]",
+            arguments=[VectorArg(numpy.float64, "x")], name="maximum",
+            parallel=True)
+    assert maximum(x) == x.max()
+    assert maximum(numpy.empty(0)) == -1
+
+
+def test_batched_source():
+    from codepy.elementwise import get_elwise_module_descriptor
+
+    def get_source(**kwargs):
+        return str(get_elwise_module_descriptor(
+            [VectorArg(numpy.float64, "x")], "x[i] *= 2", name="double",
+            **kwargs).generate())
+
+    source = get_source()
+    assert "double_batched" not in source
+    assert "double_ragged" not in source
+    assert "#include <vector>" not in source
+
+    source = get_source(batched=True)
+    assert "double_batched" in source
+    assert "double_ragged" in source
+    assert "#include <vector>" in source
+
+
+def test_batched_needs_batched_kernel():
+    from codepy.elementwise import ElementwiseKernel
+
+    kernel = ElementwiseKernel([VectorArg(numpy.float64, "x")], "x[i] *= 2",
+            lazy=True)
+    x = numpy.ones(10)
+    with pytest.raises(ValueError):
+        kernel.call_batched([(x,)])
+    with pytest.raises(ValueError):
+        kernel.call_ragged([0, 5, 10], x)
+
+
+def test_batched():
+    require_pyublas()
+    from codepy.elementwise import ElementwiseKernel
+
+    kernel = ElementwiseKernel(
+            [VectorArg(numpy.int64, "x")], "x[i] += codepy_launch + 1",
+            batched=True)
+
+    xs = [numpy.zeros(n, numpy.int64) for n in [3, 0, 5]]
+    kernel.call_batched([(x,) for x in xs])
+    for launch, x in enumerate(xs):
+        assert (x == launch + 1).all()
+
+    x = numpy.zeros(10, numpy.int64)
+    kernel.call_ragged([0, 4, 4, 10], x)
+    assert (x == [1]*4 + [3]*6).all()
+
+
+def test_generic_dtypes():
+    from codepy.elementwise import ElementwiseKernel, ScalarArg
+
+    kernel = ElementwiseKernel([
+            ScalarArg(None, "a"), VectorArg(None, "x"), VectorArg(None, "y"),
+            VectorArg(numpy.float32, "z")],
+            "z[i] = a*x[i] + y[i]", lazy=True)
+
+    x32 = numpy.ones(3, numpy.float32)
+    x64 = numpy.ones(3, numpy.float64)
+    i32 = numpy.ones(3, numpy.int32)
+
+    def dtypes(*args):
+        return tuple(numpy.dtype(dtype)
+                for dtype in kernel._get_arg_dtypes(args))
+
+    f32, f64 = numpy.dtype(numpy.float32), numpy.dtype(numpy.float64)
+
+    # taken from the values given
+    assert dtypes(numpy.float32(2), x32, x64, x32) == (f32, f32, f64, f32)
+    # zero placeholders for vectors promote the given vectors, which
+    # include those of fixed dtype
+    assert dtypes(numpy.float32(2), i32, 0, x32)[2] \
+            == numpy.result_type(numpy.int32, numpy.float32)
+    # Python scalars take part in promotion with the vectors
+    assert dtypes(2, x32, x32, x32)[0] == numpy.result_type(x32, 2)
+
+
+def test_generic_dtypes_placeholders_only():
+    from codepy.elementwise import ElementwiseKernel
+
+    kernel = ElementwiseKernel([VectorArg(None, "x"), VectorArg(None, "y")],
+            "y[i] = x[i]", lazy=True)
+
+    assert kernel._get_arg_dtypes((numpy.ones(3, numpy.int16), 0)) \
+            == (numpy.dtype(numpy.int16),)*2
+
+    with pytest.raises(ValueError, match="x, y"):
+        kernel._get_arg_dtypes((0, 0))
+
+
+class _FakeModule(object):
+    def kernel(self, *args):
+        pass
+
+    def kernel_range(self, *args):
+        pass
+
+
+def fake_module_binary(monkeypatch, compiled, wait_for=None):
+    """Replace building kernels by returning a :class:`_FakeModule`, and
+    record the operations of the kernels built in *compiled*.
+    """
+    import codepy.elementwise
+
+    def get_elwise_module_binary(arguments, operation, name, *args):
+        if wait_for is not None:
+            wait_for.wait()
+        compiled.append(operation)
+        return _FakeModule()
+
+    monkeypatch.setattr(codepy.elementwise, "get_elwise_module_binary",
+            get_elwise_module_binary)
+
+
+def test_lazy_compilation(monkeypatch):
+    from codepy.elementwise import ElementwiseKernel, set_compilation_mode
+
+    compiled = []
+    fake_module_binary(monkeypatch, compiled)
+    arguments = [VectorArg(numpy.float64, "x")]
+
+    ElementwiseKernel(arguments, "x[i] = 0")
+    assert compiled == ["x[i] = 0"]
+
+    set_compilation_mode(lazy=True)
+    try:
+        kernel = ElementwiseKernel(arguments, "x[i] = 1")
+        assert compiled == ["x[i] = 0"]
+        assert ElementwiseKernel(arguments, "x[i] = 2", lazy=False).func
+        assert compiled == ["x[i] = 0", "x[i] = 2"]
+
+        assert kernel.func
+        assert kernel.func
+        assert compiled == ["x[i] = 0", "x[i] = 2", "x[i] = 1"]
+    finally:
+        set_compilation_mode()
+
+    ElementwiseKernel(arguments, "x[i] = 3")
+    assert compiled[-1] == "x[i] = 3"
+
+
+def test_background_compilation(monkeypatch):
+    from threading import Event, Timer
+    from codepy.elementwise import ElementwiseKernel, set_compilation_mode
+
+    compiled = []
+    built = Event()
+    fake_module_binary(monkeypatch, compiled, wait_for=built)
+    arguments = [VectorArg(numpy.float64, "x")]
+
+    set_compilation_mode(background=True, max_workers=1)
+    try:
+        kernels = [ElementwiseKernel(arguments, "x[i] = %d" % i)
+                for i in range(3)]
+        assert compiled == []
+        built.set()
+        assert kernels[1].func
+        assert "x[i] = 1" in compiled
+
+        built.clear()
+        kernels.append(ElementwiseKernel(arguments, "x[i] = 3"))
+        Timer(0.1, built.set).start()
+    finally:
+        # waits for the compiles still queued
+        set_compilation_mode()
+
+    assert sorted(compiled) == ["x[i] = %d" % i for i in range(4)]
+    for kernel in kernels:
+        assert kernel.func
+    assert len(compiled) == 4
+
+
+def test_call_chunked(tmpdir):
+    require_pyublas()
+    from codepy.elementwise import ElementwiseKernel, ScalarArg
+
+    kernel = ElementwiseKernel(
+            [VectorArg(numpy.float64, "x"), VectorArg(numpy.float64, "out"),
+                ScalarArg(numpy.float64, "a")],
+            "out[i] = a*x[i] + i")
+
+    size = 100003
+    x = numpy.memmap(str(tmpdir.join("x")), dtype=numpy.float64, mode="w+",
+            shape=(size,))
+    x[:] = numpy.random.rand(size)
+    expected = numpy.empty(size)
+    kernel(x, expected, 3)
+
+    for prefetch in [False, True]:
+        out = numpy.memmap(str(tmpdir.join("out")), dtype=numpy.float64,
+                mode="w+", shape=(size,))
+        kernel.call_chunked(x, out, 3, chunk_bytes=1 << 16, prefetch=prefetch)
+        # the indices are those of the whole arrays, not of the chunks
+        assert (out == expected).all()
+
+
+def test_range_source():
+    from codepy.elementwise import get_elwise_module_descriptor
+
+    source = str(get_elwise_module_descriptor(
+        [VectorArg(numpy.float64, "x")], "x[i] = i", name="iota").generate())
+
+    assert source.count("x[i] = i;") == 1
+    assert "for (npy_uintp i = codepy_start; i < codepy_stop; ++i)" in source
+    assert "codepy_run_range(0, codepy_length, args);" in source
+    assert "codepy_run_range(codepy_start, codepy_stop, args);" in source
+    assert 'boost::python::def("iota_range", &iota_range);' in source
+
+
+def test_call_chunked_ranges(monkeypatch):
+    import codepy.elementwise
+    from codepy.elementwise import ElementwiseKernel, ScalarArg
+
+    fields = {}
+    ranges = []
+
+    class FakeArgStruct(object):
+        def __setattr__(self, name, value):
+            fields[name] = value
+
+    class FakeModule(object):
+        ArgStruct = FakeArgStruct
+
+        def kernel(self, *args):
+            pass
+
+        def kernel_range(self, start, stop, arg_struct):
+            ranges.append((start, stop))
+
+    monkeypatch.setattr(codepy.elementwise, "get_elwise_module_binary",
+            lambda *args: FakeModule())
+
+    kernel = ElementwiseKernel(
+            [VectorArg(numpy.float64, "x"), ScalarArg(numpy.float64, "a")],
+            "x[i] = a*i")
+    x = numpy.zeros((3, 5000))
+    kernel.call_chunked(x, 2, chunk_bytes=4096*8)
+
+    # each chunk sees the whole vector arguments
+    assert fields["x_ary"].size == x.size
+    assert fields["a"] == 2
+    assert ranges == [(0, 4096), (4096, 8192), (8192, 12288),
+            (12288, 15000)]
+
+
+def test_mapped_region_advice():
+    import mmap
+    from codepy.elementwise import _MappedRegion
+
+    if not hasattr(mmap.mmap, "madvise"):
+        pytest.skip("mmap.madvise is not available")
+
+    page = mmap.PAGESIZE
+    mapping = mmap.mmap(-1, 3*page + 800)
+    ary = numpy.frombuffer(mapping, dtype=numpy.float64)
+    region = _MappedRegion(mapping, may_discard=False)
+
+    advised = []
+
+    class RecordingMapping(object):
+        def __len__(self):
+            return len(mapping)
+
+        def madvise(self, advice, start, length):
+            mapping.madvise(advice, start, length)
+            advised.append((start, length))
+
+    region.mapping = RecordingMapping()
+    per_page = page // ary.itemsize
+
+    region.advise(ary, 1, 10, mmap.MADV_WILLNEED)
+    region.advise(ary, per_page + 1, 2*per_page + 1, mmap.MADV_WILLNEED)
+    region.advise(ary, 2*per_page, ary.size, mmap.MADV_WILLNEED)
+    region.advise(ary, 5, 5, mmap.MADV_WILLNEED)
+    assert advised == [(0, page), (page, 2*page), (2*page, page + 800)]
@@ -0,0 +1,43 @@
+import numpy
+
+
+def test_elwise_ufunc():
+    from codepy.elementwise import get_elwise_ufunc, ScalarArg, VectorArg
+
+    axpy = get_elwise_ufunc([
+            ScalarArg(numpy.float64, "a"),
+            VectorArg(numpy.float64, "x"),
+            VectorArg(numpy.float64, "y"),
+            VectorArg(numpy.float64, "z"),
+            ],
+            "z[i] = a*x[i] + y[i]", name="axpy",
+            dtype_signatures=[
+                (numpy.float32,)*4,
+                (numpy.float64,)*4,
+                ])
+
+    assert isinstance(axpy, numpy.ufunc)
+    assert axpy.nin == 3
+    assert axpy.nout == 1
+
+    x = numpy.random.rand(100)
+    y = numpy.random.rand(3, 100)
+
+    # broadcasting
+    assert numpy.allclose(axpy(5, x, y), 5*x + y)
+
+    # strided inputs
+    assert numpy.allclose(axpy(5, x[::2], y[:, 1::2]), 5*x[::2] + y[:, 1::2])
+
+    # out=
+    out = numpy.empty_like(x)
+    axpy(2, x, 1, out=out)
+    assert numpy.allclose(out, 2*x + 1)
+
+    # dtype dispatch
+    x32 = x.astype(numpy.float32)
+    assert axpy(numpy.float32(5), x32, x32).dtype == numpy.float32
+
+
+if __name__ == "__main__":
+    test_elwise_ufunc()
@@ -0,0 +1,101 @@
+import multiprocessing
+
+import pytest
+
+
+MODULE_CODE = """
+#include <Python.h>
+
+static PyObject *answer(PyObject *self, PyObject *args)
+{
+  return PyLong_FromLong(42);
+}
+
+static PyMethodDef methods[] = {
+  {"answer", answer, METH_NOARGS, ""},
+  {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef moddef = {
+  PyModuleDef_HEAD_INIT, "module", NULL, -1, methods
+};
+
+PyMODINIT_FUNC PyInit_module(void)
+{
+  return PyModule_Create(&moddef);
+}
+"""
+
+
+def build_in_group(comm, share, cache_dir, results):
+    from codepy.jit import extension_from_string, set_compile_group
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    if comm.rank != 0:
+        # only the leader may compile
+        toolchain = toolchain.copy(cc="/nonexistent/compiler")
+
+    set_compile_group(comm, share)
+    module = extension_from_string(toolchain, "module", MODULE_CODE,
+            cache_dir=cache_dir)
+    results.put((comm.rank, module.answer()))
+
+
+@pytest.mark.parametrize("share", ["path", "bytes"])
+def test_group_compile(tmpdir, share):
+    from codepy.group import make_pipe_communicators
+
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    processes = [
+            ctx.Process(target=build_in_group,
+                args=(comm, share, str(tmpdir), results))
+            for comm in make_pipe_communicators(3)]
+
+    for proc in processes:
+        proc.start()
+    for proc in processes:
+        proc.join(60)
+        assert proc.exitcode == 0
+
+    assert sorted(results.get() for proc in processes) == [
+            (0, 42), (1, 42), (2, 42)]
+
+
+def fail_in_group(comm, cache_dir, results):
+    from codepy.jit import extension_from_string
+    from codepy.jit import CompileGroup
+    from codepy.toolchain import guess_toolchain
+
+    # not a CompileError in the leader
+    toolchain = guess_toolchain().copy(cc="/nonexistent/compiler")
+    try:
+        extension_from_string(toolchain, "module", MODULE_CODE,
+                cache_dir=cache_dir, group=CompileGroup(comm))
+    except Exception as e:
+        results.put((comm.rank, type(e).__name__))
+    else:
+        results.put((comm.rank, None))
+
+
+def test_group_compile_error(tmpdir):
+    from codepy.group import make_pipe_communicators
+
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    processes = [
+            ctx.Process(target=fail_in_group,
+                args=(comm, str(tmpdir), results))
+            for comm in make_pipe_communicators(3)]
+
+    for proc in processes:
+        proc.start()
+    for proc in processes:
+        proc.join(60)
+        assert proc.exitcode == 0
+
+    results = sorted(results.get() for proc in processes)
+    assert [rank for rank, _ in results] == [0, 1, 2]
+    assert all(error is not None for _, error in results)
+    assert [error for _, error in results[1:]] == ["CompileError"] * 2
@@ -0,0 +1,83 @@
+import pytest
+
+
+def make_toolchain(cflags):
+    from codepy.toolchain import GCCToolchain
+    return GCCToolchain(cc="gcc", ld="gcc", cflags=cflags,
+            ldflags=[], include_dirs=[], library_dirs=[], libraries=[],
+            defines=[], undefines=[], so_ext=".so", o_ext=".o")
+
+
+def test_with_isa_level():
+    from codepy.toolchain import ISA_LEVELS
+
+    toolchain = make_toolchain(
+            ["-O3", "-march=native", "-mtune=generic", "-mavx512f", "-fPIC"])
+
+    avx2_flags = [flags for name, flags, features in ISA_LEVELS
+            if name == "avx2"][0]
+    assert toolchain.with_isa_level("avx2").cflags \
+            == ["-O3", "-fPIC"] + avx2_flags
+    assert toolchain.with_isa_level("baseline").cflags == ["-O3", "-fPIC"]
+
+    # levels replace each other
+    assert toolchain.with_isa_level("avx512").with_isa_level("avx2").cflags \
+            == ["-O3", "-fPIC"] + avx2_flags
+
+    with pytest.raises(ValueError):
+        toolchain.with_isa_level("avx9000")
+
+
+def test_select_isa_level(monkeypatch):
+    import codepy.toolchain
+    from codepy.toolchain import ISA_LEVELS, select_isa_level
+
+    levels = [name for name, flags, features in ISA_LEVELS]
+    avx2_features = [features for name, flags, features in ISA_LEVELS
+            if name == "avx2"][0]
+
+    def set_cpu_features(features):
+        monkeypatch.setattr(codepy.toolchain, "get_cpu_features",
+                lambda: frozenset(features))
+
+    set_cpu_features(avx2_features | set(["sse4_2"]))
+    assert select_isa_level(levels) == "avx2"
+    assert select_isa_level(["avx512", "baseline"]) == "baseline"
+
+    set_cpu_features([])
+    assert select_isa_level(levels) == "baseline"
+    with pytest.raises(RuntimeError):
+        select_isa_level(["avx512", "avx2"])
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_isa_levels_lookup_order(monkeypatch, cached):
+    import imp
+    import codepy.jit
+    import codepy.toolchain
+    from codepy.toolchain import ISA_LEVELS
+
+    avx2_features = [features for name, flags, features in ISA_LEVELS
+            if name == "avx2"][0]
+    monkeypatch.setattr(codepy.toolchain, "get_cpu_features",
+            lambda: avx2_features)
+
+    compiled = []
+
+    def compile_from_string(toolchain, name, *args, **kwargs):
+        level = [level for level, flags, features in ISA_LEVELS
+                if flags and flags[0] in toolchain.cflags]
+        compiled.append(level[0] if level else "baseline")
+        return "checksum", "mod_name", "ext_file", not cached
+
+    monkeypatch.setattr(codepy.jit, "compile_from_string", compile_from_string)
+    monkeypatch.setattr(imp, "load_dynamic",
+            lambda mod_name, ext_file: (mod_name, ext_file))
+
+    codepy.jit.extension_from_string(make_toolchain(["-O3"]), "module", "",
+            isa_levels=["avx512", "avx2", "baseline"])
+
+    if cached:
+        assert compiled == ["avx2"]
+    else:
+        assert compiled == ["avx2", "avx512", "baseline"]
@@ -0,0 +1,30 @@
+import numpy
+
+
+def test_lazy_fusion():
+    from codepy.lazy import as_lazy
+
+    x = numpy.zeros(10, dtype=numpy.float32)
+    y = numpy.zeros(10, dtype=numpy.float64)
+
+    arguments, operation, values = (2*as_lazy(x) + y - x).fuse()
+
+    assert [arg.name for arg in arguments] == ["result", "_x0", "_x1", "_x2"]
+    assert arguments[0].dtype == numpy.float64
+    # x is passed only once
+    assert values[1] is x and values[2] is y
+    assert len(values) == 3
+    assert operation.startswith("result[i] = ")
+    assert operation.count("_x1[i]") == 2
+
+    # expressions of the same structure map to the same kernel
+    x2 = numpy.ones(10, dtype=numpy.float32)
+    y2 = numpy.ones(10, dtype=numpy.float64)
+    arguments2, operation2, _ = (3*as_lazy(x2) + y2 - x2).fuse()
+    assert operation2 == operation
+    assert ([arg.dtype for arg in arguments2]
+            == [arg.dtype for arg in arguments])
+
+
+if __name__ == "__main__":
+    test_lazy_fusion()
@@ -0,0 +1,68 @@
+SOURCE = """
+extern "C" int count(int n)
+{
+  int result = 0;
+  for (int i = 0; i < n; ++i)
+    if (i % 3)
+      result += i;
+    else
+      result -= 1;
+  return result;
+}
+"""
+
+
+def test_pgo(tmpdir):
+    import sys
+    from subprocess import check_call, Popen, PIPE
+    from codepy.jit import compile_from_string
+    from codepy.toolchain import guess_toolchain
+
+    toolchain = guess_toolchain()
+    cache_dir = str(tmpdir)
+
+    def compile():
+        checksum, mod_name, ext_file, recompiled = compile_from_string(
+                toolchain, "module", SOURCE, cache_dir=cache_dir, pgo=True)
+        return ext_file, recompiled
+
+    instrumented_file, recompiled = compile()
+    assert recompiled
+    assert compile() == (instrumented_file, False)
+
+    # profiles are written when the process exits
+    check_call([sys.executable, "-c",
+        "import ctypes; ctypes.CDLL(%r).count(1000)" % instrumented_file])
+
+    # an instrumented process still running
+    running = Popen([sys.executable, "-c",
+        "import ctypes, sys; lib = ctypes.CDLL(%r); print('loaded'); "
+        "sys.stdout.flush(); sys.stdin.read(); lib.count(500)"
+        % instrumented_file], stdin=PIPE, stdout=PIPE)
+    assert running.stdout.readline() == b"loaded\n"
+
+    optimized_file, recompiled = compile()
+    assert recompiled
+    assert optimized_file != instrumented_file
+    assert compile() == (optimized_file, False)
+
+    # kept while instrumented processes still update the profiles
+    running.communicate(b"")
+    assert running.returncode == 0
+    assert compile() == (optimized_file, False)
+
+    # rebuilt if no longer valid
+    import os
+    os.unlink(os.path.join(os.path.dirname(optimized_file), "info"))
+    rebuilt_file, recompiled = compile()
+    assert recompiled
+    assert os.path.exists(rebuilt_file)
+    assert compile() == (rebuilt_file, False)
+
+    import ctypes
+    assert ctypes.CDLL(rebuilt_file).count(10) == 23
+
+
+if __name__ == "__main__":
+    import tempfile
+    test_pgo(tempfile.mkdtemp())
@@ -30,3 +30,35 @@ def test():
     _fn = getattr(dll, 'greet')
     _fn.restype = int
     assert _fn() == 1
+
+
+def test_link_optimizations(tmpdir):
+    toolchain = guess_toolchain().with_optimization_level(
+            2, lto=True, linker="auto", gc_sections=True, strip=True)
+
+    module_code = """
+    extern "C" {
+        static int unused()
+        {
+            return 2;
+        }
+
+        int const greet()
+        {
+            return 1;
+        }
+    }
+    """
+    _, _, obj_path, _ = compile_from_string(toolchain, 'module', module_code,
+                                            cache_dir=str(tmpdir), object=True)
+    with open(obj_path, 'rb') as file:
+        obj = file.read()
+
+    _, _, ext_file, _ = compile_from_string(
+        toolchain, 'module', obj, source_name=['module.o'],
+        cache_dir=str(tmpdir), object=False, source_is_binary=True)
+
+    dll = CDLL(ext_file)
+    _fn = getattr(dll, 'greet')
+    _fn.restype = int
+    assert _fn() == 1